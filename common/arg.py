@@ -5,11 +5,20 @@ class Arg:
     self.__dict__.update(entries)
 
 class ModelConfig:
+  # config json 에 없는 경우 사용하는 기본값
+  defaults = {
+    'fused_qkv': False,
+    'attention_backend': 'reference',
+    'compile': False,
+    'activation_checkpointing': 0,  # k: k 번째 레이어마다 checkpointing (1: 모든 레이어, 0: 사용 안 함)
+    'activation_memory_budget': None,  # GB, 주어지면 추정 activation 메모리가 이 안에 들어오도록 레이어를 고른다
+  }
+
   def __init__(self, config_path):
     self.config_path = config_path
     f = open(self.config_path, 'r')
     self.config_json = json.load(f)
-    self.arg = Arg(**self.config_json)
+    self.arg = Arg(**{**self.defaults, **self.config_json})
 
   def get_config(self):
     return self.arg
@@ -0,0 +1,221 @@
+from functools import partial
+
+import torch
+
+from common.generate import greedy, temperature_sampling
+
+
+def pad_encoder_inputs(input_ids_list, pad_token_id=0, device=None):
+  """
+  길이가 서로 다른 인코더 입력(token id 리스트)들을 하나의 배치로 묶는다.
+  가장 긴 입력 길이에 맞춰 오른쪽을 pad 로 채우고, 데이터셋과 같은 [batch, 1, seq_len] 마스크를 만든다.
+  """
+  max_len = max(len(input_ids) for input_ids in input_ids_list)
+  encoder_input_ids = torch.full((len(input_ids_list), max_len), pad_token_id, dtype=torch.long, device=device)
+  for i, input_ids in enumerate(input_ids_list):
+    encoder_input_ids[i, :len(input_ids)] = torch.tensor(input_ids, dtype=torch.long, device=device)
+  encoder_input_mask = (encoder_input_ids != pad_token_id).unsqueeze(1)
+
+  return encoder_input_ids, encoder_input_mask
+
+
+@torch.no_grad()
+def generate(model,
+             encoder_input_ids,
+             encoder_input_mask,
+             decoder_input_ids,
+             sampler=greedy,
+             max_len=128,
+             min_len=0,
+             sep_token_id=3,
+             unk_token_id=1,
+             pad_token_id=0):
+  """
+  여러 대화를 한 배치로 묶어 lockstep 으로 디코딩한다.
+  encoder_input_ids: [batch, src_len], encoder_input_mask: [batch, 1, src_len]
+  decoder_input_ids: [prefix_len] 또는 [batch, prefix_len] (예: '[CLS] B: ')
+  sampler: [batch, vocab] logit 을 받아 [batch] token id 를 반환하는 함수
+  min_len: int 또는 row 별 최소 길이. 이 길이 이하에서 [SEP] 가 나오면 [UNK] (같은 화자의 다음 문장) 로 바꾼다.
+
+  row 마다 [SEP] 가 나오면 종료되고, 종료된 row 는 배치에서 제거되어 더 이상 연산하지 않는다.
+  반환: output_ids [batch, len] (prefix 와 종료 [SEP] 포함, 이후는 pad), lengths [batch],
+       scores [batch] (생성된 토큰들의 누적 log-probability)
+  """
+  cache = model.encode(encoder_input_ids, encoder_input_mask)
+  return generate_from_cache(model, cache, decoder_input_ids, sampler, max_len, min_len,
+                             sep_token_id, unk_token_id, pad_token_id)
+
+
+def _expand_prefix(decoder_input_ids, batch_size):
+  if decoder_input_ids.dim() == 1:
+    decoder_input_ids = decoder_input_ids.unsqueeze(0).expand(batch_size, -1)
+  return decoder_input_ids
+
+
+@torch.no_grad()
+def generate_from_cache(model,
+                        cache,
+                        decoder_input_ids,
+                        sampler=greedy,
+                        max_len=128,
+                        min_len=0,
+                        sep_token_id=3,
+                        unk_token_id=1,
+                        pad_token_id=0,
+                        mask_forbidden=False):
+  # Meena.encode() 로 만든 cache 에서 디코딩을 시작한다. 인자와 반환값은 generate() 와 같다.
+  decoder_input_ids = _expand_prefix(decoder_input_ids, cache.batch_size)
+  batch_size, prefix_len = decoder_input_ids.shape
+  device = decoder_input_ids.device
+
+  # 출력은 미리 할당한 [batch, max_len] 버퍼에 스텝마다 한 열씩 in-place 로 쓴다.
+  output_ids = torch.full((batch_size, max(max_len, prefix_len)), pad_token_id, dtype=torch.long, device=device)
+  output_ids[:, :prefix_len] = decoder_input_ids
+  scores = torch.zeros(batch_size, device=device)
+  cur_len = prefix_len
+
+  # 종료된 row 의 토큰은 pad, log_prob 은 0 이므로 스텝마다 종료 여부를 따로 추적하지 않는다.
+  for step_tokens, step_log_probs in stream_from_cache(model, cache, decoder_input_ids, sampler, max_len, min_len,
+                                                       sep_token_id, unk_token_id, pad_token_id, mask_forbidden):
+    output_ids[:, cur_len] = step_tokens
+    cur_len += 1
+    scores += step_log_probs
+
+  # 길이는 마지막에 한 번, 생성된 첫 [SEP] 위치로 계산한다. ([SEP] 가 없으면 cur_len)
+  is_sep = output_ids[:, prefix_len:cur_len] == sep_token_id
+  lengths = torch.where(is_sep.any(dim=1), prefix_len + is_sep.int().argmax(dim=1) + 1, cur_len)
+
+  return output_ids[:, :cur_len], lengths, scores
+
+
+@torch.no_grad()
+def stream_generate(model,
+                    encoder_input_ids,
+                    encoder_input_mask,
+                    decoder_input_ids,
+                    sampler=greedy,
+                    max_len=128,
+                    min_len=0,
+                    sep_token_id=3,
+                    unk_token_id=1,
+                    pad_token_id=0):
+  """
+  generate() 와 같은 디코딩을 하지만, 응답이 끝나기를 기다리지 않고 매 스텝 샘플링된 토큰을 바로 yield 한다.
+  yield: tokens [batch] (이미 종료된 row 는 pad, 종료 토큰 [SEP] 도 yield 된다), log_probs [batch]
+  yield 되는 텐서는 다음 스텝에서 재사용되므로 보관하려면 복사해야 한다.
+  """
+  cache = model.encode(encoder_input_ids, encoder_input_mask)
+  yield from stream_from_cache(model, cache, decoder_input_ids, sampler, max_len, min_len,
+                               sep_token_id, unk_token_id, pad_token_id)
+
+
+@torch.no_grad()
+def stream_from_cache(model,
+                      cache,
+                      decoder_input_ids,
+                      sampler=greedy,
+                      max_len=128,
+                      min_len=0,
+                      sep_token_id=3,
+                      unk_token_id=1,
+                      pad_token_id=0,
+                      mask_forbidden=False):
+  # mask_forbidden: [UNK] 와 min_len 이전의 [SEP] 를 샘플링 전에 logit 에서 제외한다.
+  # 기본(False)은 샘플링된 [SEP] 를 [UNK] 로 바꾸므로, 점수에 실제로 내보내지 않을 토큰의 확률이 섞일 수 있다.
+  decoder_input_ids = _expand_prefix(decoder_input_ids, cache.batch_size)
+  batch_size, prefix_len = decoder_input_ids.shape
+  device = decoder_input_ids.device
+
+  # lengths / min_len 은 아직 생성 중인 row 의 값만 들고 있어 스텝마다 active 로 indexing 하지 않는다.
+  min_len = torch.as_tensor(min_len, device=device).expand(batch_size)
+  lengths = torch.full((batch_size,), prefix_len, dtype=torch.long, device=device)
+  active = torch.arange(batch_size, device=device)  # 아직 생성 중인 row 의 원래 배치 index
+  next_input_ids = decoder_input_ids
+
+  # 스텝마다 새로 만들지 않고 재사용하는 출력 버퍼
+  step_tokens = torch.empty(batch_size, dtype=torch.long, device=device)
+  step_log_probs = torch.empty(batch_size, device=device)
+
+  for _ in range(max_len - prefix_len):
+    logits, cache = model.decode_step(next_input_ids, cache)
+    logits = logits[:, -1]
+    is_short = lengths <= min_len
+    if mask_forbidden:
+      logits = logits.clone()
+      logits[:, unk_token_id] = float('-inf')
+      logits[:, sep_token_id].masked_fill_(is_short, float('-inf'))
+    next_tokens = sampler(logits)
+
+    is_sep = next_tokens == sep_token_id
+    too_short = is_sep & is_short
+    next_tokens = next_tokens.masked_fill(too_short, unk_token_id)
+    is_done = is_sep & ~too_short
+    lengths += 1
+
+    log_probs = torch.log_softmax(logits.float(), dim=-1).gather(-1, next_tokens.unsqueeze(-1)).squeeze(-1)
+    if active.size(0) == batch_size:
+      step_log_probs.copy_(log_probs)
+      step_tokens.copy_(next_tokens)
+    else:
+      step_log_probs.zero_().index_copy_(0, active, log_probs)
+      step_tokens.fill_(pad_token_id).index_copy_(0, active, next_tokens)
+    yield step_tokens, step_log_probs
+
+    # 종료된 row 는 배치와 캐시에서 제거
+    if is_done.any():
+      keep = (~is_done).nonzero().squeeze(1)
+      if keep.numel() == 0:
+        break
+      active = active[keep]
+      lengths = lengths[keep]
+      min_len = min_len[keep]
+      next_tokens = next_tokens[keep]
+      cache = cache.index_select(keep)
+
+    next_input_ids = next_tokens.unsqueeze(1)
+
+@torch.no_grad()
+def sample_and_rank_generate(model,
+                             encoder_input_ids,
+                             encoder_input_mask,
+                             decoder_input_ids,
+                             N=20,
+                             sampler=None,
+                             max_len=128,
+                             min_len=0,
+                             sep_token_id=3,
+                             unk_token_id=1,
+                             pad_token_id=0,
+                             temperature=0.88):
+  """
+  Meena 논문의 응답(시퀀스) 단위 sample-and-rank
+  (토큰 하나를 고르는 common.generate.sample_and_rank 와는 다르다)
+  1. 문맥마다 N 개의 응답을 temperature sampling 으로 독립적으로 생성하고
+  2. 그 중 log-likelihood 가 가장 높은 응답을 선택한다.
+
+  인코더는 문맥마다 한 번만 실행하고, cache 를 N 개의 row 로 복제해 N 개 응답을 한 배치로 디코딩한다.
+  모든 후보가 [SEP] 를 생성하면 바로 종료된다.
+  sampler 를 주지 않으면 논문 설정대로 temperature(기본 0.88) sampling 을 쓴다.
+  greedy 처럼 결정적인 sampler 를 넘기면 N 개 후보가 모두 같아지므로 의미가 없다.
+  반환: 문맥별 best output_ids [batch, len], lengths [batch], scores [batch]
+  """
+  if sampler is None:
+    sampler = partial(temperature_sampling, temperature=temperature)
+
+  batch_size = encoder_input_ids.size(0)
+  device = encoder_input_ids.device
+
+  cache = model.encode(encoder_input_ids, encoder_input_mask)
+  cache = cache.index_select(torch.arange(batch_size, device=device).repeat_interleave(N))
+  if decoder_input_ids.dim() == 2:
+    decoder_input_ids = decoder_input_ids.repeat_interleave(N, dim=0)
+  if not isinstance(min_len, int):
+    min_len = torch.as_tensor(min_len, device=device).repeat_interleave(N)
+
+  # 점수가 실제로 내보낸 토큰의 확률만으로 계산되도록 [UNK] 와 너무 이른 [SEP] 는 샘플링 전에 제외한다.
+  output_ids, lengths, scores = generate_from_cache(model, cache, decoder_input_ids, sampler, max_len, min_len,
+                                                    sep_token_id, unk_token_id, pad_token_id, mask_forbidden=True)
+
+  # 문맥별로 점수가 가장 높은 후보를 선택
+  best = scores.view(batch_size, N).argmax(dim=-1) + torch.arange(batch_size, device=device) * N
+  return output_ids[best], lengths[best], scores[best]
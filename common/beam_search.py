@@ -0,0 +1,140 @@
+import torch
+
+
+class BeamHypotheses(object):
+  """
+  한 문맥에 대해 [SEP] 로 끝난 가설들 중 점수가 높은 beam_size 개를 보관한다.
+  점수는 생성된 토큰들의 누적 log-probability / (생성 길이 ** length_penalty)
+  """
+  def __init__(self, beam_size, length_penalty=1.0, early_stopping=True):
+    self.beam_size = beam_size
+    self.length_penalty = length_penalty
+    self.early_stopping = early_stopping
+    self.beams = []
+    self.worst_score = float('inf')
+
+  def __len__(self):
+    return len(self.beams)
+
+  def add(self, tokens, sum_log_probs, gen_len):
+    # max_len <= prefix 길이면 생성 길이가 0 이므로 1 로 맞춰 0 으로 나누지 않는다.
+    score = sum_log_probs / (max(gen_len, 1) ** self.length_penalty)
+    if len(self) < self.beam_size or score > self.worst_score:
+      self.beams.append((score, tokens))
+      if len(self) > self.beam_size:
+        self.beams.remove(min(self.beams, key=lambda x: x[0]))
+      self.worst_score = min(score for score, _ in self.beams)
+
+  def is_done(self, best_running_score, gen_len):
+    if len(self) < self.beam_size:
+      return False
+    if self.early_stopping:
+      return True
+    # 진행 중인 beam 중 가장 좋은 것도 보관된 가설보다 나아질 수 없으면 종료
+    return self.worst_score >= best_running_score / (max(gen_len, 1) ** self.length_penalty)
+
+  def best(self):
+    return max(self.beams, key=lambda x: x[0])
+
+
+@torch.no_grad()
+def beam_search(model,
+                encoder_input_ids,
+                encoder_input_mask,
+                decoder_input_ids,
+                beam_size=4,
+                max_len=128,
+                min_len=0,
+                length_penalty=1.0,
+                early_stopping=True,
+                sep_token_id=3,
+                pad_token_id=0):
+  """
+  배치 beam search. 문맥마다 beam_size 개의 beam 을 배치 row 로 두고 한 번의 decode_step 으로 함께 디코딩한다.
+  매 스텝 선택된 beam 순서대로 DecoderCache 를 재정렬하므로 prefix 를 다시 계산하지 않는다.
+  min_len 이하의 길이에서는 [SEP] 를 생성하지 않는다.
+  반환: 문맥별 best output_ids [batch, len] (prefix 와 [SEP] 포함, 이후는 pad), lengths [batch], scores [batch]
+  """
+  batch_size = encoder_input_ids.size(0)
+  device = encoder_input_ids.device
+
+  if decoder_input_ids.dim() == 1:
+    decoder_input_ids = decoder_input_ids.unsqueeze(0).expand(batch_size, -1)
+  prefix_len = decoder_input_ids.size(1)
+
+  # 인코더는 문맥마다 한 번만 실행하고 beam 수만큼 복제
+  row_index = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+  cache = model.encode(encoder_input_ids, encoder_input_mask).index_select(row_index)
+  sequences = decoder_input_ids[row_index]
+
+  # 처음에는 모든 beam 이 같으므로 첫 번째 beam 만 확장한다.
+  beam_scores = torch.zeros(batch_size, beam_size, device=device)
+  beam_scores[:, 1:] = float('-inf')
+
+  hypotheses = [BeamHypotheses(beam_size, length_penalty, early_stopping) for _ in range(batch_size)]
+  active = list(range(batch_size))  # 아직 탐색 중인 문맥의 원래 배치 index
+  beam_offset = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+  next_input_ids = sequences
+
+  for cur_len in range(prefix_len, max_len):
+    logits, cache = model.decode_step(next_input_ids, cache)
+    log_probs = torch.log_softmax(logits[:, -1].float(), dim=-1)
+    if cur_len <= min_len:
+      log_probs[:, sep_token_id] = float('-inf')
+
+    num_active = len(active)
+    vocab_size = log_probs.size(-1)
+    gen_len = cur_len + 1 - prefix_len
+
+    candidate_scores = (beam_scores.view(-1, 1) + log_probs).view(num_active, beam_size * vocab_size)
+    top_scores, top_ids = candidate_scores.topk(2 * beam_size, dim=-1)
+    top_beams = top_ids // vocab_size
+    top_tokens = top_ids % vocab_size
+
+    # 상위 beam_size 안에 든 [SEP] 후보는 완성된 가설로 보관
+    is_sep = top_tokens == sep_token_id
+    for i, rank in is_sep[:, :beam_size].nonzero().tolist():
+      row = i * beam_size + top_beams[i, rank].item()
+      tokens = torch.cat([sequences[row], sequences.new_tensor([sep_token_id])])
+      hypotheses[active[i]].add(tokens, top_scores[i, rank].item(), gen_len)
+
+    # 나머지 후보 중 상위 beam_size 개로 다음 beam 을 구성하고 cache 를 beam 순서로 재정렬
+    beam_scores, selected = top_scores.masked_fill(is_sep, float('-inf')).topk(beam_size, dim=-1)
+    next_beams = top_beams.gather(-1, selected)
+    next_tokens = top_tokens.gather(-1, selected)
+
+    beam_rows = (beam_offset[:num_active] + next_beams).view(-1)
+    sequences = torch.cat([sequences[beam_rows], next_tokens.view(-1, 1)], dim=1)
+    cache = cache.index_select(beam_rows)
+
+    # 탐색이 끝난 문맥은 배치에서 제거
+    best_running_scores = beam_scores[:, 0].tolist()
+    is_done = [hypotheses[b].is_done(best_running_scores[i], gen_len) for i, b in enumerate(active)]
+    if any(is_done):
+      keep = [i for i, done in enumerate(is_done) if not done]
+      active = [active[i] for i in keep]
+      if not active:
+        break
+      keep = torch.tensor(keep, device=device)
+      keep_rows = (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)).view(-1)
+      beam_scores = beam_scores[keep]
+      next_tokens = next_tokens[keep]
+      sequences = sequences[keep_rows]
+      cache = cache.index_select(keep_rows)
+
+    next_input_ids = next_tokens.view(-1, 1)
+
+  # max_len 까지 [SEP] 없이 진행된 beam 도 후보에 포함
+  gen_len = sequences.size(1) - prefix_len
+  for i, b in enumerate(active):
+    for k in range(beam_size):
+      hypotheses[b].add(sequences[i * beam_size + k], beam_scores[i, k].item(), gen_len)
+
+  best = [hypothesis.best() for hypothesis in hypotheses]
+  lengths = torch.tensor([len(tokens) for _, tokens in best], device=device)
+  scores = torch.tensor([score for score, _ in best], device=device)
+  output_ids = torch.full((batch_size, lengths.max().item()), pad_token_id, dtype=torch.long, device=device)
+  for i, (_, tokens) in enumerate(best):
+    output_ids[i, :len(tokens)] = tokens
+
+  return output_ids, lengths, scores
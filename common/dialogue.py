@@ -0,0 +1,49 @@
+from collections import deque
+
+
+class DialogueHistory(object):
+  """
+  대화 기록을 turn 별 token id 로 보관하는 ring buffer
+  인코더 입력은 '[CLS] A : ... [SEP] B : ... [SEP] ...' 형식이며, 가장 최근 max_len - 1 개 토큰만 사용한다.
+  (예전 chat.py 의 make_new_source_input 과 같은 규칙을 문자열 decode / 재 tokenize 없이 id 로 바로 만든다)
+  인코더 입력 범위를 완전히 벗어난 오래된 turn 은 버리고, max_turns 가 주어지면 turn 수도 제한한다.
+  """
+  def __init__(self, cls_token_id=2, sep_token_id=3, max_len=128, max_turns=None):
+    self.cls_token_id = cls_token_id
+    self.sep_token_id = sep_token_id
+    self.max_len = max_len
+    self.turns = deque(maxlen=max_turns)
+    self.num_tokens = 0  # turn 마다 붙는 [SEP] 포함
+
+  def __len__(self):
+    return len(self.turns)
+
+  def clear(self):
+    self.turns.clear()
+    self.num_tokens = 0
+
+  def add_turn(self, token_ids):
+    # token_ids: 화자 표시를 포함한 한 turn 의 토큰 (예: 'A : 안녕' 의 id, [CLS]/[SEP] 제외)
+    if len(self.turns) == self.turns.maxlen:
+      self.num_tokens -= len(self.turns[0]) + 1
+    self.turns.append(list(token_ids))
+    self.num_tokens += len(token_ids) + 1
+
+    # 가장 오래된 turn 이 없어도 인코더 입력이 꽉 차면 그 turn 은 더 이상 필요 없다.
+    window = self.max_len - 1
+    while len(self.turns) > 1 and self.num_tokens - len(self.turns[0]) - 1 >= window:
+      self.num_tokens -= len(self.turns.popleft()) + 1
+
+  def pop_turn(self):
+    # 마지막 turn 을 제거해 반환한다. (응답 다시 생성 등)
+    turn = self.turns.pop()
+    self.num_tokens -= len(turn) + 1
+    return turn
+
+  def encoder_input_ids(self):
+    # [CLS] + 최근 max_len - 1 개 토큰
+    input_ids = []
+    for turn in self.turns:
+      input_ids.extend(turn)
+      input_ids.append(self.sep_token_id)
+    return [self.cls_token_id] + input_ids[-(self.max_len - 1):]
@@ -1,8 +1,6 @@
 import random
-import torch
-import torch.nn.functional as F
+from functools import wraps
 
-import random
 import torch
 import torch.nn.functional as F
 
@@ -25,63 +23,86 @@ def random_sampling(predict, vocab, k=1024):
   return gen_word
 
 
-def top_p(logits, threshold=0.9, temperature=0.88, is_uniform_sample=False):
-  tmp_logits = logits/temperature
-  sorted_logits, sorted_indices = torch.sort(tmp_logits, descending=True)
-  indexs = sorted_indices.tolist()
+def _batched(sampler):
+  # 1-D logit [vocab] 도 받을 수 있도록 [1, vocab] 로 바꿔 샘플링한 뒤 되돌린다.
+  @wraps(sampler)
+  def wrapper(logits, *args, **kwargs):
+    if logits.dim() == 1:
+      return sampler(logits.unsqueeze(0), *args, **kwargs).squeeze(0)
+    return sampler(logits, *args, **kwargs)
+  return wrapper
+
+
+def _multinomial(probs, generator=None):
+  # probs: [batch, n] (정규화되지 않아도 됨) -> [batch]
+  return torch.multinomial(probs, 1, generator=generator).squeeze(-1)
+
 
-  sorted_softmax_logits = torch.softmax(sorted_logits, dim=-1)
-  cum_probs = torch.cumsum(sorted_softmax_logits, dim=-1)
+@_batched
+def greedy(logits):
+  # logits: [batch, vocab] -> [batch]
+  return torch.argmax(logits, dim=-1)
 
-  sorted_indices_to_remove = cum_probs > threshold
-  top_p_index = 0
 
-  # Top-p에 해당하는 index를 획득
-  for i in range(len(sorted_indices_to_remove)):
-    if sorted_indices_to_remove[i] == True:
-      top_p_index = 0 if i == 0 else i - 1
-      break
+@_batched
+def temperature_sampling(logits, temperature=1.0, generator=None):
+  if temperature is None or temperature == 0.0:
+    return torch.argmax(logits, dim=-1)
+  probs = torch.softmax(logits / temperature, dim=-1)
+  return _multinomial(probs, generator)
+
+
+@_batched
+def top_p(logits, threshold=0.9, temperature=0.88, is_uniform_sample=False, generator=None):
+  sorted_logits, sorted_indices = torch.sort(logits / temperature, descending=True, dim=-1)
+  sorted_probs = torch.softmax(sorted_logits, dim=-1)
+  cum_probs = torch.cumsum(sorted_probs, dim=-1)
+
+  # 누적 확률이 threshold 를 넘는 첫 토큰까지 남기고 나머지(tail)는 제거한다. (가장 큰 토큰은 항상 남는다)
+  sorted_indices_to_remove = (cum_probs - sorted_probs) > threshold
 
   if is_uniform_sample:
     # uniform sampling
-    sampled_index = random.randint(0, top_p_index - 1)
+    probs = (~sorted_indices_to_remove).float()
   else:
     # sampling by probability
-    # 확률에 따라 샘플링 된 인덱스를 반환
-    sampled_index = torch.multinomial(sorted_softmax_logits, 1)
+    probs = sorted_probs.masked_fill(sorted_indices_to_remove, 0.0)
 
-  return indexs[sampled_index]
+  sampled_index = _multinomial(probs, generator)
+  return sorted_indices.gather(-1, sampled_index.unsqueeze(-1)).squeeze(-1)
 
 
-def top_k(predict, k, is_uniform_sample=False):
-  # topk 중 랜덤으로 선택된 값을 반환.
-  probs, indexs = torch.topk(predict, k=k, dim=-1)
+@_batched
+def top_k(logits, k=40, temperature=1.0, is_uniform_sample=False, generator=None):
+  # topk 중 샘플링된 token id 를 반환.
+  top_logits, top_indices = torch.topk(logits / temperature, k=k, dim=-1)
 
   if is_uniform_sample:
     # uniform sampling
-    sampled_index = random.randint(0, k - 1)
+    probs = torch.ones_like(top_logits)
   else:
     # sampling by probability
-    # 확률에 따라 샘플링 된 인덱스를 반환
-    sampled_index = torch.multinomial(probs, 1)
+    probs = torch.softmax(top_logits, dim=-1)
+
+  sampled_index = _multinomial(probs, generator)
+  return top_indices.gather(-1, sampled_index.unsqueeze(-1)).squeeze(-1)
 
-  return indexs[sampled_index]
 
-def sample_and_rank(logit, N, temperature=0.88, is_uniform_sample=True):
-  logit = logit.squeeze()
-  logit = logit/temperature
-  softmax_logit = torch.softmax(logit,dim=-1)
+@_batched
+def sample_and_rank(logits, N, temperature=0.88, is_uniform_sample=True, generator=None):
+  # 한 스텝의 후보 토큰 N 개 중 하나를 고른다. 응답 N 개를 생성해 고르는 논문의 sample-and-rank 는
+  # common.batch_generate.sample_and_rank_generate 를 사용한다.
+  softmax_logits = torch.softmax(logits / temperature, dim=-1)
 
-  # 1. Sample N independent candidate responses using plain random sampling with Temperature
+  # 1. Sample N independent candidates using plain random sampling with Temperature
   if is_uniform_sample:
-    sampled_indice = random.choices([x for x in range(0,len(softmax_logit))],k=N)
+    sampled_indices = torch.randint(0, softmax_logits.size(-1), (softmax_logits.size(0), N),
+                                    device=logits.device, generator=generator)
   else:
-    sampled_indice = torch.multinomial(softmax_logit, N)
-
-  sampled_values = softmax_logit[sampled_indice]
+    sampled_indices = torch.multinomial(softmax_logits, N, generator=generator)
 
-  # 2. Select candidate response with highest probability
-  candidate_list = list(zip(sampled_indice, sampled_values))
-  max_candidate = max(candidate_list, key=lambda x: x[1])
+  sampled_values = softmax_logits.gather(-1, sampled_indices)
 
-  return max_candidate[0] #, max_candidate[1] # return index, score
\ No newline at end of file
+  # 2. Select candidate with highest probability
+  max_candidate = sampled_values.argmax(dim=-1, keepdim=True)
+  return sampled_indices.gather(-1, max_candidate).squeeze(-1)
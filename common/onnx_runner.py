@@ -0,0 +1,108 @@
+"""
+model/onnx_export.py 로 내보낸 encoder.onnx / decoder_step.onnx 로 Meena 를 실행한다.
+torch 없이 numpy 와 onnxruntime 만 사용한다.
+"""
+import numpy as np
+import onnxruntime as ort
+
+
+def greedy(logits, rng=None):
+  return logits.argmax(-1)
+
+def top_p(logits, threshold=0.9, temperature=0.88, rng=None):
+  # common.generate.top_p 와 같은 규칙의 numpy 구현 (logits: [batch, vocab])
+  rng = rng or np.random.default_rng()
+  logits = logits / temperature
+  sorted_indices = np.argsort(-logits, axis=-1)
+  sorted_logits = np.take_along_axis(logits, sorted_indices, axis=-1)
+  sorted_probs = np.exp(sorted_logits - sorted_logits[:, :1])
+  sorted_probs /= sorted_probs.sum(-1, keepdims=True)
+  cum_probs = np.cumsum(sorted_probs, axis=-1)
+
+  sorted_probs = np.where((cum_probs - sorted_probs) > threshold, 0.0, sorted_probs)
+  sorted_probs /= sorted_probs.sum(-1, keepdims=True)
+
+  # row 별 inverse CDF 샘플링
+  uniform = rng.random((sorted_probs.shape[0], 1))
+  sampled_index = (np.cumsum(sorted_probs, axis=-1) < uniform).sum(-1)
+  sampled_index = np.minimum(sampled_index, sorted_probs.shape[-1] - 1)
+  return np.take_along_axis(sorted_indices, sampled_index[:, None], axis=-1)[:, 0]
+
+
+class OnnxMeena(object):
+  def __init__(self, encoder_path, decoder_path, providers=('CPUExecutionProvider',)):
+    self.encoder = ort.InferenceSession(encoder_path, providers=list(providers))
+    self.decoder = ort.InferenceSession(decoder_path, providers=list(providers))
+
+  def encode(self, encoder_input_ids, encoder_input_mask):
+    # 반환하는 state 는 decode_step 에서 갱신된다.
+    cross_keys, cross_values = self.encoder.run(None, {'encoder_input_ids': encoder_input_ids.astype(np.int64),
+                                                       'encoder_input_mask': encoder_input_mask.astype(bool)})
+    num_layers, batch_size, head_num, _, d_k = cross_keys.shape
+    past = np.zeros((num_layers, batch_size, head_num, 0, d_k), dtype=cross_keys.dtype)
+    return {'encoder_input_mask': encoder_input_mask.astype(bool),
+            'cross_keys': cross_keys,
+            'cross_values': cross_values,
+            'past_keys': past,
+            'past_values': past,
+            'positions': np.zeros(batch_size, dtype=np.int64)}
+
+  def decode_step(self, input_ids, state):
+    # input_ids: [batch] 새 토큰 1개씩 -> logits [batch, vocab]
+    logits, state['past_keys'], state['past_values'] = self.decoder.run(None, {
+      'input_ids': input_ids.reshape(-1, 1).astype(np.int64),
+      'positions': state['positions'],
+      'encoder_input_mask': state['encoder_input_mask'],
+      'cross_keys': state['cross_keys'],
+      'cross_values': state['cross_values'],
+      'past_keys': state['past_keys'],
+      'past_values': state['past_values'],
+    })
+    state['positions'] = state['positions'] + 1
+    return logits, state
+
+
+def generate(model: OnnxMeena,
+             encoder_input_ids,
+             encoder_input_mask,
+             decoder_input_ids,
+             sampler=greedy,
+             max_len=128,
+             min_len=0,
+             sep_token_id=3,
+             unk_token_id=1,
+             pad_token_id=0,
+             rng=None):
+  """
+  common.batch_generate.generate 와 같은 규칙의 디코딩 루프
+  decoder_input_ids: [prefix_len] prefix (모든 row 공통). prefix 도 한 토큰씩 decode_step 으로 넣는다.
+  반환: output_ids [batch, len] (prefix 와 종료 [SEP] 포함, 이후는 pad), lengths [batch]
+  """
+  batch_size = encoder_input_ids.shape[0]
+  state = model.encode(encoder_input_ids, encoder_input_mask)
+
+  for token in decoder_input_ids[:-1]:
+    _, state = model.decode_step(np.full(batch_size, token), state)
+
+  output_ids = np.full((batch_size, max_len), pad_token_id, dtype=np.int64)
+  output_ids[:, :len(decoder_input_ids)] = decoder_input_ids
+  lengths = np.full(batch_size, len(decoder_input_ids))
+  is_finished = np.zeros(batch_size, dtype=bool)
+  next_tokens = np.full(batch_size, decoder_input_ids[-1])
+
+  for step in range(len(decoder_input_ids), max_len):
+    logits, state = model.decode_step(next_tokens, state)
+    next_tokens = sampler(logits, rng=rng)
+
+    is_sep = next_tokens == sep_token_id
+    too_short = is_sep & (lengths <= min_len)
+    next_tokens = np.where(too_short, unk_token_id, next_tokens)
+    next_tokens = np.where(is_finished, pad_token_id, next_tokens)
+
+    output_ids[:, step] = next_tokens
+    lengths += ~is_finished
+    is_finished |= is_sep & ~too_short
+    if is_finished.all():
+      break
+
+  return output_ids[:, :lengths.max()], lengths
@@ -0,0 +1,233 @@
+"""
+CPU pipeline-parallel 추론
+Meena 를 여러 stage 로 나눠 stage 마다 별도 프로세스(torch.multiprocessing)에서 실행한다.
+  stage 0     : token/position embedding + MeenaEncoder + 앞쪽 Decoder 레이어
+  stage 1..n-2: 가운데 Decoder 레이어
+  stage n-1   : 뒤쪽 Decoder 레이어 + norm + lm_head (마지막 position 만)
+stage 사이의 hidden state 는 torch.multiprocessing Queue 로 전달된다. (텐서는 shared memory 로 넘어간다)
+여러 요청(micro-batch)을 동시에 흘려 보내, 한 요청이 뒤 stage 에 있는 동안 앞 stage 는 다른 요청의 토큰을 계산한다.
+"""
+import os
+from collections import deque
+
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+
+from common.generate import greedy
+from model.cache import DecoderCache
+
+
+class PipelineStage(nn.Module):
+  def __init__(self, model, start, end, is_first, is_last):
+    super(PipelineStage, self).__init__()
+    self.is_first = is_first
+    self.is_last = is_last
+    self.decoders = nn.ModuleList(model.meena_decoder.decoders[start:end])
+    if is_first:
+      self.meena_encoder = model.meena_encoder
+      self.token_emb = model.token_emb
+      self.position_emb = model.meena_decoder.position_emb
+    if is_last:
+      self.norm = model.norm
+      self.lm_head = model.lm_head
+
+  def encode(self, encoder_input_ids, encoder_input_mask):
+    cache = DecoderCache(len(self.decoders))
+    cache.encoder_hidden_states = self.meena_encoder(encoder_input_ids, encoder_input_mask)
+    cache.encoder_mask = encoder_input_mask
+    return cache
+
+  def embed(self, input_ids, cache):
+    return self.token_emb(input_ids) + self.position_emb(input_ids, cache.seq_len)
+
+  def forward(self, hidden_states, cache):
+    for decoder, layer_cache in zip(self.decoders, cache.layers):
+      hidden_states = decoder(hidden_states, cache.encoder_hidden_states, cache.encoder_mask, layer_cache)
+    cache.seq_len += hidden_states.size(1)
+
+    if self.is_last:
+      return self.lm_head(self.norm(hidden_states[:, -1]))
+    return hidden_states
+
+
+def _stage_worker(stage, inbox, outbox, num_threads):
+  """
+  stage 프로세스의 루프. micro-batch id 별로 자기 레이어의 cache 를 보관한다.
+  메시지: ('encode', id, encoder_input_ids, encoder_input_mask, decoder_input_ids)  stage 0 만
+          ('step', id, decoder_input_ids)                                          stage 0
+          ('step', id, hidden_states, encoder_hidden_states, encoder_mask)         stage 1 이후 (인코더 출력은 첫 스텝에만)
+          ('free', id)  micro-batch 종료, None: 프로세스 종료
+  마지막 stage 는 ('logits', id, logits [batch, vocab]) 를 driver 로 보낸다.
+  """
+  torch.set_num_threads(num_threads)
+  stage.eval()
+  caches = {}
+
+  with torch.no_grad():
+    while True:
+      message = inbox.get()
+      if message is None:
+        if not stage.is_last:
+          outbox.put(None)
+        break
+
+      kind, mb_id = message[0], message[1]
+      if kind == 'free':
+        caches.pop(mb_id, None)
+        if not stage.is_last:
+          outbox.put(message)
+        continue
+
+      first_step = False
+      if kind == 'encode':
+        encoder_input_ids, encoder_input_mask, decoder_input_ids = message[2:]
+        cache = caches[mb_id] = stage.encode(encoder_input_ids, encoder_input_mask)
+        hidden_states = stage.embed(decoder_input_ids, cache)
+        first_step = True
+      elif stage.is_first:
+        cache = caches[mb_id]
+        hidden_states = stage.embed(message[2], cache)
+      else:
+        hidden_states, encoder_hidden_states, encoder_mask = message[2:]
+        if mb_id not in caches:
+          cache = caches[mb_id] = DecoderCache(len(stage.decoders))
+          cache.encoder_hidden_states = encoder_hidden_states
+          cache.encoder_mask = encoder_mask
+          first_step = True
+        cache = caches[mb_id]
+
+      output = stage(hidden_states, cache)
+      if stage.is_last:
+        outbox.put(('logits', mb_id, output))
+      elif first_step:
+        outbox.put(('step', mb_id, output, cache.encoder_hidden_states, cache.encoder_mask))
+      else:
+        outbox.put(('step', mb_id, output, None, None))
+
+
+def split_layers(num_layers, num_stages):
+  # Decoder 레이어를 stage 수로 최대한 고르게 나눈다. (앞쪽 stage 가 하나씩 더 가진다)
+  sizes = [num_layers // num_stages + (1 if i < num_layers % num_stages else 0) for i in range(num_stages)]
+  bounds, start = [], 0
+  for size in sizes:
+    bounds.append((start, start + size))
+    start += size
+  return bounds
+
+
+class PipelineMeena(object):
+  """
+  Meena 를 num_stages 개 프로세스로 나눠 실행하는 pipeline-parallel 추론기 (CPU 전용)
+  weight 는 share_memory() 로 공유되므로 프로세스 수만큼 복사되지 않는다.
+  stage_layers 로 stage 별 Decoder 레이어 수를 직접 정할 수 있다. (stage 0 은 인코더도 실행하므로 적게 주는 것이 좋다)
+
+      with PipelineMeena(model, num_stages=3) as pipeline:
+          results = pipeline.generate(requests, sampler=top_p)
+  """
+  def __init__(self, model, num_stages=2, num_threads=None, stage_layers=None):
+    num_layers = len(model.meena_decoder.decoders)
+    if stage_layers is None:
+      bounds = split_layers(num_layers, num_stages)
+    else:
+      assert sum(stage_layers) == num_layers and len(stage_layers) == num_stages
+      starts = [sum(stage_layers[:i]) for i in range(num_stages)]
+      bounds = [(start, start + size) for start, size in zip(starts, stage_layers)]
+
+    model.eval()
+    model.share_memory()
+    self.stages = [PipelineStage(model, start, end, i == 0, i == num_stages - 1)
+                   for i, (start, end) in enumerate(bounds)]
+    self.num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_stages)
+    self.processes = []
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def start(self):
+    ctx = mp.get_context('spawn')
+    self.queues = [ctx.Queue() for _ in range(len(self.stages) + 1)]  # queues[-1]: 마지막 stage -> driver
+    self.processes = [ctx.Process(target=_stage_worker,
+                                  args=(stage, self.queues[i], self.queues[i + 1], self.num_threads),
+                                  daemon=True)
+                      for i, stage in enumerate(self.stages)]
+    for process in self.processes:
+      process.start()
+
+  def stop(self):
+    if self.processes:
+      self.queues[0].put(None)
+      for process in self.processes:
+        process.join()
+      self.processes = []
+
+  @torch.no_grad()
+  def generate(self,
+               requests,
+               sampler=greedy,
+               max_len=128,
+               min_len=0,
+               sep_token_id=3,
+               unk_token_id=1,
+               pad_token_id=0,
+               max_in_flight=None):
+    """
+    requests: (encoder_input_ids [batch, src_len], encoder_input_mask [batch, 1, src_len],
+               decoder_input_ids [prefix_len] 또는 [batch, prefix_len]) 의 리스트. 요청 하나가 micro-batch 하나이다.
+    max_in_flight: 동시에 pipeline 에 넣는 micro-batch 수 (기본값: stage 수, 모든 stage 가 쉬지 않는 최소값)
+    [SEP]/min_len 처리는 batch_generate.generate 와 같다.
+    반환: 요청 순서대로 (output_ids [batch, len], lengths [batch])
+    """
+    inbox, results_queue = self.queues[0], self.queues[-1]
+    max_in_flight = max_in_flight or len(self.stages)
+    pending = deque(enumerate(requests))
+    active = {}
+    results = [None] * len(requests)
+
+    def launch():
+      mb_id, (encoder_input_ids, encoder_input_mask, decoder_input_ids) = pending.popleft()
+      batch_size = encoder_input_ids.size(0)
+      if decoder_input_ids.dim() == 1:
+        decoder_input_ids = decoder_input_ids.unsqueeze(0).expand(batch_size, -1)
+      prefix_len = decoder_input_ids.size(1)
+
+      output_ids = torch.full((batch_size, max_len), pad_token_id, dtype=torch.long)
+      output_ids[:, :prefix_len] = decoder_input_ids
+      active[mb_id] = {'output_ids': output_ids,
+                       'cur_len': prefix_len,
+                       'lengths': torch.full((batch_size,), prefix_len, dtype=torch.long),
+                       'is_finished': torch.zeros(batch_size, dtype=torch.bool)}
+      inbox.put(('encode', mb_id, encoder_input_ids, encoder_input_mask, decoder_input_ids.contiguous()))
+
+    while pending and len(active) < max_in_flight:
+      launch()
+
+    while active:
+      _, mb_id, logits = results_queue.get()
+      state = active[mb_id]
+      next_tokens = sampler(logits)
+
+      is_sep = next_tokens == sep_token_id
+      too_short = is_sep & (state['lengths'] <= min_len)
+      next_tokens = torch.where(too_short, torch.full_like(next_tokens, unk_token_id), next_tokens)
+      next_tokens = next_tokens.masked_fill(state['is_finished'], pad_token_id)
+
+      state['output_ids'][:, state['cur_len']] = next_tokens
+      state['cur_len'] += 1
+      state['lengths'] += ~state['is_finished']
+      state['is_finished'] |= is_sep & ~too_short
+
+      if state['is_finished'].all() or state['cur_len'] >= max_len:
+        results[mb_id] = (state['output_ids'][:, :state['cur_len']], state['lengths'])
+        del active[mb_id]
+        inbox.put(('free', mb_id))
+        if pending:
+          launch()
+      else:
+        inbox.put(('step', mb_id, next_tokens.unsqueeze(1)))
+
+    return results
@@ -0,0 +1,76 @@
+import logging
+
+import torch
+
+
+class MixedPrecision(object):
+  """
+  torch.autocast + GradScaler 기반 mixed precision (apex amp 대체)
+  config 의 fp16 / fp16_opt_level 로 정한다.
+    fp16=false 또는 'O0': fp32
+    'O1' / 'O2' / 'O3': CUDA 는 fp16 autocast + GradScaler, CPU 는 bf16 autocast
+    'bf16': 장치와 관계없이 bf16 autocast (loss scaling 불필요)
+  apex O2/O3 처럼 가중치를 fp16 으로 바꾸지 않고, 가중치와 optimizer 상태는 fp32 로 유지한다.
+  """
+  def __init__(self, enabled=True, opt_level='O1', device='cuda'):
+    self.device_type = torch.device(device).type
+    self.enabled = enabled and opt_level != 'O0'
+
+    if opt_level == 'bf16' or self.device_type != 'cuda':
+      self.dtype = torch.bfloat16
+    else:
+      self.dtype = torch.float16
+
+    # bf16 은 fp32 와 지수 범위가 같으므로 loss scaling 이 필요 없다.
+    self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.enabled and self.dtype == torch.float16)
+
+  def autocast(self):
+    return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+  def backward(self, loss):
+    self.scaler.scale(loss).backward()
+
+  def unscale_(self, optimizer):
+    # gradient clipping 전에 호출해 원래 크기의 gradient 로 되돌린다.
+    self.scaler.unscale_(optimizer)
+
+  def step(self, optimizer):
+    # inf/nan gradient 가 있으면 step 을 건너뛰고 scale 을 줄인다.
+    self.scaler.step(optimizer)
+    self.scaler.update()
+
+  def state_dict(self):
+    return self.scaler.state_dict()
+
+  def load_state_dict(self, state_dict):
+    if state_dict and self.scaler.is_enabled():
+      self.scaler.load_state_dict(state_dict)
+
+  def load_checkpoint(self, checkpoint):
+    # apex 시절 체크포인트는 'scaler' 대신 'amp' 상태를 가지고 있으므로 loss scale 만 옮겨 온다.
+    if 'scaler' in checkpoint:
+      self.load_state_dict(checkpoint['scaler'])
+    elif 'amp' in checkpoint:
+      if not self.scaler.is_enabled():
+        logging.info('Ignoring apex amp state: loss scaling is off for this precision setting')
+        return
+      self.load_state_dict(scaler_state_from_amp(checkpoint['amp']))
+
+
+def scaler_state_from_amp(amp_state):
+  """
+  apex amp.state_dict() ({'loss_scaler0': {'loss_scale': ..., 'unskipped': ...}, ...}) 를
+  GradScaler.state_dict() 형식으로 바꾼다. loss scaler 가 없으면 None.
+  """
+  loss_scaler = (amp_state or {}).get('loss_scaler0')
+  if not loss_scaler:
+    return None
+
+  logging.info(f'Migrating apex amp loss scale {loss_scaler["loss_scale"]} to GradScaler')
+  return {
+    'scale': float(loss_scaler['loss_scale']),
+    'growth_factor': 2.0,
+    'backoff_factor': 0.5,
+    'growth_interval': 2000,
+    '_growth_tracker': 0,
+  }
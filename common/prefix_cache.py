@@ -0,0 +1,115 @@
+import time
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+
+def token_ids_key(*token_id_lists, **params):
+  """
+  token id 시퀀스(들)와 생성 인자로 만든 해시 key
+  시퀀스마다 길이를 함께 넣어 경계가 다른 입력끼리 같은 key 가 되지 않도록 한다.
+  """
+  digest = hashlib.blake2b(digest_size=16)
+  for token_ids in token_id_lists:
+    token_ids = array('q', token_ids)
+    digest.update(array('q', [len(token_ids)]).tobytes())
+    digest.update(token_ids.tobytes())
+  if params:
+    digest.update(repr(sorted(params.items())).encode('utf-8'))
+  return digest.hexdigest()
+
+
+class LRUCache(object):
+  """
+  크기(max_entries, max_bytes)와 유효 시간(ttl, 초)이 제한된 LRU 저장소
+  한도를 넘으면 가장 오래 사용하지 않은 항목부터 제거하고, ttl 이 지난 항목은 조회할 때 제거한다.
+  """
+  def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+
+    self.entries = OrderedDict()  # key -> (value, nbytes, expires_at)
+    self.lock = threading.Lock()
+    self.nbytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+        self._remove(key)
+        self.expirations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return entry[0]
+
+  def put(self, key, value, nbytes=0):
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+      expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+      self.entries[key] = (value, nbytes, expires_at)
+      self.nbytes += nbytes
+
+      while self.entries and ((self.max_entries is not None and len(self.entries) > self.max_entries) or
+                              (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+
+  def _remove(self, key):
+    _, nbytes, _ = self.entries.pop(key)
+    self.nbytes -= nbytes
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    with self.lock:
+      return {'entries': len(self.entries),
+              'bytes': self.nbytes,
+              'hits': self.hits,
+              'misses': self.misses,
+              'evictions': self.evictions,
+              'expirations': self.expirations}
+
+
+class EncoderStateCache(LRUCache):
+  """
+  인코더 입력 token id 시퀀스 -> Meena.encode() 결과 (batch 1, 인코더 출력과 cross-attention key/value)
+  같은 문맥(자주 오는 인사, 고정 프롬프트 등)은 MeenaEncoder 를 다시 실행하지 않는다.
+  반환되는 cache 는 복사본이므로 디코딩에 그대로 사용해도 저장된 값은 바뀌지 않는다.
+  """
+  def lookup(self, encoder_input_ids):
+    cache = self.get(token_ids_key(encoder_input_ids))
+    return None if cache is None else cache.copy()
+
+  def store(self, encoder_input_ids, cache):
+    self.put(token_ids_key(encoder_input_ids), cache, cache.nbytes())
+
+
+class ResponseCache(LRUCache):
+  """
+  (인코더 입력, 디코더 prefix, 생성 인자) -> 생성된 응답 token id 리스트
+  greedy / beam search 처럼 같은 입력에 항상 같은 응답을 내는 결정적 디코딩에서만 사용해야 한다.
+  """
+  def lookup(self, encoder_input_ids, decoder_input_ids, **params):
+    output_ids = self.get(token_ids_key(encoder_input_ids, decoder_input_ids, **params))
+    return None if output_ids is None else list(output_ids)
+
+  def store(self, encoder_input_ids, decoder_input_ids, output_ids, **params):
+    self.put(token_ids_key(encoder_input_ids, decoder_input_ids, **params), tuple(output_ids), 8 * len(output_ids))
@@ -0,0 +1,149 @@
+import os
+import random
+import signal
+import logging
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ResumableSampler(Sampler):
+  """
+  중간에서 다시 시작할 수 있는 학습 데이터 sampler
+  epoch 마다 (seed + epoch) 로 순서를 정하므로 같은 seed 면 재시작 후에도 같은 순서가 나온다.
+  set_epoch(epoch, start_index) 로 이미 학습한 샘플을 읽지 않고 start_index 번째 샘플부터 내보낸다.
+  """
+  def __init__(self, num_samples, shuffle=True, seed=0):
+    self.num_samples = num_samples
+    self.shuffle = shuffle
+    self.seed = seed
+    self.epoch = 0
+    self.start_index = 0
+
+  def set_epoch(self, epoch, start_index=0):
+    self.epoch = epoch
+    self.start_index = start_index
+
+  def __iter__(self):
+    if self.shuffle:
+      generator = torch.Generator()
+      generator.manual_seed(self.seed + self.epoch)
+      indices = torch.randperm(self.num_samples, generator=generator)
+    else:
+      indices = torch.arange(self.num_samples)
+    return iter(indices[self.start_index:].tolist())
+
+  def __len__(self):
+    return max(self.num_samples - self.start_index, 0)
+
+  def state_dict(self):
+    return {'seed': self.seed, 'epoch': self.epoch, 'start_index': self.start_index}
+
+
+def get_rng_state():
+  # torch.load(weights_only=True) 로도 읽을 수 있도록 numpy 상태는 python 리스트로 저장한다.
+  np_state = np.random.get_state()
+  state = {
+    'python': random.getstate(),
+    'numpy': [np_state[0], np_state[1].tolist(), np_state[2], np_state[3], np_state[4]],
+    'torch': torch.get_rng_state(),
+  }
+  if torch.cuda.is_available():
+    state['cuda'] = torch.cuda.get_rng_state_all()
+  return state
+
+
+def set_rng_state(state):
+  random.setstate(state['python'])
+  np_state = state['numpy']
+  np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32), np_state[2], np_state[3], np_state[4]))
+  torch.set_rng_state(state['torch'].cpu())
+  if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+    torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state['cuda']])
+
+
+def load_resume_state(checkpoint, model, optimizer, seed, steps_per_epoch, model_name=None, precision=None,
+                      require_model_name=False):
+  """
+  MeenaTrainer 체크포인트에서 모델/optimizer/loss scale/난수 상태를 복원하고 (start_epoch, start_step, global_steps, losses) 를 돌려준다.
+  epoch_step, rng_state, seed 가 없는 이전 형식의 체크포인트도 이어서 학습하며,
+  apex 시절의 'amp' 상태는 precision(MixedPrecision) 의 GradScaler 로 옮긴다.
+  다른 model_name 으로 저장된 체크포인트면 경고를 남기고 None 을 돌려준다.
+  require_model_name 이면 model_name 이 없는 (이전 형식) 체크포인트도 이어받지 않는다.
+  """
+  if model_name is not None:
+    saved_model_name = checkpoint.get('model_name', None if require_model_name else model_name)
+    if saved_model_name != model_name:
+      logging.warning(f'Checkpoint was saved by {checkpoint.get("model_name")}, not {model_name}; starting from step 0')
+      return None
+
+  start_epoch = checkpoint['epoch']
+  global_steps = checkpoint['train_step']
+  if 'epoch_step' in checkpoint:
+    start_step = checkpoint['epoch_step']
+  else: # epoch 내 위치를 저장하지 않던 이전 체크포인트
+    start_step = global_steps if start_epoch == 0 else global_steps % steps_per_epoch
+    start_step = min(start_step, steps_per_epoch)
+    logging.info(f'Legacy checkpoint without epoch_step, resuming at epoch_step {start_step} computed from train_step')
+
+  model.load_state_dict(checkpoint['model_state_dict'])
+  optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+  if precision is not None:
+    precision.load_checkpoint(checkpoint)
+  if 'rng_state' in checkpoint:
+    set_rng_state(checkpoint['rng_state'])
+  if checkpoint.get('seed', seed) != seed:
+    logging.warning(f'Checkpoint seed {checkpoint["seed"]} != trainer seed {seed}, data order will differ')
+
+  return start_epoch, start_step, global_steps, checkpoint['losses']
+
+
+def atomic_save(obj, path):
+  # 저장 도중 프로세스가 종료되어도 이전 체크포인트가 깨지지 않도록 임시 파일에 쓴 뒤 교체한다.
+  tmp_path = f'{path}.tmp'
+  with open(tmp_path, 'wb') as f:
+    torch.save(obj, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+class PreemptionHandler(object):
+  """
+  with 블록 안에서 SIGTERM/SIGINT 를 받으면 바로 종료하지 않고 requested 를 세운다.
+  학습 루프는 현재 배치를 마친 뒤 requested 를 확인해 체크포인트를 저장하고 종료한다.
+  저장을 기다리는 중에 시그널을 한 번 더 받으면 바로 종료한다.
+  """
+  def __init__(self, signals=(signal.SIGTERM, signal.SIGINT)):
+    self.signals = signals
+    self.signum = None
+    self._previous_handlers = {}
+
+  @property
+  def requested(self):
+    return self.signum is not None
+
+  @property
+  def exit_code(self):
+    return 128 + self.signum
+
+  def _handle(self, signum, frame):
+    if self.signum is not None:
+      raise SystemExit(128 + signum)
+    self.signum = signum
+    logging.warning(f'Received {signal.Signals(signum).name}, saving checkpoint after the current batch')
+
+  def __enter__(self):
+    # signal handler 는 main thread 에서만 등록할 수 있다.
+    if threading.current_thread() is threading.main_thread():
+      for signum in self.signals:
+        self._previous_handlers[signum] = signal.signal(signum, self._handle)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    for signum, handler in self._previous_handlers.items():
+      signal.signal(signum, handler)
+    self._previous_handlers = {}
+    return False
@@ -0,0 +1,235 @@
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+import torch
+
+from common.batch_generate import pad_encoder_inputs
+from common.generate import greedy
+from model.cache import DecoderCache
+
+
+class GenerationRequest(object):
+  """
+  스케줄러에 제출하는 생성 요청 하나
+  encoder_input_ids / decoder_input_ids 는 token id 리스트 (decoder 쪽은 '[CLS] B: ' 같은 prefix)
+  결과는 future 로 전달된다. (prefix 와 종료 [SEP] 를 포함한 token id 리스트)
+  on_token 이 주어지면 토큰이 샘플링될 때마다 스케줄러 thread 에서 on_token(token_id) 를 호출한다. (streaming)
+  cache 에 같은 인코더 입력으로 만든 Meena.encode() 결과(batch 1)를 넘기면 인코더를 다시 실행하지 않는다.
+  return_cache=True 이면 prefill 후 request.cache 에 이 요청의 인코더 결과를 남긴다. (세션 저장소 등에서 재사용)
+  """
+  def __init__(self, encoder_input_ids, decoder_input_ids, max_len=128, min_len=0, on_token=None, cache=None,
+               return_cache=False):
+    self.encoder_input_ids = encoder_input_ids
+    self.decoder_input_ids = decoder_input_ids
+    self.max_len = max_len
+    self.min_len = min_len
+    self.on_token = on_token
+    self.cache = cache
+    self.return_cache = return_cache
+
+    self.output_ids = list(decoder_input_ids)
+    self.future = Future()
+
+
+class _RunningBatch(object):
+  # 함께 디코딩 중인 요청들과 그 cache, row 별 길이/제한
+  def __init__(self, requests, cache, lengths):
+    device = lengths.device
+    self.requests = requests
+    self.cache = cache
+    self.lengths = lengths
+    self.min_lens = torch.tensor([request.min_len for request in requests], device=device)
+    self.max_lens = torch.tensor([request.max_len for request in requests], device=device)
+    self.next_tokens = None
+
+  def __len__(self):
+    return len(self.requests)
+
+  def select(self, keep):
+    self.requests = [self.requests[i] for i in keep.tolist()]
+    self.cache = self.cache.index_select(keep)
+    self.lengths = self.lengths[keep]
+    self.min_lens = self.min_lens[keep]
+    self.max_lens = self.max_lens[keep]
+    self.next_tokens = self.next_tokens[keep]
+
+  def merge(self, other):
+    self.requests = self.requests + other.requests
+    self.cache = DecoderCache.concat([self.cache, other.cache])
+    self.lengths = torch.cat([self.lengths, other.lengths])
+    self.min_lens = torch.cat([self.min_lens, other.min_lens])
+    self.max_lens = torch.cat([self.max_lens, other.max_lens])
+    self.next_tokens = torch.cat([self.next_tokens, other.next_tokens])
+
+
+class ContinuousBatchingScheduler(object):
+  """
+  Continuous (in-flight) batching 스케줄러
+  하나의 Meena 모델을 전용 thread 에서 실행하며, 새 요청은 도착하는 대로 prefill 후 실행 중인 배치에 합치고
+  [SEP] 를 생성하거나 max_len 에 도달한 요청은 그 스텝에서 바로 배치에서 제거한다.
+
+  max_batch_size: 동시에 디코딩하는 최대 요청 수
+  max_queue_wait: 배치가 비어 있을 때 첫 요청 이후 다른 요청을 함께 prefill 하기 위해 기다리는 최대 시간(초)
+  encoder_cache: 주어지면 인코더 입력이 같은 요청은 저장된 인코더 결과를 사용하고 MeenaEncoder 를 건너뛴다.
+  """
+  def __init__(self,
+               model,
+               sampler=greedy,
+               max_batch_size=16,
+               max_queue_wait=0.01,
+               sep_token_id=3,
+               unk_token_id=1,
+               pad_token_id=0,
+               encoder_cache=None):
+    self.model = model
+    self.sampler = sampler
+    self.max_batch_size = max_batch_size
+    self.max_queue_wait = max_queue_wait
+    self.sep_token_id = sep_token_id
+    self.unk_token_id = unk_token_id
+    self.pad_token_id = pad_token_id
+    self.encoder_cache = encoder_cache  # common.prefix_cache.EncoderStateCache
+    self.device = next(model.parameters()).device
+
+    self.queue = queue.Queue()
+    self.batch = None
+    self.running = False
+    self.thread = None
+
+  def submit(self, request):
+    self.queue.put(request)
+    return request.future
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    if self.thread is not None:
+      self.thread.join()
+
+  def _run(self):
+    while self.running:
+      new_requests = self._collect()
+      try:
+        with torch.no_grad():
+          if new_requests:
+            self._prefill(new_requests)
+          if self.batch is not None:
+            self._step()
+      except Exception as e:
+        logging.exception('Generation failed')
+        failed = new_requests + (self.batch.requests if self.batch is not None else [])
+        for request in failed:
+          if not request.future.done():
+            request.future.set_exception(e)
+        self.batch = None
+
+  def _collect(self):
+    running = 0 if self.batch is None else len(self.batch)
+    free = self.max_batch_size - running
+    new_requests = []
+
+    if running == 0:
+      # 배치가 비어 있으면 첫 요청을 기다린 뒤, max_queue_wait 동안 도착한 요청을 함께 prefill 한다.
+      try:
+        new_requests.append(self.queue.get(timeout=0.1))
+      except queue.Empty:
+        return new_requests
+      deadline = time.monotonic() + self.max_queue_wait
+      while len(new_requests) < free:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        try:
+          new_requests.append(self.queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+
+    while len(new_requests) < free:
+      try:
+        new_requests.append(self.queue.get_nowait())
+      except queue.Empty:
+        break
+
+    return new_requests
+
+  def _prefill(self, requests):
+    # prefix 길이가 같은 요청끼리 묶어 인코더와 디코더 prefix 를 한 번에 계산한다.
+    groups = {}
+    for request in requests:
+      groups.setdefault(len(request.decoder_input_ids), []).append(request)
+
+    for prefix_len, group in groups.items():
+      # 인코더 결과가 이미 있는 요청은 인코더를 건너뛰고, 나머지는 한 번에 인코딩한 뒤 cache 를 합친다.
+      if self.encoder_cache is not None:
+        for request in group:
+          if request.cache is None:
+            request.cache = self.encoder_cache.lookup(request.encoder_input_ids)
+      fresh = [request for request in group if request.cache is None]
+      encoded = [request for request in group if request.cache is not None]
+      caches = [request.cache.copy() for request in encoded]
+      if fresh:
+        encoder_input_ids, encoder_input_mask = pad_encoder_inputs([request.encoder_input_ids for request in fresh],
+                                                                   self.pad_token_id, self.device)
+        cache = self.model.encode(encoder_input_ids, encoder_input_mask)
+        for i, request in enumerate(fresh):
+          if request.return_cache or self.encoder_cache is not None:
+            row = cache.encoder_row(i, len(request.encoder_input_ids))
+            if self.encoder_cache is not None:
+              self.encoder_cache.store(request.encoder_input_ids, row)
+            if request.return_cache:
+              request.cache = row
+        caches.insert(0, cache)
+      group = fresh + encoded
+      cache = caches[0] if len(caches) == 1 else DecoderCache.concat(caches)
+
+      decoder_input_ids = torch.tensor([request.decoder_input_ids for request in group], device=self.device)
+      logits, cache = self.model.decode_step(decoder_input_ids, cache)
+
+      lengths = torch.full((len(group),), prefix_len, dtype=torch.long, device=self.device)
+      batch = self._accept(_RunningBatch(group, cache, lengths), logits[:, -1])
+      if batch is None:
+        continue
+      if self.batch is None:
+        self.batch = batch
+      else:
+        self.batch.merge(batch)
+
+  def _step(self):
+    logits, self.batch.cache = self.model.decode_step(self.batch.next_tokens.unsqueeze(1), self.batch.cache)
+    self.batch = self._accept(self.batch, logits[:, -1])
+
+  def _accept(self, batch, logits):
+    # 샘플링한 토큰을 요청별 출력에 붙이고, 종료된 요청은 결과를 넘긴 뒤 배치에서 제거한다.
+    next_tokens = self.sampler(logits)
+
+    is_sep = next_tokens == self.sep_token_id
+    too_short = is_sep & (batch.lengths <= batch.min_lens)
+    next_tokens = torch.where(too_short, torch.full_like(next_tokens, self.unk_token_id), next_tokens)
+    batch.lengths = batch.lengths + 1
+    batch.next_tokens = next_tokens
+    is_done = (is_sep & ~too_short) | (batch.lengths >= batch.max_lens)
+
+    for request, token in zip(batch.requests, next_tokens.tolist()):
+      request.output_ids.append(token)
+      if request.on_token is not None:
+        request.on_token(token)
+
+    if not is_done.any():
+      return batch
+
+    for request, done in zip(batch.requests, is_done.tolist()):
+      if done:
+        request.future.set_result(request.output_ids)
+
+    keep = (~is_done).nonzero().squeeze(1)
+    if keep.numel() == 0:
+      return None
+    batch.select(keep)
+    return batch
@@ -0,0 +1,151 @@
+import time
+import threading
+from collections import OrderedDict
+
+from common.dialogue import DialogueHistory
+
+
+class Session(object):
+  """
+  대화 하나의 상태
+  history: token id 대화 기록 (DialogueHistory)
+  encoder_state: (인코더 입력 id tuple, Meena.encode() cache). 인코더 입력이 같을 때만 재사용한다.
+  """
+  def __init__(self, session_id, history):
+    self.session_id = session_id
+    self.history = history
+    self.encoder_state = None
+    self.last_access = time.monotonic()
+
+  def nbytes(self):
+    # token id 는 python int 리스트이므로 대략 토큰당 8 byte 로 계산한다.
+    nbytes = 8 * self.history.num_tokens
+    if self.encoder_state is not None:
+      nbytes += self.encoder_state[1].nbytes()
+    return nbytes
+
+
+class SessionStore(object):
+  """
+  대화 id 별 Session 을 보관하는 LRU 저장소
+  max_sessions 또는 memory_budget(byte) 을 넘으면 가장 오래 사용하지 않은 세션부터
+  1) 다시 계산할 수 있는 encoder_state 를 먼저 버리고, 2) 그래도 넘으면 세션 전체를 제거한다.
+  stats() 의 hit/miss/eviction 수로 저장소 크기를 정할 수 있다.
+  """
+  def __init__(self, max_sessions=None, memory_budget=None, cls_token_id=2, sep_token_id=3, max_len=128,
+               max_turns=None):
+    self.max_sessions = max_sessions
+    self.memory_budget = memory_budget
+    self.cls_token_id = cls_token_id
+    self.sep_token_id = sep_token_id
+    self.max_len = max_len
+    self.max_turns = max_turns
+
+    self.sessions = OrderedDict()
+    self.lock = threading.Lock()
+    self.nbytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.encoder_hits = 0
+    self.encoder_misses = 0
+    self.encoder_evictions = 0
+
+  def __len__(self):
+    return len(self.sessions)
+
+  def __contains__(self, session_id):
+    return session_id in self.sessions
+
+  def get(self, session_id):
+    # 세션을 찾고(hit) 없으면 새로 만든다(miss). 찾은 세션은 가장 최근 사용으로 옮긴다.
+    with self.lock:
+      session = self.sessions.get(session_id)
+      if session is not None:
+        self.hits += 1
+        self.sessions.move_to_end(session_id)
+      else:
+        self.misses += 1
+        session = Session(session_id, DialogueHistory(self.cls_token_id, self.sep_token_id, self.max_len,
+                                                      self.max_turns))
+        self.sessions[session_id] = session
+        self._evict(keep=session_id)
+      session.last_access = time.monotonic()
+      return session
+
+  def remove(self, session_id):
+    with self.lock:
+      session = self.sessions.pop(session_id, None)
+      if session is not None:
+        self.nbytes -= session.nbytes()
+
+  def add_turn(self, session, token_ids):
+    # encoder_state 는 인코더 입력 id 로 확인하므로 대화 기록이 바뀌어도 지우지 않는다. (pop_turn 후 재사용)
+    with self.lock:
+      before = session.nbytes()
+      session.history.add_turn(token_ids)
+      self._update(session, before)
+
+  def pop_turn(self, session):
+    with self.lock:
+      before = session.nbytes()
+      turn = session.history.pop_turn()
+      self._update(session, before)
+      return turn
+
+  def lookup_encoder_state(self, session, encoder_input_ids):
+    # 같은 인코더 입력으로 만든 encoder_state 가 있으면 반환한다. (없으면 None, 호출한 쪽에서 다시 계산)
+    with self.lock:
+      state = session.encoder_state
+      if state is not None and state[0] == tuple(encoder_input_ids):
+        self.encoder_hits += 1
+        return state[1]
+      self.encoder_misses += 1
+      return None
+
+  def store_encoder_state(self, session, encoder_input_ids, cache):
+    with self.lock:
+      before = session.nbytes()
+      session.encoder_state = (tuple(encoder_input_ids), cache)
+      self._update(session, before)
+
+  def _update(self, session, before):
+    if session.session_id in self.sessions:
+      self.nbytes += session.nbytes() - before
+    self._evict(keep=session.session_id)
+
+  def _evict(self, keep=None):
+    # 1) LRU 순서로 encoder_state 를 버린다.
+    if self.memory_budget is not None and self.nbytes > self.memory_budget:
+      for session in self.sessions.values():
+        if self.nbytes <= self.memory_budget:
+          break
+        if session.encoder_state is not None and session.session_id != keep:
+          before = session.nbytes()
+          session.encoder_state = None
+          self.nbytes += session.nbytes() - before
+          self.encoder_evictions += 1
+
+    # 2) LRU 순서로 세션을 제거한다. (방금 사용한 세션은 남긴다)
+    while len(self.sessions) > 1 and (
+        (self.max_sessions is not None and len(self.sessions) > self.max_sessions) or
+        (self.memory_budget is not None and self.nbytes > self.memory_budget)):
+      session_id, session = next(iter(self.sessions.items()))
+      if session_id == keep:
+        self.sessions.move_to_end(session_id)
+        session_id, session = next(iter(self.sessions.items()))
+      del self.sessions[session_id]
+      self.nbytes -= session.nbytes()
+      self.evictions += 1
+
+  def stats(self):
+    with self.lock:
+      return {'sessions': len(self.sessions),
+              'bytes': self.nbytes,
+              'hits': self.hits,
+              'misses': self.misses,
+              'evictions': self.evictions,
+              'encoder_hits': self.encoder_hits,
+              'encoder_misses': self.encoder_misses,
+              'encoder_evictions': self.encoder_evictions}
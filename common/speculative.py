@@ -0,0 +1,156 @@
+import torch
+
+
+def warp_probs(logits, temperature=0.88, threshold=0.9):
+  """
+  common.generate.top_p 가 샘플링하는 분포 그 자체를 [batch, vocab] 확률로 반환한다.
+  temperature 가 0 또는 None 이면 greedy (argmax one-hot), threshold 가 None 이면 temperature sampling 분포
+  """
+  if not temperature:
+    return torch.zeros_like(logits, dtype=torch.float).scatter_(-1, logits.argmax(-1, keepdim=True), 1.0)
+
+  probs = torch.softmax(logits.float() / temperature, dim=-1)
+  if threshold is None:
+    return probs
+
+  sorted_probs, sorted_indices = torch.sort(probs, descending=True, dim=-1)
+  cum_probs = torch.cumsum(sorted_probs, dim=-1)
+  sorted_probs = sorted_probs.masked_fill((cum_probs - sorted_probs) > threshold, 0.0)
+  probs = torch.zeros_like(probs).scatter_(-1, sorted_indices, sorted_probs)
+  return probs / probs.sum(-1, keepdim=True)
+
+
+class SpeculativeStats(object):
+  """
+  speculative decoding 지표. 여러 응답에 걸쳐 누적할 수 있다.
+  acceptance_rate: draft 가 제안한 토큰 중 target 이 받아들인 비율
+  tokens_per_target_pass: target 모델 한 번 실행당 생성된 토큰 수 (일반 디코딩은 1)
+  """
+  def __init__(self):
+    self.draft_tokens = 0
+    self.accepted_tokens = 0
+    self.target_passes = 0
+    self.generated_tokens = 0
+
+  @property
+  def acceptance_rate(self):
+    return self.accepted_tokens / max(self.draft_tokens, 1)
+
+  @property
+  def tokens_per_target_pass(self):
+    return self.generated_tokens / max(self.target_passes, 1)
+
+  def as_dict(self):
+    return {'draft_tokens': self.draft_tokens,
+            'accepted_tokens': self.accepted_tokens,
+            'target_passes': self.target_passes,
+            'generated_tokens': self.generated_tokens,
+            'acceptance_rate': self.acceptance_rate,
+            'tokens_per_target_pass': self.tokens_per_target_pass}
+
+
+@torch.no_grad()
+def speculative_generate(model,
+                         draft_model,
+                         encoder_input_ids,
+                         encoder_input_mask,
+                         decoder_input_ids,
+                         num_draft_tokens=4,
+                         max_len=128,
+                         min_len=0,
+                         temperature=0.88,
+                         threshold=0.9,
+                         sep_token_id=3,
+                         unk_token_id=1,
+                         pad_token_id=0,
+                         generator=None,
+                         stats=None):
+  """
+  Speculative decoding (Leviathan et al. 2023, Chen et al. 2023)
+  draft_model (예: meena-config-small) 이 num_draft_tokens 개의 토큰을 순서대로 제안하면
+  model 이 한 번의 decode_step 으로 모두 검증한다. draft 토큰 x 는 min(1, p(x)/q(x)) 확률로 받아들이고,
+  처음 거절된 위치에서는 norm(max(p - q, 0)) 에서 다시 샘플링하므로 출력 분포는 model 로 top-p 샘플링한 것과 같다.
+  모두 받아들여지면 model 의 마지막 logit 에서 토큰 하나를 더 샘플링한다.
+
+  두 모델은 같은 tokenizer(vocab) 와 인코더 입력을 사용한다. 응답 하나(batch 1)의 지연 시간을 줄이기 위한 것이다.
+  [SEP]/min_len 처리는 batch_generate.generate 와 같다.
+  반환: output_ids [1, len] (prefix 와 종료 [SEP] 포함), length, stats (SpeculativeStats)
+  """
+  assert encoder_input_ids.size(0) == 1, 'speculative_generate 는 batch 1 만 지원한다.'
+  assert model.lm_head.out_features == draft_model.lm_head.out_features, 'model 과 draft_model 의 vocab 이 다르다.'
+  stats = stats if stats is not None else SpeculativeStats()
+  device = encoder_input_ids.device
+  if decoder_input_ids.dim() == 1:
+    decoder_input_ids = decoder_input_ids.unsqueeze(0)
+  prefix_len = decoder_input_ids.size(1)
+
+  cache = model.encode(encoder_input_ids, encoder_input_mask)
+  draft_cache = draft_model.encode(encoder_input_ids, encoder_input_mask)
+
+  # 생성된 토큰은 미리 할당한 버퍼에 쓴다. cache 에는 마지막 토큰을 제외한 sequence 가 들어 있다.
+  sequence = torch.full((1, max_len), pad_token_id, dtype=torch.long, device=device)
+  sequence[:, :prefix_len] = decoder_input_ids
+  cur_len = prefix_len
+  is_finished = False
+
+  def apply_rules(token, length):
+    # 샘플링된 토큰에 [SEP]/min_len 규칙을 적용하고, 응답이 끝났는지 함께 반환한다.
+    if token == sep_token_id and length <= min_len:
+      token = unk_token_id
+    return token, token == sep_token_id or length + 1 >= max_len
+
+  while not is_finished:
+    # 1. draft 모델이 토큰을 하나씩 제안한다. (sampled: 규칙 적용 전 샘플링된 토큰)
+    draft_len = cur_len
+    sampled, draft_probs = [], []
+    while len(sampled) < num_draft_tokens:
+      draft_logits, draft_cache = draft_model.decode_step(sequence[:, draft_cache.seq_len:draft_len], draft_cache)
+      probs = warp_probs(draft_logits[:, -1], temperature, threshold)
+      token = torch.multinomial(probs, 1, generator=generator).item()
+      sampled.append(token)
+      draft_probs.append(probs[0])
+
+      token, draft_done = apply_rules(token, draft_len)
+      sequence[0, draft_len] = token
+      draft_len += 1
+      if draft_done:
+        break
+    num_drafts = len(sampled)
+    stats.draft_tokens += num_drafts
+
+    # 2. model 이 draft 토큰들을 한 번에 검증한다. (마지막 num_drafts + 1 개 position 의 logit 만 계산)
+    input_ids = sequence[:, cache.seq_len:draft_len]
+    logits_index = torch.arange(input_ids.size(1) - num_drafts - 1, input_ids.size(1), device=device).unsqueeze(0)
+    logits, cache = model.decode_step(input_ids, cache, logits_index=logits_index)
+    target_probs = warp_probs(logits[0], temperature, threshold)
+    stats.target_passes += 1
+
+    # 3. accept / reject
+    for i, token in enumerate(sampled):
+      p, q = target_probs[i], draft_probs[i]
+      accepted = bool(torch.rand((), device=device, generator=generator) < p[token] / q[token])
+      if accepted:
+        stats.accepted_tokens += 1
+      else:
+        residual = (p - q).clamp(min=0)
+        token = torch.multinomial(residual if residual.sum() > 0 else p, 1, generator=generator).item()
+
+      token, is_finished = apply_rules(token, cur_len)
+      sequence[0, cur_len] = token
+      cur_len += 1
+      stats.generated_tokens += 1
+      if is_finished or not accepted:
+        break
+    else:
+      # draft 토큰이 모두 받아들여지면 model 의 마지막 logit 에서 토큰을 하나 더 샘플링한다.
+      token = torch.multinomial(target_probs[num_drafts], 1, generator=generator).item()
+      token, is_finished = apply_rules(token, cur_len)
+      sequence[0, cur_len] = token
+      cur_len += 1
+      stats.generated_tokens += 1
+
+    # 받아들여진 sequence 와 다른 토큰은 캐시에서 제거한다.
+    cache.crop(min(cache.seq_len, cur_len - 1))
+    draft_cache.crop(min(draft_cache.seq_len, cur_len - 1))
+
+  return sequence[:, :cur_len], cur_len, stats
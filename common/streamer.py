@@ -0,0 +1,28 @@
+from transformers import BertTokenizer
+
+
+class IncrementalDetokenizer(object):
+  """
+  생성된 token id 를 하나씩 받아 새로 확정된 텍스트 조각을 반환한다.
+  전체 응답을 다시 decode 하지 않고 토큰 하나만 문자열로 바꾸므로 토큰당 비용이 일정하다.
+  BertTokenizer 의 wordpiece 규칙('##' 는 앞 토큰에 붙임)을 따르며 special token 은 건너뛴다.
+  """
+  def __init__(self, tokenizer: BertTokenizer):
+    self.tokenizer = tokenizer
+    self.special_ids = set(tokenizer.all_special_ids)
+    self.is_first = True
+
+  def reset(self):
+    self.is_first = True
+
+  def add(self, token_id: int) -> str:
+    if token_id in self.special_ids:
+      return ''
+
+    token = self.tokenizer.convert_ids_to_tokens(token_id)
+    if token.startswith('##'):
+      return token[2:]
+    if self.is_first:
+      self.is_first = False
+      return token
+    return ' ' + token
@@ -0,0 +1,88 @@
+"""
+eager / torch.compile 모드의 학습 스텝과 토큰 생성 속도 비교 (small config, CPU 에서도 실행 가능)
+첫 호출 시간(compile 모드는 graph compile 포함)은 따로 출력한다.
+
+    python benchmark_compile.py --config ../config/meena-config-small.json
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import copy
+import time
+import argparse
+
+import torch
+
+from common.arg import ModelConfig
+from common.batch_generate import generate
+from model.meena import Meena, compile_meena
+
+def make_batch(config, vocab_size, batch_size):
+    encoder_input_ids = torch.randint(5, vocab_size, (batch_size, config.max_seq_len))
+    decoder_input_ids = torch.randint(5, vocab_size, (batch_size, config.max_seq_len))
+    encoder_input_mask = (encoder_input_ids != 0).unsqueeze(1)
+    return encoder_input_ids, decoder_input_ids, encoder_input_mask, decoder_input_ids.clone()
+
+def train_step_time(model, batch, steps, warmup):
+    # 반환: (첫 스텝 시간, warmup 이후 스텝당 평균 시간)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+    start = time.perf_counter()
+    for i in range(max(warmup, 1) + steps):
+        if i == 1:
+            first = time.perf_counter() - start
+        if i == max(warmup, 1):
+            start = time.perf_counter()
+        _, loss = model(*batch)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return first, (time.perf_counter() - start) / steps
+
+@torch.no_grad()
+def decode_tokens_per_second(model, batch, gen_len, warmup):
+    model.eval()
+    encoder_input_ids, decoder_input_ids, encoder_input_mask, _ = batch
+    prefix = decoder_input_ids[0, :1]
+    start = time.perf_counter()
+    for i in range(max(warmup, 1)):
+        generate(model, encoder_input_ids, encoder_input_mask, prefix, max_len=gen_len)
+        if i == 0:
+            first = time.perf_counter() - start
+    start = time.perf_counter()
+    _, lengths, _ = generate(model, encoder_input_ids, encoder_input_mask, prefix, max_len=gen_len)
+    return first, (lengths - 1).sum().item() / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/meena-config-small.json')
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--gen-len', type=int, default=64)
+    args = parser.parse_args()
+
+    torch.manual_seed(9)
+    config = ModelConfig(args.config).get_config()
+    batch = make_batch(config, args.vocab_size, args.batch_size)
+
+    eager_model = Meena.from_config(config, vocab_size=args.vocab_size)
+    compiled_model = compile_meena(copy.deepcopy(eager_model))
+
+    results = {}
+    for name, model in (('eager', eager_model), ('compile', compiled_model)):
+        train_first, train_step = train_step_time(model, batch, args.steps, args.warmup)
+        decode_first, decode_speed = decode_tokens_per_second(model, batch, args.gen_len, args.warmup)
+        results[name] = (train_step, decode_speed)
+        print(f'{name:8s} | train step: {train_step * 1000:.1f}ms | decode: {decode_speed:.1f} tokens/s | '
+              f'first call: train {train_first:.1f}s, decode {decode_first:.1f}s')
+
+    print(f'speedup  | train: {results["eager"][0] / results["compile"][0]:.2f}x | '
+          f'decode: {results["compile"][1] / results["eager"][1]:.2f}x')
+
+if __name__ == '__main__':
+    main()
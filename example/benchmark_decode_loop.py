@@ -0,0 +1,111 @@
+"""
+디코딩 루프의 토큰당 host overhead 비교
+모델 연산을 빼고(매 스텝 같은 logit 을 반환하는 모델) 루프 자체의 비용만 잰다.
+  legacy: 예전 chat.py 처럼 매 토큰 tolist() -> list append -> torch.tensor 재생성
+  buffer: batch_generate.generate_from_cache 의 미리 할당된 [batch, max_len] 버퍼 + in-place 길이 갱신
+buffer 루프는 매 스텝 log_softmax 로 응답 점수를 계산하므로, 같은 일을 하도록 점수 계산을 넣은 legacy 루프와 비교하고
+점수 계산 비용은 따로 출력한다.
+--config 를 주면 small config 모델로 실제 generate 의 tokens/s 도 잰다.
+
+    python benchmark_decode_loop.py --max-len 128 --repeat 50
+    python benchmark_decode_loop.py --config ../config/meena-config-small.json
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import time
+import argparse
+
+import torch
+
+from common.arg import ModelConfig
+from common.batch_generate import generate, generate_from_cache
+from common.generate import greedy
+from model.meena import Meena
+
+class ConstantLogitsCache(object):
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+    def index_select(self, index):
+        return ConstantLogitsCache(index.numel())
+
+class ConstantLogitsModel(object):
+    # [SEP] 가 절대 나오지 않는 고정 logit 을 반환해 항상 max_len 까지 디코딩하게 한다.
+    def __init__(self, vocab_size, sep_token_id=3):
+        self.logits = torch.randn(1, 1, vocab_size)
+        self.logits[..., sep_token_id] = float('-inf')
+
+    def decode_step(self, decoder_input_ids, cache):
+        return self.logits.expand(decoder_input_ids.size(0), -1, -1), cache
+
+@torch.no_grad()
+def legacy_loop(model, prefix, max_len, sep_token_id=3, track_scores=False):
+    target_input_ids = prefix.unsqueeze(0)
+    cache = ConstantLogitsCache(1)
+    score = torch.zeros(1)
+    for _ in range(max_len - prefix.size(0)):
+        logits, cache = model.decode_step(target_input_ids[:, -1:], cache)
+        step_logits = logits[:, -1]
+        sampled_word = greedy(step_logits.squeeze(0)).item()
+        if track_scores:
+            # buffer 루프와 같은 스텝별 점수 계산
+            score += torch.log_softmax(step_logits.float(), dim=-1)[:, sampled_word]
+        if sampled_word == sep_token_id:
+            break
+        target_input_ids = target_input_ids.tolist()
+        target_input_ids[0].append(sampled_word)
+        target_input_ids = torch.tensor(target_input_ids)
+    return target_input_ids
+
+@torch.no_grad()
+def buffer_loop(model, prefix, max_len):
+    return generate_from_cache(model, ConstantLogitsCache(1), prefix, greedy, max_len)[0]
+
+def per_token_us(loop, repeat, num_tokens):
+    loop()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeat):
+        loop()
+    return (time.perf_counter() - start) / (repeat * num_tokens) * 1e6
+
+@torch.no_grad()
+def model_tokens_per_second(config, vocab_size, max_len):
+    model = Meena.from_config(config, vocab_size=vocab_size)
+    model.eval()
+    encoder_input_ids = torch.randint(5, vocab_size, (1, config.max_seq_len))
+    encoder_input_mask = (encoder_input_ids != 0).unsqueeze(1)
+    prefix = torch.tensor([2])
+    generate(model, encoder_input_ids, encoder_input_mask, prefix, max_len=8)  # warmup
+    start = time.perf_counter()
+    _, lengths, _ = generate(model, encoder_input_ids, encoder_input_mask, prefix, max_len=max_len)
+    return (lengths - 1).sum().item() / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--max-len', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--config', default=None)
+    args = parser.parse_args()
+
+    model = ConstantLogitsModel(args.vocab_size)
+    prefix = torch.tensor([2, 5, 6])  # '[CLS] B:' 와 같은 길이 3 의 prefix
+    num_tokens = args.max_len - prefix.size(0)
+
+    legacy_plain = per_token_us(lambda: legacy_loop(model, prefix, args.max_len), args.repeat, num_tokens)
+    legacy = per_token_us(lambda: legacy_loop(model, prefix, args.max_len, track_scores=True), args.repeat, num_tokens)
+    buffer = per_token_us(lambda: buffer_loop(model, prefix, args.max_len), args.repeat, num_tokens)
+    print(f'host overhead per token (both with score tracking) | legacy: {legacy:.1f}us | buffer: {buffer:.1f}us | '
+          f'removed: {legacy - buffer:.1f}us ({(1 - buffer / legacy) * 100:.0f}%)')
+    print(f'score tracking (log_softmax) per token | {legacy - legacy_plain:.1f}us | legacy without it: {legacy_plain:.1f}us')
+
+    if args.config is not None:
+        config = ModelConfig(args.config).get_config()
+        print(f'generate with {args.config}: {model_tokens_per_second(config, args.vocab_size, args.max_len):.1f} tokens/s')
+
+if __name__ == '__main__':
+    main()
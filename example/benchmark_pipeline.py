@@ -0,0 +1,68 @@
+"""
+단일 프로세스 generate 와 pipeline-parallel(PipelineMeena) 추론의 처리량 비교 (CPU)
+여러 요청을 micro-batch 로 흘려 보내 stage 프로세스들이 동시에 다른 요청의 토큰을 계산한다.
+
+    python benchmark_pipeline.py --config ../config/meena-config.json --num-stages 3 --num-requests 12
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import time
+import argparse
+
+import torch
+
+from common.arg import ModelConfig
+from common.batch_generate import generate
+from common.pipeline import PipelineMeena
+from model.meena import Meena
+
+def make_requests(config, vocab_size, num_requests, batch_size):
+    requests = []
+    for _ in range(num_requests):
+        encoder_input_ids = torch.randint(5, vocab_size, (batch_size, config.max_seq_len // 2))
+        encoder_input_mask = (encoder_input_ids != 0).unsqueeze(1)
+        requests.append((encoder_input_ids, encoder_input_mask, torch.tensor([2])))
+    return requests
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/meena-config-small.json')
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--num-stages', type=int, default=2)
+    parser.add_argument('--stage-layers', type=int, nargs='*', default=None, help='stage 별 Decoder 레이어 수')
+    parser.add_argument('--num-requests', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=1, help='요청(micro-batch) 당 row 수')
+    parser.add_argument('--gen-len', type=int, default=32)
+    args = parser.parse_args()
+
+    config = ModelConfig(args.config).get_config()
+    model = Meena.from_config(config, vocab_size=args.vocab_size)
+    model.eval()
+    requests = make_requests(config, args.vocab_size, args.num_requests, args.batch_size)
+    num_tokens = args.num_requests * args.batch_size * (args.gen_len - 1)
+
+    # 생성 길이를 같게 하기 위해 [SEP] 가 나오지 않는 greedy 를 사용한다.
+    def sampler(logits):
+        logits[:, 3] = float('-inf')
+        return logits.argmax(-1)
+
+    start = time.perf_counter()
+    for encoder_input_ids, encoder_input_mask, decoder_input_ids in requests:
+        generate(model, encoder_input_ids, encoder_input_mask, decoder_input_ids, sampler=sampler, max_len=args.gen_len)
+    single = num_tokens / (time.perf_counter() - start)
+
+    with PipelineMeena(model, num_stages=args.num_stages, stage_layers=args.stage_layers) as pipeline:
+        pipeline.generate(requests[:1], sampler=sampler, max_len=4)  # warmup
+        start = time.perf_counter()
+        pipeline.generate(requests, sampler=sampler, max_len=args.gen_len)
+        pipelined = num_tokens / (time.perf_counter() - start)
+
+    print(f'tokens/s | single process: {single:.1f} | pipeline ({args.num_stages} stages): {pipelined:.1f} | '
+          f'speedup: {pipelined / single:.2f}x')
+
+if __name__ == '__main__':
+    main()
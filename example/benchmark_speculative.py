@@ -0,0 +1,97 @@
+"""
+speculative decoding (small config draft) 과 일반 top-p 디코딩의 응답당 지연 시간 비교
+두 방식의 출력 분포는 같으므로 지연 시간과 draft 토큰 acceptance rate 만 비교하면 된다.
+acceptance rate 는 학습된 checkpoint 에서만 의미가 있다. (랜덤 초기화 모델끼리는 거의 받아들여지지 않는다)
+
+    python benchmark_speculative.py --config ../config/meena-config.json \
+                                    --checkpoint ../checkpoint/komeena-base-finetuning-v3.pth \
+                                    --draft-config ../config/meena-config-small.json \
+                                    --draft-checkpoint ../checkpoint/komeena-small.pth
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import time
+import argparse
+from functools import partial
+
+import torch
+from transformers import BertTokenizer
+
+from common.arg import ModelConfig
+from common.batch_generate import generate
+from common.generate import top_p
+from common.speculative import SpeculativeStats, speculative_generate
+from model.checkpoint import is_slim_checkpoint, load_slim_meena
+from model.meena import Meena
+
+def load_model(config_path, checkpoint_path, vocab_size, device):
+    config = ModelConfig(config_path).get_config()
+    if checkpoint_path is not None and is_slim_checkpoint(checkpoint_path):
+        return load_slim_meena(config, checkpoint_path, vocab_size=vocab_size, device=device)
+
+    model = Meena.from_config(config, vocab_size=vocab_size)
+    if checkpoint_path is not None:
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        del checkpoint
+    model.to(device)
+    model.eval()
+    return model
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/meena-config.json')
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--draft-config', default='../config/meena-config-small.json')
+    parser.add_argument('--draft-checkpoint', default=None)
+    parser.add_argument('--vocab', default='../data/vocab-10K.txt')
+    parser.add_argument('--num-draft-tokens', type=int, default=4)
+    parser.add_argument('--max-len', type=int, default=128)
+    parser.add_argument('--min-len', type=int, default=15)
+    parser.add_argument('--temperature', type=float, default=0.88)
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    tokenizer = BertTokenizer(args.vocab, do_lower_case=False)
+    model = load_model(args.config, args.checkpoint, tokenizer.vocab_size, device)
+    draft_model = load_model(args.draft_config, args.draft_checkpoint, tokenizer.vocab_size, device)
+
+    queries = ['오늘은 날이 좋아서 밖에 나가고 싶다', '요즘 무슨 영화 재밌어?', '배고픈데 뭐 먹을까']
+    decoder_input_ids = torch.tensor(tokenizer.encode('[CLS] B: ', add_special_tokens=False), device=device)
+    sampler = partial(top_p, threshold=args.threshold, temperature=args.temperature)
+    rules = dict(max_len=args.max_len, min_len=args.min_len, sep_token_id=tokenizer.sep_token_id,
+                 unk_token_id=tokenizer.unk_token_id, pad_token_id=tokenizer.pad_token_id)
+
+    stats = SpeculativeStats()
+    baseline_time = speculative_time = 0.0
+    for _ in range(args.repeat):
+        for query in queries:
+            encoder_input_ids = torch.tensor([tokenizer.encode(f'[CLS] A : {query} [SEP] ', add_special_tokens=False)],
+                                             device=device)
+            encoder_input_mask = (encoder_input_ids != tokenizer.pad_token_id).unsqueeze(1)
+
+            start = time.perf_counter()
+            generate(model, encoder_input_ids, encoder_input_mask, decoder_input_ids, sampler=sampler, **rules)
+            baseline_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            speculative_generate(model, draft_model, encoder_input_ids, encoder_input_mask, decoder_input_ids,
+                                 num_draft_tokens=args.num_draft_tokens, temperature=args.temperature,
+                                 threshold=args.threshold, stats=stats, **rules)
+            speculative_time += time.perf_counter() - start
+
+    replies = args.repeat * len(queries)
+    print(f'latency per reply | top-p: {baseline_time / replies * 1000:.1f}ms | '
+          f'speculative: {speculative_time / replies * 1000:.1f}ms | '
+          f'speedup: {baseline_time / speculative_time:.2f}x')
+    print(f'acceptance rate: {stats.acceptance_rate:.3f} | tokens per target pass: {stats.tokens_per_target_pass:.2f} | '
+          f'{stats.as_dict()}')
+
+if __name__ == '__main__':
+    main()
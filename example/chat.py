@@ -4,67 +4,13 @@ warnings.filterwarnings("ignore")
 import torch
 from common.arg import ModelConfig
 from model.meena import Meena
+from model.checkpoint import is_slim_checkpoint, load_slim_meena
 from transformers import BertTokenizer
 from common.generate import top_p, top_k,sample_and_rank
-import time
-
-
-def get_encoder_input(tokenizer:BertTokenizer, input_str:list, config: ModelConfig):
-    encoder_input = torch.tensor(tokenizer.encode(input_str,
-                                                    add_special_tokens=False,
-                                                    pad_to_max_length=True,
-                                                    max_length=config.max_seq_len,
-                                                    return_tensors='pt',
-                                                    truncation=True))
-    encoder_input_mask = encoder_input !=0
-    return encoder_input, encoder_input_mask
-
-def get_decoder_input(tokenizer:BertTokenizer, input_str:list, config: ModelConfig):
-    decoder_input = torch.tensor(tokenizer.encode(input_str,
-                                                    add_special_tokens=False,
-                                                    max_length=config.max_seq_len,
-                                                    return_tensors='pt',
-                                                    truncation=True))
-    return decoder_input
-
-def get_next_token(logit, func, **args):
-    next_token_ebedd = logit.squeeze()[-1]
-    sampled_word = func(next_token_ebedd, **args)
-
-    return sampled_word
-
-def remove_pad_token(tokenizer:BertTokenizer, input_ids: torch.Tensor):
-    pad_token_mask  = input_ids != tokenizer.pad_token_id
-    removed_pad_input_ids = input_ids[pad_token_mask]
-    return removed_pad_input_ids.tolist()
-
-def make_new_source_input(tokenizer:BertTokenizer, target_input_ids: torch.Tensor, source_input_ids:torch.Tensor):
-    list_target_input_ids = target_input_ids.tolist()[0]
-    list_target_input_ids.append(tokenizer.sep_token_id)
-
-    source_input_ids = remove_pad_token(tokenizer, source_input_ids[0])
-    source_input_ids = source_input_ids + list_target_input_ids[1:]
-    if source_input_ids[-127:][0] == tokenizer.cls_token_id:
-        source_input_ids = source_input_ids[-127:]
-    else:
-        source_input_ids = [tokenizer.cls_token_id] + source_input_ids[-127:]
-
-    source_input_str = tokenizer.decode(source_input_ids, clean_up_tokenization_spaces=True)
-
-    return torch.tensor(source_input_ids), source_input_str
-
-def print_output(out_ids, tokenizer:BertTokenizer):
-    out_str = tokenizer.decode(out_ids)
-    turn = 'B :'
-    out_str = f'Meena: {out_str[4:]}'
-    out_list = out_str.split(turn)
+from common.batch_generate import pad_encoder_inputs, stream_generate
+from common.dialogue import DialogueHistory
+from common.streamer import IncrementalDetokenizer
 
-    if len(out_list)==1:
-        print(out_str)
-    elif len(out_list)>1:
-        for item in out_list:
-            print(item)
-            time.sleep(1.1)
 
 def main():
 
@@ -76,89 +22,78 @@ def main():
 
     tokenizer = BertTokenizer(config.vocab_path, do_lower_case=False)
 
-    model = Meena(vocab_size=tokenizer.vocab_size,
-                  dim=config.dim,
-                  encoder_depth=config.encoder_depth,
-                  decoder_depth=config.decoder_depth,
-                  max_seq_len=config.max_seq_len,
-                  head_num=config.n_head,
-                  dropout=config.dropout_prob)
+    if is_slim_checkpoint(checkpoint_path):
+        model = load_slim_meena(config, checkpoint_path, vocab_size=tokenizer.vocab_size, device=device)
+    else:
+        model = Meena.from_config(config, vocab_size=tokenizer.vocab_size)
 
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    model.load_state_dict(checkpoint['model_state_dict'])
-    del checkpoint
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        del checkpoint
+        model.to(device)
 
     model.eval()
 
-    # Meta data for conversation
-    meta_data = '[CLS] '
+    # 대화 기록은 token id 로 보관하고 인코더 입력도 id 로 바로 만든다.
+    history = DialogueHistory(cls_token_id=tokenizer.cls_token_id,
+                              sep_token_id=tokenizer.sep_token_id,
+                              max_len=config.max_seq_len)
 
     # Start of chat with Meena
-    target_str = '[CLS] B: '
+    target_input_ids = torch.tensor(tokenizer.encode('[CLS] B: ', add_special_tokens=False), device=device)
+    prefix_len = target_input_ids.size(0)
+    turn_ids = tokenizer.encode('B :', add_special_tokens=False)
+    detokenizer = IncrementalDetokenizer(tokenizer)
     print('Meena에게 말을 건네세요: ')
 
-    count = 0
     min_len = 15
 
     while True:
         user_query = input('A : ')
-        user_query = f'A : {user_query}'
-
-        if count == 0:
-            source_str = meta_data + user_query + ' [SEP] '
-        else:
-            user_query_ids = tokenizer.encode(user_query, add_special_tokens=False, max_length=config.max_seq_len,
-                                              truncation=True)
-            user_query_ids.append(tokenizer.sep_token_id)
-            user_query_ids = torch.tensor(user_query_ids)
-            _, source_str = make_new_source_input(tokenizer, user_query_ids.unsqueeze(0), source_input_ids)
-        source_input_ids, source_input_mask = get_encoder_input(tokenizer=tokenizer, input_str=source_str,
-                                                                config=config)
-        target_input_ids = get_decoder_input(tokenizer=tokenizer, input_str=target_str, config=config)
-
-        # Sentence completed normally
-        is_complete = False
-
-        for _ in range(config.max_seq_len):
-            logit, _ = model(source_input_ids, target_input_ids, source_input_mask)
-            sampled_word = get_next_token(logit, top_p)
-            # sampled_word = get_next_token(logit, sample_and_rank, N=20, temperature=0.88, is_uniform_sample=False)
-
-            if sampled_word == tokenizer.sep_token_id:
-                if len(target_input_ids[0]) > min_len:
-                    # print(f'{tokenizer.decode(target_input_ids[0], skip_special_tokens=True)}')
-                    print_output(target_input_ids[0],tokenizer)
-                    source_input_ids, source_str = make_new_source_input(tokenizer, target_input_ids, source_input_ids)
-                    target_str = '[CLS] B: '
-                    is_complete = True
-                    break
-                else:
-                    addtional_target_str = ' [UNK] B: '
-                    addtional_target_ids = tokenizer.encode(addtional_target_str, add_special_tokens=False)
-
-                    target_input_ids = target_input_ids.tolist()
-                    target_input_ids[0].append(addtional_target_ids[0])
-                    target_input_ids = torch.tensor(target_input_ids)
-
+        history.add_turn(tokenizer.encode(f'A : {user_query}', add_special_tokens=False,
+                                          max_length=config.max_seq_len, truncation=True))
+        source_input_ids, source_input_mask = pad_encoder_inputs([history.encoder_input_ids()],
+                                                                 tokenizer.pad_token_id, device)
+
+        # 응답 토큰은 미리 할당한 버퍼에 in-place 로 쓴다.
+        target_buffer = torch.full((1, config.max_seq_len), tokenizer.pad_token_id, dtype=torch.long, device=device)
+        target_buffer[0, :prefix_len] = target_input_ids
+        target_len = prefix_len
+
+        # 응답이 끝나기를 기다리지 않고 샘플링된 토큰을 바로 출력한다.
+        # [UNK] 는 같은 화자의 다음 문장이므로 줄을 바꾸고, 뒤따르는 'B :' 는 출력하지 않는다.
+        print('Meena: ', end='', flush=True)
+        detokenizer.reset()
+        pending_turn_ids = []
+
+        for step_tokens, _ in stream_generate(model, source_input_ids, source_input_mask, target_input_ids,
+                                              sampler=top_p,
+                                              max_len=config.max_seq_len,
+                                              min_len=min_len,
+                                              sep_token_id=tokenizer.sep_token_id,
+                                              unk_token_id=tokenizer.unk_token_id,
+                                              pad_token_id=tokenizer.pad_token_id):
+            token = step_tokens.item()
+            if token == tokenizer.sep_token_id:
+                break
+            target_buffer[0, target_len] = token
+            target_len += 1
+
+            if token == tokenizer.unk_token_id:
+                print(flush=True)
+                detokenizer.reset()
+                pending_turn_ids = list(turn_ids)
+            elif pending_turn_ids and token == pending_turn_ids[0]:
+                pending_turn_ids.pop(0)
             else:
-                target_input_ids = target_input_ids.tolist()
-                target_input_ids[0].append(sampled_word)
-                target_input_ids = torch.tensor(target_input_ids)
-
-        if is_complete == False:
-            source_input_ids, source_str = make_new_source_input(tokenizer, target_input_ids, source_input_ids)
-            target_str = '[CLS] B: '
+                pending_turn_ids = []
+                print(detokenizer.add(token), end='', flush=True)
+        print()
 
-        count += 1
+        # [CLS] 를 뺀 'B : ...' 응답을 기록에 추가한다.
+        history.add_turn(target_buffer[0, 1:target_len].tolist())
 
 
 
 if __name__=='__main__':
     main()
-
-
-
-
-
-
-
@@ -0,0 +1,51 @@
+"""
+학습 checkpoint(.pth)를 추론용 slim checkpoint(safetensors 형식, mmap 로드)로 변환한다.
+optimizer / losses / loss scaler(apex amp) 상태는 버리고 model_state_dict 만 저장한다.
+
+    python export_checkpoint.py --checkpoint ../checkpoint/komeena-base-finetuning-v3.pth \
+                                --out-dir ../checkpoint/komeena-base-finetuning-v3 --bf16
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import os
+import time
+import argparse
+
+import torch
+
+from common.arg import ModelConfig
+from model.checkpoint import save_slim_checkpoint, load_slim_meena
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--out-dir', required=True)
+    parser.add_argument('--max-shard-size', type=int, default=2 * 1024 ** 3, help='shard 당 최대 byte')
+    parser.add_argument('--bf16', action='store_true', help='floating point weight 를 bf16 으로 저장')
+    parser.add_argument('--config', default=None, help='지정하면 저장 후 load_slim_meena 로 로드 시간을 잰다')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    state_dict = checkpoint['model_state_dict']
+    del checkpoint
+    print(f'torch.load: {time.perf_counter() - start:.2f}s')
+
+    path = save_slim_checkpoint(state_dict, args.out_dir,
+                                max_shard_size=args.max_shard_size,
+                                dtype=torch.bfloat16 if args.bf16 else None)
+    size = sum(os.path.getsize(os.path.join(args.out_dir, f)) for f in os.listdir(args.out_dir))
+    print(f'Saved {path} ({size / 1024 ** 2:.1f} MB)')
+
+    if args.config is not None:
+        config = ModelConfig(args.config).get_config()
+        start = time.perf_counter()
+        load_slim_meena(config, args.out_dir)
+        print(f'load_slim_meena: {time.perf_counter() - start:.2f}s')
+
+if __name__ == '__main__':
+    main()
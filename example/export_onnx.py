@@ -0,0 +1,67 @@
+"""
+Meena 를 encoder.onnx / decoder_step.onnx 로 내보내고 Meena.forward 와 logit 을 비교한다.
+
+    python export_onnx.py --config ../config/meena-config-small.json --out-dir ../onnx
+    python export_onnx.py --config ../config/meena-finetuning-config-v3.json \
+                          --checkpoint ../checkpoint/komeena-base-finetuning-v3.pth --out-dir ../onnx
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import argparse
+
+import numpy as np
+import torch
+
+from common.arg import ModelConfig
+from common.onnx_runner import OnnxMeena
+from model.meena import Meena
+from model.onnx_export import export_meena_onnx
+
+@torch.no_grad()
+def check_parity(model, runner, vocab_size, max_seq_len, batch_size=2, src_len=16, tgt_len=12):
+    # 같은 입력에 대해 Meena.forward 의 position 별 logit 과 ONNX 디코더 스텝 logit 의 최대 오차
+    encoder_input_ids = torch.randint(5, vocab_size, (batch_size, src_len))
+    encoder_input_ids[1, src_len // 2:] = 0  # 길이가 다른 row
+    encoder_input_mask = (encoder_input_ids != 0).unsqueeze(1)
+    decoder_input_ids = torch.randint(5, vocab_size, (batch_size, min(tgt_len, max_seq_len)))
+
+    torch_logits, _ = model(encoder_input_ids, decoder_input_ids, encoder_input_mask)
+
+    state = runner.encode(encoder_input_ids.numpy(), encoder_input_mask.numpy())
+    max_diff = 0.0
+    for t in range(decoder_input_ids.size(1)):
+        onnx_logits, state = runner.decode_step(decoder_input_ids[:, t].numpy(), state)
+        max_diff = max(max_diff, float(np.abs(onnx_logits - torch_logits[:, t].numpy()).max()))
+    return max_diff
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/meena-config-small.json')
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--out-dir', default='../onnx')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--atol', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    config = ModelConfig(args.config).get_config()
+    model = Meena.from_config(config, vocab_size=args.vocab_size)
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location='cpu')
+        model.load_state_dict(checkpoint['model_state_dict'])
+        del checkpoint
+    model.eval()
+
+    encoder_path, decoder_path = export_meena_onnx(model, args.out_dir, args.opset)
+    print(f'Exported {encoder_path}, {decoder_path}')
+
+    max_diff = check_parity(model, OnnxMeena(encoder_path, decoder_path), args.vocab_size, config.max_seq_len)
+    print(f'max |logit diff| vs Meena.forward: {max_diff:.6f} (atol {args.atol})')
+    sys.exit(0 if max_diff <= args.atol else 1)
+
+if __name__ == '__main__':
+    main()
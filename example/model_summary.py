@@ -21,14 +21,7 @@ config = ModelConfig(config_path=config_path).get_config()
 tokenizer = BertTokenizer(vocab_file=config.vocab_path, do_lower_case=False)
 
 # Meena Model
-model = Meena(
-    vocab_size=tokenizer.vocab_size,
-    dim=config.dim,
-    encoder_depth=config.encoder_depth,
-    decoder_depth=config.decoder_depth,
-    max_seq_len=config.max_seq_len,
-    head_num=config.n_head,
-    dropout=config.dropout_prob)
+model = Meena.from_config(config, vocab_size=tokenizer.vocab_size)
 
 # Model Inputs
 encoder_input_ids = torch.randint(0,10000,(1,128))
@@ -0,0 +1,55 @@
+"""
+torch 없이 ONNX Runtime 으로 Meena 와 대화한다. (export_onnx.py 로 만든 그래프 사용)
+
+    python onnx_chat.py --vocab ../data/vocab-10K.txt --onnx-dir ../onnx
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import os
+import argparse
+from functools import partial
+
+import numpy as np
+from transformers import BertTokenizer
+
+from common.onnx_runner import OnnxMeena, generate, top_p
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vocab', default='../data/vocab-10K.txt')
+    parser.add_argument('--onnx-dir', default='../onnx')
+    parser.add_argument('--max-len', type=int, default=128)
+    parser.add_argument('--min-len', type=int, default=15)
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer(args.vocab, do_lower_case=False)
+    model = OnnxMeena(os.path.join(args.onnx_dir, 'encoder.onnx'), os.path.join(args.onnx_dir, 'decoder_step.onnx'))
+    decoder_input_ids = np.array(tokenizer.encode('[CLS] B: ', add_special_tokens=False))
+    sampler = partial(top_p, threshold=0.9, temperature=0.88)
+
+    print('Meena에게 말을 건네세요: ')
+    while True:
+        user_query = input('A : ')
+        source_ids = tokenizer.encode(f'[CLS] A : {user_query} [SEP] ', add_special_tokens=False,
+                                      max_length=args.max_len, truncation=True)
+        encoder_input_ids = np.array([source_ids])
+        encoder_input_mask = (encoder_input_ids != tokenizer.pad_token_id)[:, None, :]
+
+        output_ids, lengths = generate(model, encoder_input_ids, encoder_input_mask, decoder_input_ids,
+                                       sampler=sampler,
+                                       max_len=args.max_len,
+                                       min_len=args.min_len,
+                                       sep_token_id=tokenizer.sep_token_id,
+                                       unk_token_id=tokenizer.unk_token_id,
+                                       pad_token_id=tokenizer.pad_token_id)
+        out_str = tokenizer.decode(output_ids[0, :lengths[0]], skip_special_tokens=True)
+        for line in out_str.split('B :'):
+            if line.strip():
+                print(f'Meena: {line.strip()}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+fp32 Meena 와 int8 양자화 Meena 의 perplexity / 메모리 / 토큰 생성 속도 비교
+
+    python quantization_parity.py --config ../config/meena-finetuning-config-v3.json \
+                                  --checkpoint ../checkpoint/komeena-base-finetuning-v3.pth
+--checkpoint 를 주지 않으면 랜덤 초기화 모델로 비교한다. (perplexity 값 자체는 의미가 없고 상대 오차/속도만 본다)
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import io
+import copy
+import math
+import time
+import argparse
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from transformers import BertTokenizer
+
+from common.arg import ModelConfig
+from common.batch_generate import generate
+from common.dataset import DatasetForSeq2seqConversation
+from model.meena import Meena
+from model.quantization import quantize_meena
+
+def state_dict_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+@torch.no_grad()
+def evaluate_perplexity(model, dataloader):
+    total_loss = 0.0
+    steps = 0
+    for encoder_input_ids, decoder_input_ids, encoder_input_mask, labels in dataloader:
+        _, loss = model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels)
+        total_loss += loss.item()
+        steps += 1
+    return math.exp(total_loss / steps)
+
+@torch.no_grad()
+def tokens_per_second(model, dataloader, max_len):
+    encoder_input_ids, decoder_input_ids, encoder_input_mask, _ = next(iter(dataloader))
+    start = time.perf_counter()
+    _, lengths, _ = generate(model, encoder_input_ids, encoder_input_mask, decoder_input_ids[0, :1], max_len=max_len)
+    return (lengths - 1).sum().item() / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/meena-finetuning-config-v3.json')
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--data-path', default=None)
+    parser.add_argument('--num-samples', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--gen-len', type=int, default=32)
+    parser.add_argument('--tolerance', type=float, default=0.02, help='허용하는 perplexity 상대 오차')
+    args = parser.parse_args()
+
+    config = ModelConfig(args.config).get_config()
+    tokenizer = BertTokenizer(config.vocab_path, do_lower_case=False)
+
+    dataset = DatasetForSeq2seqConversation(tokenizer, config.max_seq_len, args.data_path or config.data_path)
+    dataset = Subset(dataset, range(min(args.num_samples, len(dataset))))
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+
+    model = Meena.from_config(config, vocab_size=tokenizer.vocab_size)
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location='cpu')
+        model.load_state_dict(checkpoint['model_state_dict'])
+        del checkpoint
+    else:
+        print('no --checkpoint: comparing randomly initialized weights')
+    model.eval()
+
+    quantized_model = quantize_meena(copy.deepcopy(model))
+
+    results = {}
+    for name, m in (('fp32', model), ('int8', quantized_model)):
+        results[name] = (evaluate_perplexity(m, dataloader),
+                         state_dict_size(m) / 2 ** 20,
+                         tokens_per_second(m, dataloader, args.gen_len))
+        print(f'{name} | perplexity: {results[name][0]:.4f} | weights: {results[name][1]:.1f}MB | '
+              f'generation: {results[name][2]:.2f} tokens/s')
+
+    diff = abs(results['int8'][0] - results['fp32'][0]) / results['fp32'][0]
+    print(f'perplexity relative diff: {diff:.4f} (tolerance {args.tolerance})')
+    sys.exit(0 if diff <= args.tolerance else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Meena chat server
+여러 사용자의 요청을 하나의 Meena 모델에서 continuous batching 으로 처리한다.
+
+    python server.py --config ../config/meena-config-small.json
+    curl -X POST localhost:8000/chat -d '{"text": "안녕"}'
+    curl -N -X POST localhost:8000/chat/stream -d '{"text": "안녕"}'   # 생성되는 대로 텍스트를 받는다.
+    curl -X POST localhost:8000/chat -d '{"session_id": "u1", "text": "안녕"}'   # 대화 기록을 이어간다.
+    curl -X POST localhost:8000/chat -d '{"session_id": "u1", "regenerate": true}'   # 마지막 응답을 다시 생성
+    curl localhost:8000/sessions/stats
+    curl localhost:8000/cache/stats   # --encoder-cache-size / --response-cache-size 사용 시
+
+--checkpoint 를 주지 않으면 랜덤 초기화된 모델로 실행된다. (CPU 에서 small config 로 동작 확인용)
+"""
+import warnings
+warnings.filterwarnings("ignore")
+
+import sys
+sys.path.append('../')
+
+import argparse
+import asyncio
+import json
+import logging
+from functools import partial
+
+import torch
+from transformers import BertTokenizer
+
+from common.arg import ModelConfig
+from common.generate import greedy, top_p
+from common.prefix_cache import EncoderStateCache, ResponseCache
+from common.scheduler import ContinuousBatchingScheduler, GenerationRequest
+from common.session import SessionStore
+from common.streamer import IncrementalDetokenizer
+from model.checkpoint import is_slim_checkpoint, load_slim_meena
+from model.meena import Meena, compile_meena
+from model.quantization import quantize_meena
+
+def get_encoder_input_ids(tokenizer: BertTokenizer, text: str, max_len: int):
+    source_str = f'[CLS] A : {text} [SEP] '
+    return tokenizer.encode(source_str, add_special_tokens=False, max_length=max_len, truncation=True)
+
+def decode_reply(tokenizer: BertTokenizer, output_ids: list):
+    out_str = tokenizer.decode(output_ids, skip_special_tokens=True)
+    return [line.strip() for line in out_str.split('B :') if line.strip()]
+
+async def read_request(reader: asyncio.StreamReader):
+    request_line = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+def write_response(writer: asyncio.StreamWriter, status: str, payload: dict):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(f'HTTP/1.1 {status}\r\n'
+                 f'Content-Type: application/json; charset=utf-8\r\n'
+                 f'Content-Length: {len(body)}\r\n'
+                 f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+
+def write_chunk(writer: asyncio.StreamWriter, text: str):
+    data = text.encode('utf-8')
+    writer.write(f'{len(data):X}\r\n'.encode('latin-1') + data + b'\r\n')
+
+async def stream_reply(writer, scheduler, tokenizer, request):
+    # 스케줄러 thread 에서 샘플링된 토큰을 event loop 의 queue 로 넘겨 받아 바로 chunk 로 보낸다.
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    if request.future.done():
+        # 응답 캐시 hit: 저장된 토큰을 그대로 보낸다.
+        for token in request.output_ids[len(request.decoder_input_ids):]:
+            tokens.put_nowait(token)
+        tokens.put_nowait(None)
+    else:
+        request.on_token = lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token)
+        future = scheduler.submit(request)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(tokens.put_nowait, None))
+
+    writer.write(b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/plain; charset=utf-8\r\n'
+                 b'Transfer-Encoding: chunked\r\n'
+                 b'Connection: close\r\n\r\n')
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    while True:
+        token = await tokens.get()
+        if token is None:
+            break
+        if token == tokenizer.unk_token_id:
+            # 같은 화자의 다음 문장
+            detokenizer.reset()
+            text = '\n'
+        else:
+            text = detokenizer.add(token)
+        if text:
+            write_chunk(writer, text)
+            await writer.drain()
+    writer.write(b'0\r\n\r\n')
+
+def session_encoder_input_ids(sessions: SessionStore, session, tokenizer: BertTokenizer, payload: dict, max_len: int):
+    # 세션의 대화 기록에 사용자 발화를 추가하고 인코더 입력을 만든다.
+    # regenerate 이면 마지막 응답을 지우고 같은 문맥으로 다시 생성한다.
+    if payload.get('regenerate'):
+        if len(session.history) == 0:
+            raise ValueError('nothing to regenerate')
+        sessions.pop_turn(session)
+    else:
+        sessions.add_turn(session, tokenizer.encode(f'A : {payload["text"]}', add_special_tokens=False,
+                                                    max_length=max_len, truncation=True))
+    return session.history.encoder_input_ids()
+
+def finish_session_turn(sessions: SessionStore, session, request, encoder_input_ids, sep_token_id):
+    if request.return_cache and request.cache is not None:
+        sessions.store_encoder_state(session, encoder_input_ids, request.cache)
+    # '[CLS]' 와 종료 [SEP] 를 뺀 'B : ...' 응답을 기록에 추가한다.
+    reply_ids = request.output_ids[1:]
+    if reply_ids and reply_ids[-1] == sep_token_id:
+        reply_ids = reply_ids[:-1]
+    sessions.add_turn(session, reply_ids)
+
+async def handle_chat(reader, writer, scheduler, sessions, response_cache, tokenizer, config, args):
+    try:
+        method, path, body = await read_request(reader)
+        if method == 'GET' and path == '/sessions/stats':
+            write_response(writer, '200 OK', sessions.stats())
+            return
+        if method == 'GET' and path == '/cache/stats':
+            write_response(writer, '200 OK', {
+                'encoder': scheduler.encoder_cache.stats() if scheduler.encoder_cache is not None else None,
+                'response': response_cache.stats() if response_cache is not None else None})
+            return
+        if method != 'POST' or path not in ('/chat', '/chat/stream'):
+            write_response(writer, '404 Not Found',
+                           {'error': 'POST /chat, /chat/stream or GET /sessions/stats, /cache/stats only'})
+            return
+
+        payload = json.loads(body)
+        session, cache = None, None
+        if 'session_id' in payload:
+            session = sessions.get(str(payload['session_id']))
+            encoder_input_ids = session_encoder_input_ids(sessions, session, tokenizer, payload, config.max_seq_len)
+            if args.session_encoder_cache:
+                cache = sessions.lookup_encoder_state(session, encoder_input_ids)
+        else:
+            encoder_input_ids = get_encoder_input_ids(tokenizer, payload['text'], config.max_seq_len)
+
+        request = GenerationRequest(encoder_input_ids=encoder_input_ids,
+                                    decoder_input_ids=tokenizer.encode('[CLS] B: ', add_special_tokens=False),
+                                    max_len=min(payload.get('max_len', config.max_seq_len), config.max_seq_len),
+                                    min_len=payload.get('min_len', args.min_len),
+                                    cache=cache,
+                                    return_cache=session is not None and args.session_encoder_cache and cache is None)
+
+        # 결정적 디코딩(--greedy)에서는 같은 입력의 응답을 캐시에서 바로 돌려준다.
+        cached = None
+        if response_cache is not None:
+            cached = response_cache.lookup(encoder_input_ids, request.decoder_input_ids,
+                                           max_len=request.max_len, min_len=request.min_len)
+            if cached is not None:
+                request.output_ids = cached
+                request.future.set_result(cached)
+
+        if path == '/chat/stream':
+            await stream_reply(writer, scheduler, tokenizer, request)
+        else:
+            future = request.future if cached is not None else scheduler.submit(request)
+            output_ids = await asyncio.wrap_future(future)
+            write_response(writer, '200 OK', {'reply': decode_reply(tokenizer, output_ids)})
+
+        if request.future.done() and request.future.exception() is None:
+            if response_cache is not None and cached is None:
+                response_cache.store(encoder_input_ids, request.decoder_input_ids, request.output_ids,
+                                     max_len=request.max_len, min_len=request.min_len)
+            if session is not None:
+                finish_session_turn(sessions, session, request, encoder_input_ids, tokenizer.sep_token_id)
+    except (ValueError, KeyError) as e:
+        write_response(writer, '400 Bad Request', {'error': str(e)})
+    except Exception as e:
+        logging.exception('Request failed')
+        write_response(writer, '500 Internal Server Error', {'error': str(e)})
+    finally:
+        await writer.drain()
+        writer.close()
+
+def load_model(config, checkpoint_path, vocab_size, device):
+    if checkpoint_path is not None and is_slim_checkpoint(checkpoint_path):
+        return load_slim_meena(config, checkpoint_path, vocab_size=vocab_size, device=device)
+
+    model = Meena.from_config(config, vocab_size=vocab_size)
+
+    if checkpoint_path is not None:
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        del checkpoint
+
+    model.to(device)
+    model.eval()
+    return model
+
+async def serve(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    config = ModelConfig(args.config).get_config()
+    tokenizer = BertTokenizer(config.vocab_path, do_lower_case=False)
+    if args.quantize:
+        device = 'cpu'  # dynamic int8 양자화는 CPU 전용
+    model = load_model(config, args.checkpoint, tokenizer.vocab_size, device)
+    if args.quantize:
+        model = quantize_meena(model, inplace=True)
+    if args.compile or config.compile:
+        compile_meena(model)
+
+    encoder_cache = None
+    if args.encoder_cache_size:
+        encoder_cache = EncoderStateCache(max_entries=args.encoder_cache_size,
+                                          max_bytes=args.encoder_cache_mb * 1024 ** 2 if args.encoder_cache_mb else None,
+                                          ttl=args.cache_ttl)
+    response_cache = None
+    if args.response_cache_size:
+        if not args.greedy:
+            raise ValueError('--response-cache-size 는 결정적 디코딩(--greedy)에서만 사용할 수 있다.')
+        response_cache = ResponseCache(max_entries=args.response_cache_size, ttl=args.cache_ttl)
+
+    scheduler = ContinuousBatchingScheduler(model,
+                                            sampler=greedy if args.greedy else partial(top_p, threshold=0.9, temperature=0.88),
+                                            max_batch_size=args.max_batch_size,
+                                            max_queue_wait=args.max_queue_wait,
+                                            sep_token_id=tokenizer.sep_token_id,
+                                            unk_token_id=tokenizer.unk_token_id,
+                                            pad_token_id=tokenizer.pad_token_id,
+                                            encoder_cache=encoder_cache)
+    scheduler.start()
+
+    sessions = SessionStore(max_sessions=args.max_sessions,
+                            memory_budget=args.session_memory_mb * 1024 ** 2 if args.session_memory_mb else None,
+                            cls_token_id=tokenizer.cls_token_id,
+                            sep_token_id=tokenizer.sep_token_id,
+                            max_len=config.max_seq_len)
+
+    server = await asyncio.start_server(partial(handle_chat, scheduler=scheduler, sessions=sessions,
+                                                response_cache=response_cache, tokenizer=tokenizer,
+                                                config=config, args=args),
+                                        args.host, args.port)
+    print(f'Meena server listening on http://{args.host}:{args.port}/chat')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        scheduler.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='../config/meena-config-small.json')
+    parser.add_argument('--checkpoint', default=None, help='학습 checkpoint(.pth) 또는 export_checkpoint.py 로 만든 slim checkpoint')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=16)
+    parser.add_argument('--max-queue-wait', type=float, default=0.01)
+    parser.add_argument('--min-len', type=int, default=15)
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 양자화 모델로 CPU 추론')
+    parser.add_argument('--compile', action='store_true', help='Encoder/Decoder 블록을 torch.compile')
+    parser.add_argument('--max-sessions', type=int, default=10000, help='보관할 최대 대화 세션 수 (LRU)')
+    parser.add_argument('--session-memory-mb', type=float, default=None, help='세션 저장소 메모리 한도 (MB)')
+    parser.add_argument('--session-encoder-cache', action='store_true',
+                        help='세션별 인코더 출력/cross-attention key/value 를 보관해 같은 문맥에서 재사용')
+    parser.add_argument('--encoder-cache-size', type=int, default=0,
+                        help='인코더 입력이 같은 요청의 인코더 출력을 재사용하는 캐시 항목 수 (0: 사용 안 함)')
+    parser.add_argument('--encoder-cache-mb', type=float, default=None, help='인코더 캐시 메모리 한도 (MB)')
+    parser.add_argument('--response-cache-size', type=int, default=0,
+                        help='같은 입력의 응답을 재사용하는 캐시 항목 수 (--greedy 필요, 0: 사용 안 함)')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='인코더/응답 캐시 항목 유효 시간 (초)')
+    parser.add_argument('--greedy', action='store_true', help='top-p 대신 greedy 디코딩 (결정적)')
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import torch
+
+
+def _pad_to(tensor, dim, length, left=False, value=0):
+  pad_len = length - tensor.size(dim)
+  if pad_len == 0:
+    return tensor
+  shape = list(tensor.shape)
+  shape[dim] = pad_len
+  pad = tensor.new_full(shape, value)
+  return torch.cat([pad, tensor] if left else [tensor, pad], dim=dim)
+
+
+class DecoderCache(object):
+  """
+  Incremental decoding 을 위한 디코더 캐시
+  layers[i] 는 i번째 Decoder 레이어의 self-attention key/value ('self_key', 'self_value') 와
+  encoder-decoder attention key/value ('cross_key', 'cross_value') 를 보관한다.
+  seq_len 은 지금까지 캐시된 디코더 토큰 수 (다음 토큰의 position)
+
+  길이가 다른 row 들을 하나로 합친 경우(concat) self-attention key 는 왼쪽이 pad 로 채워지고,
+  self_mask [batch, seq_len] 가 유효한 key 위치를, positions [batch] 가 row 별 다음 토큰의 position 을 나타낸다.
+  """
+  def __init__(self, num_layers):
+    self.layers = [{} for _ in range(num_layers)]
+    self.seq_len = 0
+    self.self_mask = None
+    self.positions = None
+
+    # Meena.encode() 에서 채워진다.
+    self.encoder_hidden_states = None
+    self.encoder_mask = None
+
+  def __len__(self):
+    return self.seq_len
+
+  @property
+  def batch_size(self):
+    return self.encoder_hidden_states.size(0)
+
+  def nbytes(self):
+    # 캐시가 차지하는 메모리 (인코더 출력, 마스크, 레이어별 key/value)
+    tensors = [self.encoder_hidden_states, self.encoder_mask, self.self_mask]
+    tensors += [tensor for layer_cache in self.layers for tensor in layer_cache.values()]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors if tensor is not None)
+
+  def encoder_row(self, index, length):
+    # index 번째 row 의 인코더 결과(cross-attention key/value 포함)만 pad 를 뺀 길이 length 로 잘라 batch 1 cache 로 만든다.
+    cache = DecoderCache(len(self.layers))
+    cache.encoder_hidden_states = self.encoder_hidden_states[index:index + 1, :length].clone()
+    cache.encoder_mask = self.encoder_mask[index:index + 1, ..., :length].clone()
+    for layer_cache, source in zip(cache.layers, self.layers):
+      for name in ('cross_key', 'cross_value'):
+        if name in source:
+          layer_cache[name] = source[name][index:index + 1, :, :length].clone()
+    return cache
+
+  def copy(self):
+    # 텐서는 공유하고 레이어 dict 만 새로 만든다. (index_select / decode_step 이 원본 cache 를 바꾸지 않도록)
+    cache = DecoderCache(0)
+    cache.__dict__.update(self.__dict__)
+    cache.layers = [dict(layer_cache) for layer_cache in self.layers]
+    return cache
+
+  def index_select(self, index):
+    # 배치 row 를 index 순서로 선택한다. (종료된 row 제거, beam 재정렬 등)
+    for layer_cache in self.layers:
+      for name, tensor in layer_cache.items():
+        layer_cache[name] = tensor.index_select(0, index)
+
+    if self.encoder_hidden_states is not None:
+      self.encoder_hidden_states = self.encoder_hidden_states.index_select(0, index)
+    if self.encoder_mask is not None:
+      self.encoder_mask = self.encoder_mask.index_select(0, index)
+    if self.positions is not None:
+      self.positions = self.positions.index_select(0, index)
+    if self.self_mask is not None:
+      self.self_mask = self.self_mask.index_select(0, index)
+      self._trim_self_padding()
+
+    return self
+
+  def crop(self, seq_len):
+    # 캐시를 앞쪽 seq_len 개 토큰까지로 되돌린다. (speculative decoding 에서 거절된 토큰 제거)
+    drop = self.seq_len - seq_len
+    if drop <= 0:
+      return self
+    for layer_cache in self.layers:
+      if 'self_key' in layer_cache:
+        layer_cache['self_key'] = layer_cache['self_key'][:, :, :seq_len]
+        layer_cache['self_value'] = layer_cache['self_value'][:, :, :seq_len]
+    if self.self_mask is not None:
+      self.self_mask = self.self_mask[:, :seq_len]
+    if self.positions is not None:
+      self.positions = self.positions - drop
+    self.seq_len = seq_len
+    return self
+
+  def _trim_self_padding(self):
+    # 남은 row 모두에서 pad 인 앞쪽 key 위치는 잘라낸다.
+    first_valid = int(self.self_mask.any(0).int().argmax())
+    if first_valid == 0:
+      return
+    for layer_cache in self.layers:
+      layer_cache['self_key'] = layer_cache['self_key'][:, :, first_valid:]
+      layer_cache['self_value'] = layer_cache['self_value'][:, :, first_valid:]
+    self.self_mask = self.self_mask[:, first_valid:]
+    self.seq_len -= first_valid
+
+  @staticmethod
+  def concat(caches):
+    """
+    여러 cache 의 row 들을 하나의 cache 로 합친다. (continuous batching)
+    인코더 쪽 key/value 는 오른쪽을, 디코더 self-attention key/value 는 왼쪽을 pad 로 채워 길이를 맞춘다.
+    """
+    merged = DecoderCache(len(caches[0].layers))
+    merged.seq_len = max(cache.seq_len for cache in caches)
+    encoder_len = max(cache.encoder_hidden_states.size(1) for cache in caches)
+
+    positions, self_masks = [], []
+    for cache in caches:
+      batch_size, device = cache.batch_size, cache.encoder_hidden_states.device
+      positions.append(cache.positions if cache.positions is not None
+                       else torch.full((batch_size,), cache.seq_len, dtype=torch.long, device=device))
+      self_mask = cache.self_mask if cache.self_mask is not None \
+        else torch.ones(batch_size, cache.seq_len, dtype=torch.bool, device=device)
+      self_masks.append(_pad_to(self_mask, 1, merged.seq_len, left=True, value=False))
+    merged.positions = torch.cat(positions)
+    merged.self_mask = torch.cat(self_masks)
+
+    merged.encoder_hidden_states = torch.cat([_pad_to(cache.encoder_hidden_states, 1, encoder_len)
+                                              for cache in caches])
+    merged.encoder_mask = torch.cat([_pad_to(cache.encoder_mask, -1, encoder_len, value=False)
+                                     for cache in caches])
+
+    for i, layer_cache in enumerate(merged.layers):
+      for name in caches[0].layers[i]:
+        if name.startswith('self'):
+          tensors = [_pad_to(cache.layers[i][name], 2, merged.seq_len, left=True) for cache in caches]
+        else:
+          tensors = [_pad_to(cache.layers[i][name], 2, encoder_len) for cache in caches]
+        layer_cache[name] = torch.cat(tensors)
+
+    return merged
@@ -0,0 +1,179 @@
+"""
+추론용 slim checkpoint
+학습 checkpoint(.pth)에서 model_state_dict 만 꺼내 safetensors 형식으로 저장한다.
+  [8 byte little-endian header 길이][JSON header][raw tensor bytes]
+파일을 mmap 으로 열고 torch.frombuffer 로 tensor 를 만들기 때문에 load 시 unpickle/복사가 없다.
+"""
+import os
+import json
+import mmap
+import struct
+
+import torch
+
+from model.meena import Meena
+
+SINGLE_FILE_NAME = 'model.safetensors'
+INDEX_FILE_NAME = 'model.safetensors.index.json'
+
+_DTYPE_TO_STR = {
+  torch.float32: 'F32',
+  torch.float16: 'F16',
+  torch.bfloat16: 'BF16',
+  torch.int64: 'I64',
+  torch.int32: 'I32',
+  torch.int8: 'I8',
+  torch.uint8: 'U8',
+  torch.bool: 'BOOL',
+}
+_STR_TO_DTYPE = {value: key for key, value in _DTYPE_TO_STR.items()}
+
+
+def _tensor_bytes(tensor):
+  tensor = tensor.detach().cpu().contiguous().reshape(-1)
+  return tensor.view(torch.uint8).numpy().tobytes()
+
+def _unique_tensors(state_dict):
+  # token_emb 처럼 여러 모듈이 공유하는 tensor 는 한 번만 저장하고 나머지 이름은 alias 로 기록한다.
+  tensors, aliases, seen = {}, {}, {}
+  for name, tensor in state_dict.items():
+    key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+    if key in seen:
+      aliases[name] = seen[key]
+    else:
+      seen[key] = name
+      tensors[name] = tensor
+  return tensors, aliases
+
+def _write_shard(path, tensors, metadata):
+  header = {'__metadata__': metadata}
+  # dtype 크기가 큰 tensor 부터 저장해 mmap 위의 모든 tensor 가 element 크기에 정렬되도록 한다.
+  names = sorted(tensors, key=lambda name: -tensors[name].element_size())
+  offset = 0
+  for name in names:
+    tensor = tensors[name]
+    size = tensor.numel() * tensor.element_size()
+    header[name] = {'dtype': _DTYPE_TO_STR[tensor.dtype],
+                    'shape': list(tensor.shape),
+                    'data_offsets': [offset, offset + size]}
+    offset += size
+
+  header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+  header_bytes += b' ' * (-len(header_bytes) % 8)  # 데이터 시작 위치 8 byte 정렬
+
+  with open(path, 'wb') as f:
+    f.write(struct.pack('<Q', len(header_bytes)))
+    f.write(header_bytes)
+    for name in names:
+      f.write(_tensor_bytes(tensors[name]))
+
+def save_slim_checkpoint(state_dict, save_dir, max_shard_size=2 * 1024 ** 3, dtype=None):
+  """
+  state_dict 를 max_shard_size(byte) 단위 shard 로 나눠 save_dir 에 저장한다.
+  dtype=torch.bfloat16 이면 floating point tensor 를 bf16 으로 바꿔 저장한다. (파일 크기 절반)
+  shard 가 하나면 model.safetensors, 여러 개면 model-0000i-of-0000n.safetensors 와 index json 을 쓴다.
+  """
+  os.makedirs(save_dir, exist_ok=True)
+  tensors, aliases = _unique_tensors(state_dict)
+  if dtype is not None:
+    tensors = {name: tensor.to(dtype) if tensor.is_floating_point() else tensor
+               for name, tensor in tensors.items()}
+
+  shards, shard, shard_size = [], {}, 0
+  for name, tensor in tensors.items():
+    size = tensor.numel() * tensor.element_size()
+    if shard and shard_size + size > max_shard_size:
+      shards.append(shard)
+      shard, shard_size = {}, 0
+    shard[name] = tensor
+    shard_size += size
+  shards.append(shard)
+
+  metadata = {'format': 'pt', 'aliases': json.dumps(aliases)}
+  if len(shards) == 1:
+    path = os.path.join(save_dir, SINGLE_FILE_NAME)
+    _write_shard(path, shards[0], metadata)
+    return path
+
+  weight_map = {}
+  for i, shard in enumerate(shards):
+    file_name = f'model-{i + 1:05d}-of-{len(shards):05d}.safetensors'
+    _write_shard(os.path.join(save_dir, file_name), shard, metadata)
+    weight_map.update({name: file_name for name in shard})
+
+  path = os.path.join(save_dir, INDEX_FILE_NAME)
+  with open(path, 'w') as f:
+    json.dump({'metadata': {'total_size': sum(t.numel() * t.element_size() for t in tensors.values()),
+                            'aliases': aliases},
+               'weight_map': weight_map}, f, indent=2)
+  return path
+
+def is_slim_checkpoint(path):
+  return os.path.isdir(path) or path.endswith('.safetensors') or path.endswith(INDEX_FILE_NAME)
+
+def _load_shard(path):
+  with open(path, 'rb') as f:
+    header_size = struct.unpack('<Q', f.read(8))[0]
+    header = json.loads(f.read(header_size))
+    # ACCESS_COPY: 페이지는 접근할 때 읽히고, 쓰기가 생겨도 파일에는 반영되지 않는다.
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+  metadata = header.pop('__metadata__', {})
+  data_start = 8 + header_size
+  tensors = {}
+  for name, info in header.items():
+    dtype = _STR_TO_DTYPE[info['dtype']]
+    begin, end = info['data_offsets']
+    numel = (end - begin) // torch.empty((), dtype=dtype).element_size()
+    tensor = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + begin) if numel > 0 \
+             else torch.empty(0, dtype=dtype)
+    tensors[name] = tensor.view(info['shape'])
+  return tensors, json.loads(metadata.get('aliases', '{}'))
+
+def load_slim_state_dict(path):
+  """
+  save_slim_checkpoint 로 저장한 파일(또는 디렉터리/index json)을 mmap 기반 state_dict 로 읽는다.
+  반환된 tensor 는 파일 페이지를 그대로 가리키므로 복사가 일어나지 않는다.
+  """
+  if os.path.isdir(path):
+    index_path = os.path.join(path, INDEX_FILE_NAME)
+    path = index_path if os.path.exists(index_path) else os.path.join(path, SINGLE_FILE_NAME)
+
+  if not path.endswith(INDEX_FILE_NAME):
+    state_dict, aliases = _load_shard(path)
+  else:
+    with open(path) as f:
+      index = json.load(f)
+    state_dict, aliases = {}, index['metadata'].get('aliases', {})
+    for file_name in sorted(set(index['weight_map'].values())):
+      tensors, _ = _load_shard(os.path.join(os.path.dirname(path), file_name))
+      state_dict.update(tensors)
+
+  for alias, name in aliases.items():
+    state_dict[alias] = state_dict[name]
+  return state_dict
+
+def load_slim_meena(config, path, vocab_size=None, dtype=None, device='cpu'):
+  """
+  slim checkpoint 로 Meena 를 만든다.
+  meta device 에서 모델을 만들어 랜덤 초기화를 건너뛰고, load_state_dict(assign=True) 로
+  mmap tensor 를 그대로 parameter 로 사용한다. dtype/device 를 바꾸는 경우에만 복사가 일어난다.
+  """
+  state_dict = load_slim_state_dict(path)
+  if vocab_size is None:
+    vocab_size = state_dict['token_emb.weight'].size(0)
+
+  with torch.device('meta'):
+    model = Meena.from_config(config, vocab_size=vocab_size)
+  model.load_state_dict(state_dict, assign=True)
+
+  # state_dict 에 없는 non-persistent buffer(position_ids)는 다시 만든다.
+  for module in model.modules():
+    if getattr(module, 'position_ids', None) is not None and module.position_ids.is_meta:
+      module.position_ids = torch.arange(module.position_ids.size(0))
+
+  if dtype is not None:
+    model.to(dtype)
+  model.to(device)
+  model.eval()
+  return model
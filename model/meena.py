@@ -1,5 +1,8 @@
+import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from model.transformer import PositionalEmbedding, Encoder, Decoder
+from model.cache import DecoderCache
 from torch.nn import CrossEntropyLoss
 
 
@@ -10,12 +13,16 @@ class MeenaEncoder(nn.Module):
                encoder_depth=1,
                max_seq_len=128,
                head_num=32,
-               dropout=0.1):
+               dropout=0.1,
+               fused_qkv=False,
+               attention_backend='reference'):
     super().__init__()
     self.token_emb = token_emb
     self.position_emb = PositionalEmbedding(dim,max_seq_len)
 
-    self.encoders = nn.ModuleList([Encoder(d_model=dim, head_num=head_num, dropout=dropout) for _ in range(encoder_depth)])
+    self.encoders = nn.ModuleList([Encoder(d_model=dim, head_num=head_num, dropout=dropout, fused_qkv=fused_qkv,
+                                           attention_backend=attention_backend) for _ in range(encoder_depth)])
+    self.checkpoint_layers = set()  # activation checkpointing 을 적용할 레이어 index (set_activation_checkpointing)
 
   def forward(self, input_ids, input_mask):
     inputs_embed = self.token_emb(input_ids)
@@ -23,8 +30,11 @@ class MeenaEncoder(nn.Module):
 
     hidden_states = inputs_embed + position_embed
 
-    for encoder in self.encoders:
-      hidden_states = encoder(hidden_states, input_mask)
+    for i, encoder in enumerate(self.encoders):
+      if i in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+        hidden_states = checkpoint(encoder, hidden_states, input_mask, use_reentrant=False)
+      else:
+        hidden_states = encoder(hidden_states, input_mask)
 
     return hidden_states
 
@@ -35,20 +45,43 @@ class MeenaDecoder(nn.Module):
                decoder_depth=13,
                max_seq_len=128,
                head_num=32,
-               dropout=0.1):
+               dropout=0.1,
+               fused_qkv=False,
+               attention_backend='reference'):
     super().__init__()
     self.token_emb = token_emb
     self.position_emb = PositionalEmbedding(dim,max_seq_len)
 
-    self.decoders = nn.ModuleList([Decoder(d_model=dim, head_num=head_num, dropout=dropout) for _ in range(decoder_depth)])
+    self.decoders = nn.ModuleList([Decoder(d_model=dim, head_num=head_num, dropout=dropout, fused_qkv=fused_qkv,
+                                           attention_backend=attention_backend) for _ in range(decoder_depth)])
+    self.checkpoint_layers = set()
+
+  def forward(self, input_ids, encoder_hidden_states, encoder_mask, cache=None):
+    # cache 가 주어지면 input_ids 는 캐시된 토큰 이후의 새 토큰들만 담고 있다.
+    position_offset = 0
+    self_mask = None
+    if cache is not None:
+      position_offset = cache.seq_len if cache.positions is None else cache.positions
+      if cache.self_mask is not None:
+        cache.self_mask = torch.cat([cache.self_mask, cache.self_mask.new_ones(input_ids.shape)], dim=1)
+        self_mask = cache.self_mask.unsqueeze(1)
 
-  def forward(self, input_ids, encoder_hidden_states, encoder_mask):
     inputs_embed = self.token_emb(input_ids)
-    position_embed = self.position_emb(input_ids)
+    position_embed = self.position_emb(input_ids, position_offset)
 
     hidden_states = inputs_embed + position_embed
-    for decoder in self.decoders:
-      hidden_states = decoder(hidden_states, encoder_hidden_states, encoder_mask)
+    for i, decoder in enumerate(self.decoders):
+      layer_cache = None if cache is None else cache.layers[i]
+      if i in self.checkpoint_layers and self.training and torch.is_grad_enabled() and layer_cache is None:
+        hidden_states = checkpoint(decoder, hidden_states, encoder_hidden_states, encoder_mask, None, self_mask,
+                                   use_reentrant=False)
+      else:
+        hidden_states = decoder(hidden_states, encoder_hidden_states, encoder_mask, layer_cache, self_mask)
+
+    if cache is not None:
+      cache.seq_len += input_ids.size(1)
+      if cache.positions is not None:
+        cache.positions = cache.positions + input_ids.size(1)
 
     return hidden_states
 
@@ -60,25 +93,85 @@ class Meena(nn.Module):
                decoder_depth=13,
                max_seq_len=128,
                head_num=32,
-               dropout=0.1):
+               dropout=0.1,
+               fused_qkv=False,
+               attention_backend='reference'):
     super(Meena, self).__init__()
 
     # Embedding
     self.token_emb = nn.Embedding(vocab_size, dim)
 
     # Meena Model
-    self.meena_encoder = MeenaEncoder(self.token_emb,dim,encoder_depth,max_seq_len,head_num,dropout)
-    self.meena_decoder = MeenaDecoder(self.token_emb,dim,decoder_depth,max_seq_len,head_num,dropout)
+    self.meena_encoder = MeenaEncoder(self.token_emb,dim,encoder_depth,max_seq_len,head_num,dropout,fused_qkv,attention_backend)
+    self.meena_decoder = MeenaDecoder(self.token_emb,dim,decoder_depth,max_seq_len,head_num,dropout,fused_qkv,attention_backend)
 
     # LM Head
     self.norm = nn.LayerNorm(dim)
     self.lm_head = nn.Linear(dim, vocab_size, bias=False)
 
-  def forward(self, encoder_input_ids, decoder_input_ids, encoder_input_mask, labels=None):
+  @classmethod
+  def from_config(cls, config, vocab_size):
+    # common.arg.ModelConfig 의 config 로 모델을 만든다.
+    return cls(vocab_size=vocab_size,
+               dim=config.dim,
+               encoder_depth=config.encoder_depth,
+               decoder_depth=config.decoder_depth,
+               max_seq_len=config.max_seq_len,
+               head_num=config.n_head,
+               dropout=config.dropout_prob,
+               fused_qkv=config.fused_qkv,
+               attention_backend=config.attention_backend)
+
+  def init_cache(self):
+    return DecoderCache(len(self.meena_decoder.decoders))
+
+  def encode(self, encoder_input_ids, encoder_input_mask):
+    # 턴마다 인코더를 한 번만 실행하고, 각 디코더 레이어의 cross-attention key/value 를 미리 계산한다.
+    cache = self.init_cache()
+    cache.encoder_hidden_states = self.meena_encoder(encoder_input_ids, encoder_input_mask)
+    cache.encoder_mask = encoder_input_mask
+
+    for decoder, layer_cache in zip(self.meena_decoder.decoders, cache.layers):
+      key, value = decoder.encoder_decoder_attention.project_key_value(cache.encoder_hidden_states,
+                                                                       cache.encoder_hidden_states)
+      layer_cache['cross_key'] = key
+      layer_cache['cross_value'] = value
+
+    return cache
+
+  def lm_logits(self, decoder_logit, logits_index=None):
+    """
+    norm 과 lm_head 를 logits_index 가 가리키는 position 에만 적용한다.
+    None: 모든 position [batch, seq_len, vocab]
+    int (예: -1): 모든 row 의 같은 position [batch, 1, vocab]
+    LongTensor [batch] 또는 [batch, k]: row 별 position [batch, 1 또는 k, vocab]
+    """
+    if logits_index is not None:
+      if isinstance(logits_index, int):
+        decoder_logit = decoder_logit[:, logits_index].unsqueeze(1)
+      else:
+        if logits_index.dim() == 1:
+          logits_index = logits_index.unsqueeze(1)
+        index = logits_index.unsqueeze(-1).expand(-1, -1, decoder_logit.size(-1))
+        decoder_logit = torch.gather(decoder_logit, 1, index)
+
+    return self.lm_head(self.norm(decoder_logit))
+
+  def decode_step(self, decoder_input_ids, cache, logits_index=-1):
+    # decoder_input_ids 는 cache 이후의 새 토큰들 (보통 마지막으로 생성된 토큰 1개)
+    # 다음 토큰 샘플링에는 마지막 position 만 필요하므로 기본값은 마지막 position 의 logit 만 계산한다.
+    decoder_logit = self.meena_decoder(decoder_input_ids, cache.encoder_hidden_states, cache.encoder_mask, cache)
+    lm_logits = self.lm_logits(decoder_logit, logits_index)
+
+    return lm_logits, cache
+
+  def forward(self, encoder_input_ids, decoder_input_ids, encoder_input_mask, labels=None, cache=None, logits_index=None):
     encoder_hidden_state = self.meena_encoder(encoder_input_ids, encoder_input_mask)
-    decoder_logit = self.meena_decoder(decoder_input_ids, encoder_hidden_state, encoder_input_mask)
+    decoder_logit = self.meena_decoder(decoder_input_ids, encoder_hidden_state, encoder_input_mask, cache)
 
-    lm_logits = self.lm_head(self.norm(decoder_logit))
+    if labels is not None:
+      logits_index = None  # loss 는 모든 position 의 logit 이 필요하다.
+    lm_logits = self.lm_logits(decoder_logit, logits_index)
 
     loss = None
     if labels is not None:
@@ -91,3 +184,63 @@ class Meena(nn.Module):
       loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
 
     return lm_logits, loss
+
+
+def compile_meena(model, **kwargs):
+  """
+  Encoder/Decoder 블록을 torch.compile 한다. (학습, 추론 공통)
+  블록 단위로 in-place compile 하므로 state_dict key 가 바뀌지 않고, 캐시 길이가 바뀌어도
+  dynamic shape 으로 한 번만 compile 된다. kwargs 는 torch.compile 인자 (mode, backend 등)
+  """
+  kwargs.setdefault('dynamic', True)
+  for block in [*model.meena_encoder.encoders, *model.meena_decoder.decoders]:
+    block.compile(**kwargs)
+  return model
+
+
+def _layer_activation_elements(batch_size, seq_len, dim, head_num, cross_attention):
+  # 레이어 하나가 backward 를 위해 저장하는 activation 원소 수의 대략적인 추정
+  # (Korthikanti et al. 2022 의 self-attention + MLP 블록 추정식, 디코더는 cross-attention 블록을 더한다)
+  attention = 11 * seq_len * batch_size * dim + 5 * head_num * seq_len * seq_len * batch_size
+  mlp = 19 * seq_len * batch_size * dim
+  elements = attention + mlp
+  if cross_attention:
+    elements += attention
+  return elements // 2  # 위 식은 fp16 byte 단위
+
+def set_activation_checkpointing(model, every=1, memory_budget=None, batch_size=None, seq_len=None,
+                                 bytes_per_element=4):
+  """
+  Encoder/Decoder 블록에 activation(gradient) checkpointing 을 설정한다. (학습 시에만 동작)
+  every=k: k 번째 레이어마다 checkpointing (1 이면 모든 레이어, 0 이면 해제)
+  memory_budget(GB) 가 주어지면 batch_size, seq_len 으로 추정한 activation 메모리가 budget 안에 들어올 때까지
+  절약량이 큰 레이어부터 checkpointing 한다. (every 는 무시)
+  checkpointing 된 레이어는 입력만 저장하고 backward 때 forward 를 다시 계산한다.
+  """
+  encoder, decoder = model.meena_encoder, model.meena_decoder
+  layers = [(encoder, i, False) for i in range(len(encoder.encoders))] + \
+           [(decoder, i, True) for i in range(len(decoder.decoders))]
+  encoder.checkpoint_layers, decoder.checkpoint_layers = set(), set()
+
+  if memory_budget is None:
+    if every:
+      for stack, i, _ in layers:
+        if (i + 1) % every == 0:
+          stack.checkpoint_layers.add(i)
+    return model
+
+  dim = model.token_emb.embedding_dim
+  head_num = decoder.decoders[0].masked_multi_head_attention.head_num
+  budget = memory_budget * 1024 ** 3
+  costs = [(_layer_activation_elements(batch_size, seq_len, dim, head_num, cross) * bytes_per_element, stack, i)
+           for stack, i, cross in layers]
+  stored_input = batch_size * seq_len * dim * bytes_per_element
+
+  # backward 중 다시 계산되는 레이어 하나의 activation 은 항상 필요하다.
+  total = sum(cost for cost, _, _ in costs) + max(cost for cost, _, _ in costs)
+  for cost, stack, i in sorted(costs, key=lambda item: -item[0]):
+    if total <= budget:
+      break
+    stack.checkpoint_layers.add(i)
+    total -= cost - stored_input
+  return model
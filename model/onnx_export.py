@@ -0,0 +1,121 @@
+import os
+import inspect
+
+import torch
+from torch import nn
+
+from model.cache import DecoderCache
+
+# dynamic_axes 는 TorchScript exporter 의 인자이다. dynamo exporter 가 기본값인 최신 torch 에서는
+# onnxscript 가 필요하므로 TorchScript exporter 를 명시적으로 사용한다.
+_EXPORT_KWARGS = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+
+class EncoderGraph(nn.Module):
+  """
+  ONNX 로 내보낼 인코더 그래프
+  입력: encoder_input_ids [batch, src_len], encoder_input_mask [batch, 1, src_len]
+  출력: 각 디코더 레이어의 cross-attention key/value [layer, batch, head, src_len, d_k]
+  """
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, encoder_input_ids, encoder_input_mask):
+    cache = self.model.encode(encoder_input_ids, encoder_input_mask)
+    cross_keys = torch.stack([layer_cache['cross_key'] for layer_cache in cache.layers])
+    cross_values = torch.stack([layer_cache['cross_value'] for layer_cache in cache.layers])
+    return cross_keys, cross_values
+
+
+class DecoderStepGraph(nn.Module):
+  """
+  ONNX 로 내보낼 KV cache 기반 디코더 한 스텝 그래프
+  입력: input_ids [batch, 1], positions [batch], encoder_input_mask [batch, 1, src_len],
+       cross_keys / cross_values [layer, batch, head, src_len, d_k],
+       past_keys / past_values [layer, batch, head, past_len, d_k]
+  출력: logits [batch, vocab], present_keys / present_values [layer, batch, head, past_len + 1, d_k]
+  """
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, input_ids, positions, encoder_input_mask, cross_keys, cross_values, past_keys, past_values):
+    cache = DecoderCache(len(self.model.meena_decoder.decoders))
+    cache.positions = positions
+    cache.encoder_mask = encoder_input_mask
+    for i, layer_cache in enumerate(cache.layers):
+      layer_cache['self_key'] = past_keys[i]
+      layer_cache['self_value'] = past_values[i]
+      layer_cache['cross_key'] = cross_keys[i]
+      layer_cache['cross_value'] = cross_values[i]
+
+    # cross-attention key/value 가 cache 에 있으므로 인코더 출력 자리에는 None 이 아닌 텐서만 넘기면 된다.
+    hidden_states = self.model.meena_decoder(input_ids, cross_keys, encoder_input_mask, cache)
+    logits = self.model.lm_logits(hidden_states, -1)[:, 0]
+
+    present_keys = torch.stack([layer_cache['self_key'] for layer_cache in cache.layers])
+    present_values = torch.stack([layer_cache['self_value'] for layer_cache in cache.layers])
+    return logits, present_keys, present_values
+
+
+@torch.no_grad()
+def export_meena_onnx(model, out_dir, opset_version=17):
+  """
+  Meena 를 encoder.onnx 와 decoder_step.onnx 두 그래프로 내보낸다.
+  batch, src_len, past_len 축은 dynamic 이다.
+  """
+  # export 는 끝난 뒤 wrapper 의 학습 모드를 (하위 모듈인 model 까지) 되돌리므로 wrapper 도 eval 로 만든다.
+  encoder_graph = EncoderGraph(model).eval()
+  decoder_graph = DecoderStepGraph(model).eval()
+  os.makedirs(out_dir, exist_ok=True)
+
+  num_layers = len(model.meena_decoder.decoders)
+  attention = model.meena_decoder.decoders[0].masked_multi_head_attention
+  batch_size, src_len, past_len = 2, 8, 3
+
+  encoder_input_ids = torch.randint(5, model.token_emb.num_embeddings, (batch_size, src_len))
+  encoder_input_mask = torch.ones(batch_size, 1, src_len, dtype=torch.bool)
+  encoder_path = os.path.join(out_dir, 'encoder.onnx')
+  torch.onnx.export(encoder_graph,
+                    (encoder_input_ids, encoder_input_mask),
+                    encoder_path,
+                    input_names=['encoder_input_ids', 'encoder_input_mask'],
+                    output_names=['cross_keys', 'cross_values'],
+                    dynamic_axes={'encoder_input_ids': {0: 'batch', 1: 'src_len'},
+                                  'encoder_input_mask': {0: 'batch', 2: 'src_len'},
+                                  'cross_keys': {1: 'batch', 3: 'src_len'},
+                                  'cross_values': {1: 'batch', 3: 'src_len'}},
+                    opset_version=opset_version,
+                    **_EXPORT_KWARGS)
+
+  cross_keys, cross_values = encoder_graph(encoder_input_ids, encoder_input_mask)
+  past_shape = (num_layers, batch_size, attention.head_num, past_len, attention.d_k)
+  decoder_inputs = (torch.randint(5, model.token_emb.num_embeddings, (batch_size, 1)),
+                    torch.full((batch_size,), past_len, dtype=torch.long),
+                    encoder_input_mask,
+                    cross_keys,
+                    cross_values,
+                    torch.randn(past_shape),
+                    torch.randn(past_shape))
+  decoder_path = os.path.join(out_dir, 'decoder_step.onnx')
+  torch.onnx.export(decoder_graph,
+                    decoder_inputs,
+                    decoder_path,
+                    input_names=['input_ids', 'positions', 'encoder_input_mask', 'cross_keys', 'cross_values',
+                                 'past_keys', 'past_values'],
+                    output_names=['logits', 'present_keys', 'present_values'],
+                    dynamic_axes={'input_ids': {0: 'batch'},
+                                  'positions': {0: 'batch'},
+                                  'encoder_input_mask': {0: 'batch', 2: 'src_len'},
+                                  'cross_keys': {1: 'batch', 3: 'src_len'},
+                                  'cross_values': {1: 'batch', 3: 'src_len'},
+                                  'past_keys': {1: 'batch', 3: 'past_len'},
+                                  'past_values': {1: 'batch', 3: 'past_len'},
+                                  'logits': {0: 'batch'},
+                                  'present_keys': {1: 'batch', 3: 'present_len'},
+                                  'present_values': {1: 'batch', 3: 'present_len'}},
+                    opset_version=opset_version,
+                    **_EXPORT_KWARGS)
+
+  return encoder_path, decoder_path
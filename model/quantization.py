@@ -0,0 +1,29 @@
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+
+from model.meena import Meena
+
+
+def quantize_meena(model: Meena, inplace=False):
+  """
+  CPU 추론용 dynamic int8 양자화
+  MultiHeadAttention, FeedForward, lm_head 의 모든 nn.Linear 를 per-channel int8 weight 로 바꾼다.
+  activation 은 매 호출마다 동적으로 양자화되므로 calibration 데이터가 필요 없다.
+  """
+  if 'fbgemm' in torch.backends.quantized.supported_engines:
+    torch.backends.quantized.engine = 'fbgemm'
+
+  model.eval()
+  return quantize_dynamic(model, {nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=inplace)
+
+
+def load_quantized_meena(config, checkpoint_path, vocab_size):
+  # 학습 checkpoint 의 fp32 model_state_dict 로 Meena 를 만든 뒤 양자화한다.
+  model = Meena.from_config(config, vocab_size=vocab_size)
+
+  checkpoint = torch.load(checkpoint_path, map_location='cpu')
+  model.load_state_dict(checkpoint['model_state_dict'])
+  del checkpoint
+
+  return quantize_meena(model, inplace=True)
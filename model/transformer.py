@@ -1,9 +1,17 @@
 import math
+from functools import lru_cache
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-def self_attention(query, key, value, mask=None, causal=False):
+@lru_cache(maxsize=None)
+def causal_mask(query_len, key_len, device):
+  # [query_len, key_len], True 인 위치만 attention 한다.
+  # 캐시된 key 가 있으면 query 는 key 의 마지막 query_len 개 위치에 해당한다.
+  return torch.ones(query_len, key_len, dtype=torch.bool, device=device).tril(key_len - query_len)
+
+def self_attention(query, key, value, mask=None, causal=False, need_weights=True):
   key_transpose = torch.transpose(key,-2,-1)                      # (bath, head_num, d_k, token_)
   matmul_result = torch.matmul(query,key_transpose)                # MatMul(Q,K)
   d_k = query.size()[-1]
@@ -12,20 +20,51 @@ def self_attention(query, key, value, mask=None, causal=False):
   if mask is not None:
     attention_score = attention_score.masked_fill(mask == 0, -1e4)
 
-  if causal:
-    query_len = query.size()[2]
-    # causal_mask = torch.tril(torch.ones(query_len, query_len))
-    # attention_score = attention_score.masked_fill_(causal_mask == 0, -1e4)
-    i, j = torch.triu_indices(query_len, query_len, 1)
-    attention_score[:, :, i, j] = -1e4
+  if causal and query.size(2) > 1:
+    # query 가 토큰 1개이면 (incremental decoding) 가릴 위치가 없다.
+    attention_score = attention_score.masked_fill(~causal_mask(query.size(2), key.size(2), query.device), -1e4)
 
   softmax_attention_score = F.softmax(attention_score,dim=-1)  # 어텐션 값
   result = torch.matmul(softmax_attention_score,value)
 
   return result, softmax_attention_score
 
+def sdpa_attention(query, key, value, mask=None, causal=False, need_weights=False):
+  """
+  torch.nn.functional.scaled_dot_product_attention 을 사용하는 attention
+  [batch, head, query_len, key_len] score/확률 텐서를 만들지 않는 fused kernel 을 사용할 수 있다.
+  어텐션 확률이 필요하거나 (need_weights) sdpa 가 없는 torch 버전에서는 self_attention 으로 계산한다.
+  """
+  if need_weights or not hasattr(F, 'scaled_dot_product_attention'):
+    return self_attention(query, key, value, mask, causal, need_weights)
+
+  query_len, key_len = query.size(2), key.size(2)
+  attn_mask = None if mask is None else mask != 0
+  is_causal = bool(causal and query_len > 1)  # torch.onnx 추적 중에는 query_len 이 텐서이다.
+  if is_causal and (attn_mask is not None or query_len != key_len):
+    # sdpa 의 is_causal 은 query 와 key 의 시작 위치가 같다고 가정하므로 직접 마스크를 합친다.
+    causal_attn_mask = causal_mask(query_len, key_len, query.device)
+    attn_mask = causal_attn_mask if attn_mask is None else attn_mask & causal_attn_mask
+    is_causal = False
+
+  if attn_mask is None:
+    return F.scaled_dot_product_attention(query, key, value, is_causal=is_causal), None
+
+  # 모든 key 가 가려진 row(배치의 all-pad 문장 등)에서 sdpa 는 NaN 을 반환한다.
+  # self_attention 은 이 경우 모든 score 가 -1e4 로 같아 value 의 평균이 되므로 같은 값으로 맞춘다.
+  fully_masked = ~attn_mask.any(dim=-1, keepdim=True)
+  result = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask | fully_masked)
+  result = torch.where(fully_masked, value.mean(dim=-2, keepdim=True), result)
+  return result, None
+
+ATTENTION_BACKENDS = {
+  'reference': self_attention,
+  'sdpa': sdpa_attention,
+}
+
 class MultiHeadAttention(nn.Module):
-  def __init__(self, head_num =8 , d_model = 512,dropout = 0.1, causal=False):
+  def __init__(self, head_num =8 , d_model = 512,dropout = 0.1, causal=False, cross_attention=False, fused=False,
+               attention_backend='reference', need_weights=False):
     super(MultiHeadAttention,self).__init__()
 
     # print(d_model % head_num)
@@ -35,32 +74,96 @@ class MultiHeadAttention(nn.Module):
     self.d_model = d_model
     self.d_k = self.d_v = d_model // head_num
     self.causal = causal
-
-    self.w_q = nn.Linear(d_model,d_model)
-    self.w_k = nn.Linear(d_model,d_model)
-    self.w_v = nn.Linear(d_model,d_model)
+    self.cross_attention = cross_attention
+    self.fused = fused
+
+    # fused: self-attention 은 Q/K/V 를 [d_model, 3*d_model] GEMM 하나로,
+    #        encoder-decoder attention 은 K/V 를 [d_model, 2*d_model] GEMM 하나로 계산한다.
+    if not fused:
+      self.w_q = nn.Linear(d_model,d_model)
+      self.w_k = nn.Linear(d_model,d_model)
+      self.w_v = nn.Linear(d_model,d_model)
+    elif cross_attention:
+      self.w_q = nn.Linear(d_model,d_model)
+      self.w_kv = nn.Linear(d_model,d_model*2)
+    else:
+      self.w_qkv = nn.Linear(d_model,d_model*3)
     self.w_o = nn.Linear(d_model,d_model)
 
-    self.self_attention = self_attention
+    # need_weights 가 True 인 경우에만 어텐션 확률을 self.attention_score 에 남긴다.
+    self.self_attention = ATTENTION_BACKENDS[attention_backend]
+    self.need_weights = need_weights
+    self.attention_score = None
     self.dropout = nn.Dropout(p=dropout)
 
-  def forward(self, query, key, value, mask = None):
+  def forward(self, query, key, value, mask = None, layer_cache = None):
     if mask is not None:
       mask = mask.unsqueeze(1)
 
     batche_num = query.size(0)
-
-    query = self.w_q(query).view(batche_num, -1, self.head_num, self.d_k).transpose(1, 2)
-    key = self.w_k(key).view(batche_num, -1, self.head_num, self.d_k).transpose(1, 2)
-    value = self.w_v(value).view(batche_num, -1, self.head_num, self.d_k).transpose(1, 2)
-
-    attention_result, attention_score = self.self_attention(query, key, value, mask, self.causal)
+    cached_cross = self.cross_attention and layer_cache is not None and 'cross_key' in layer_cache
+
+    if self.fused and not self.cross_attention:
+      # self-attention 이므로 query, key, value 는 같은 입력이다.
+      query, key, value = [self._split_heads(x) for x in self.w_qkv(query).chunk(3, dim=-1)]
+    else:
+      query = self._split_heads(self.w_q(query))
+      if not cached_cross:
+        key, value = self.project_key_value(key, value)
+
+    if layer_cache is None:
+      pass
+    elif not self.cross_attention:
+      # self-attention: 이전 스텝까지의 key/value 뒤에 새 토큰의 key/value 를 이어 붙인다.
+      if 'self_key' in layer_cache:
+        key = torch.cat([layer_cache['self_key'], key], dim=2)
+        value = torch.cat([layer_cache['self_value'], value], dim=2)
+      layer_cache['self_key'] = key
+      layer_cache['self_value'] = value
+    else:
+      # encoder-decoder attention: 인코더 출력은 한 턴 동안 변하지 않으므로 한 번만 계산한다.
+      if not cached_cross:
+        layer_cache['cross_key'], layer_cache['cross_value'] = key, value
+      key = layer_cache['cross_key']
+      value = layer_cache['cross_value']
+
+    attention_result, attention_score = self.self_attention(query, key, value, mask, self.causal, self.need_weights)
+    if self.need_weights:
+      self.attention_score = attention_score
 
     attention_result = attention_result.transpose(1,2).contiguous().view(batche_num, -1, self.head_num * self.d_k)
 
 
     return self.w_o(attention_result)
 
+  def project_key_value(self, key, value):
+    if self.fused:
+      # fused 모드의 encoder-decoder attention 에서 key 와 value 는 같은 인코더 출력이다.
+      key, value = self.w_kv(key).chunk(2, dim=-1)
+    else:
+      key, value = self.w_k(key), self.w_v(value)
+    return self._split_heads(key), self._split_heads(value)
+
+  def _split_heads(self, x):
+    return x.view(x.size(0), -1, self.head_num, self.d_k).transpose(1, 2)
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # fused / 분리된 projection 사이의 checkpoint 를 서로 변환해서 불러온다.
+    separate = ['w_q', 'w_k', 'w_v']
+    fused_name = 'w_kv' if self.cross_attention else 'w_qkv'
+    fused_parts = separate[1:] if self.cross_attention else separate
+
+    for param in ('weight', 'bias'):
+      fused_key = f'{prefix}{fused_name}.{param}'
+      part_keys = [f'{prefix}{name}.{param}' for name in fused_parts]
+      if self.fused and fused_key not in state_dict and all(key in state_dict for key in part_keys):
+        state_dict[fused_key] = torch.cat([state_dict.pop(key) for key in part_keys], dim=0)
+      elif not self.fused and fused_key in state_dict:
+        for key, tensor in zip(part_keys, state_dict.pop(fused_key).chunk(len(part_keys), dim=0)):
+          state_dict[key] = tensor
+
+    super(MultiHeadAttention,self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class FeedForward(nn.Module):
   def __init__(self,d_model, dropout = 0.1):
     super(FeedForward,self).__init__()
@@ -78,8 +181,9 @@ class LayerNorm(nn.Module):
     self.b_2 = nn.Parameter(torch.zeros(features))
     self.eps = eps
   def forward(self, x):
-    mean = x.mean(-1, keepdim =True) # 평균
-    std = x.std(-1, keepdim=True)    # 표준편차
+    # 평균과 (unbiased) 분산을 한 번의 reduction 으로 계산한다.
+    var, mean = torch.var_mean(x, -1, unbiased=True, keepdim=True)
+    std = var.sqrt()    # 표준편차
 
     return self.a_2 * (x-mean)/ (std + self.eps) + self.b_2
 
@@ -92,38 +196,49 @@ class ResidualConnection(nn.Module):
   def forward(self, x, sublayer):
     return x + self.dropout((sublayer(self.norm(x))))
 
+  def residual(self, x, sublayer_output):
+    # sublayer_output = sublayer(self.norm(x)). Encoder/Decoder 는 lambda 없이 이 경로를 사용한다.
+    return x + self.dropout(sublayer_output)
+
 class Encoder(nn.Module):
-  def __init__(self, d_model, head_num, dropout):
+  def __init__(self, d_model, head_num, dropout, fused_qkv=False, attention_backend='reference'):
     super(Encoder,self).__init__()
-    self.multi_head_attention = MultiHeadAttention(d_model= d_model, head_num= head_num)
+    self.multi_head_attention = MultiHeadAttention(d_model= d_model, head_num= head_num, fused=fused_qkv,
+                                                   attention_backend=attention_backend)
     self.residual_1 = ResidualConnection(d_model,dropout=dropout)
 
     self.feed_forward = FeedForward(d_model)
     self.residual_2 = ResidualConnection(d_model,dropout=dropout)
 
   def forward(self, input, mask):
-    x = self.residual_1(input, lambda x: self.multi_head_attention(x, x, x, mask))
-    x = self.residual_2(x, lambda x: self.feed_forward(x))
+    # sublayer 를 lambda 로 감싸지 않고 직접 호출한다. (torch.compile 에서 graph break 없이 추적된다)
+    h = self.residual_1.norm(input)
+    x = self.residual_1.residual(input, self.multi_head_attention(h, h, h, mask))
+    x = self.residual_2.residual(x, self.feed_forward(self.residual_2.norm(x)))
     return x
 
 class Decoder(nn.Module):
-  def __init__(self, d_model,head_num, dropout):
+  def __init__(self, d_model,head_num, dropout, fused_qkv=False, attention_backend='reference'):
     super(Decoder,self).__init__()
-    self.masked_multi_head_attention = MultiHeadAttention(d_model= d_model, head_num= head_num, causal=True)
+    self.masked_multi_head_attention = MultiHeadAttention(d_model= d_model, head_num= head_num, causal=True, fused=fused_qkv,
+                                                          attention_backend=attention_backend)
     self.residual_1 = ResidualConnection(d_model,dropout=dropout)
 
-    self.encoder_decoder_attention = MultiHeadAttention(d_model=d_model, head_num=head_num)
+    self.encoder_decoder_attention = MultiHeadAttention(d_model=d_model, head_num=head_num, cross_attention=True, fused=fused_qkv,
+                                                        attention_backend=attention_backend)
     self.residual_2 = ResidualConnection(d_model, dropout=dropout)
 
     self.feed_forward = FeedForward(d_model)
     self.residual_3 = ResidualConnection(d_model, dropout=dropout)
 
 
-  def forward(self, target, encoder_output= None, encoder_mask =None):
-    x = self.residual_1(target, lambda x: self.masked_multi_head_attention(x, x, x))
+  def forward(self, target, encoder_output= None, encoder_mask =None, layer_cache=None, self_mask=None):
+    h = self.residual_1.norm(target)
+    x = self.residual_1.residual(target, self.masked_multi_head_attention(h, h, h, self_mask, layer_cache))
     if encoder_output is not None and encoder_mask is not None:
-      x = self.residual_2(x, lambda x: self.encoder_decoder_attention(x, encoder_output, encoder_output, encoder_mask))
-    x = self.residual_3(x, lambda x: self.feed_forward(x))
+      h = self.residual_2.norm(x)
+      x = self.residual_2.residual(x, self.encoder_decoder_attention(h, encoder_output, encoder_output, encoder_mask, layer_cache))
+    x = self.residual_3.residual(x, self.feed_forward(self.residual_3.norm(x)))
 
     return x
 
@@ -139,9 +254,15 @@ class PositionalEmbedding(nn.Module):
   def __init__(self, dim, max_seq_len):
     super().__init__()
     self.embedding = nn.Embedding(max_seq_len, dim)
-
-  def forward(self, x):
-    t = torch.arange(x.shape[1], device=x.device)
+    # forward 마다 arange 를 새로 만들지 않도록 position id 를 buffer 로 둔다. (state_dict 에는 저장하지 않음)
+    self.register_buffer('position_ids', torch.arange(max_seq_len), persistent=False)
+
+  def forward(self, x, offset=0):
+    # offset: 시작 position. row 마다 다르면 [batch] 텐서
+    if torch.is_tensor(offset):
+      t = offset.unsqueeze(1) + self.position_ids[:x.shape[1]]
+    else:
+      t = self.position_ids[offset:offset + x.shape[1]]
     return self.embedding(t)
 
 if __name__=="__main__":
@@ -0,0 +1,40 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+
+from common.arg import ModelConfig
+from model.meena import Meena
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'meena-config-small.json')
+
+
+def build_pair(vocab_size=100):
+  config = ModelConfig(CONFIG_PATH).get_config()
+  config.attention_backend = 'reference'
+  reference = Meena.from_config(config, vocab_size=vocab_size).eval()
+  config.attention_backend = 'sdpa'
+  sdpa = Meena.from_config(config, vocab_size=vocab_size).eval()
+  sdpa.load_state_dict(reference.state_dict())
+  return reference, sdpa
+
+
+@torch.no_grad()
+def test_sdpa_matches_reference_on_padded_batch():
+  torch.manual_seed(0)
+  reference, sdpa = build_pair()
+
+  # 0: 패딩 없음, 1: 뒤쪽 패딩, 2: 전부 패딩 (모든 key 가 가려진 row)
+  encoder_input_ids = torch.randint(5, 100, (3, 12))
+  encoder_input_ids[1, 7:] = 0
+  encoder_input_ids[2] = 0
+  encoder_input_mask = (encoder_input_ids != 0).unsqueeze(1)
+  decoder_input_ids = torch.randint(5, 100, (3, 6))
+
+  reference_logits = reference(encoder_input_ids, decoder_input_ids, encoder_input_mask)[0]
+  sdpa_logits = sdpa(encoder_input_ids, decoder_input_ids, encoder_input_mask)[0]
+
+  assert not torch.isnan(sdpa_logits).any()
+  assert torch.allclose(reference_logits, sdpa_logits, atol=1e-4)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example'))
+
+import pytest
+import torch
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from common.arg import ModelConfig
+from common.onnx_runner import OnnxMeena
+from export_onnx import check_parity
+from model.meena import Meena
+from model.onnx_export import export_meena_onnx
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'meena-config-small.json')
+
+
+@pytest.mark.parametrize('attention_backend', ['reference', 'sdpa'])
+def test_onnx_matches_forward(tmp_path, attention_backend):
+  torch.manual_seed(0)
+  config = ModelConfig(CONFIG_PATH).get_config()
+  config.attention_backend = attention_backend
+  model = Meena.from_config(config, vocab_size=100).eval()
+
+  encoder_path, decoder_path = export_meena_onnx(model, str(tmp_path))
+
+  # export 후에도 model 은 eval 모드여야 한다. (dropout 이 켜지면 비교가 무의미하다)
+  assert not model.training
+  assert check_parity(model, OnnxMeena(encoder_path, decoder_path), 100, config.max_seq_len) <= 1e-3
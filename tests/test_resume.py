@@ -0,0 +1,72 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+from torch import nn
+
+from common.resume import load_resume_state
+
+
+def build_checkpoint(**extra):
+  # model_name/epoch_step/rng_state 가 없는 이전 형식의 체크포인트
+  model = nn.Linear(4, 2)
+  optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+  checkpoint = {
+    'epoch': 0,
+    'train_step': 7,
+    'model_state_dict': model.state_dict(),
+    'optimizer_state_dict': optimizer.state_dict(),
+    'losses': {7: 1.5},
+  }
+  checkpoint.update(extra)
+  return checkpoint
+
+
+def resume(checkpoint, **kwargs):
+  model = nn.Linear(4, 2)
+  optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+  return load_resume_state(checkpoint, model, optimizer, seed=42, steps_per_epoch=10, **kwargs)
+
+
+def test_legacy_checkpoint_resumes_without_model_name_check():
+  # 사전학습 trainer: model_name 이 없는 이전 체크포인트도 이어서 학습한다.
+  assert resume(build_checkpoint()) == (0, 7, 7, {7: 1.5})
+  assert resume(build_checkpoint(), model_name='meena-finetuning') == (0, 7, 7, {7: 1.5})
+
+
+def test_finetuning_does_not_resume_legacy_checkpoint():
+  # 파인튜닝 trainer: 같은 경로의 사전학습 체크포인트(model_name 없음)는 초기 가중치로만 쓴다.
+  assert resume(build_checkpoint(), model_name='meena-finetuning', require_model_name=True) is None
+  assert resume(build_checkpoint(model_name='meena-pretraining'), model_name='meena-finetuning',
+                require_model_name=True) is None
+
+
+def test_finetuning_resumes_own_checkpoint():
+  checkpoint = build_checkpoint(model_name='meena-finetuning', epoch_step=3)
+  assert resume(checkpoint, model_name='meena-finetuning', require_model_name=True) == (0, 3, 7, {7: 1.5})
+
+
+class RecordingPrecision(object):
+  def __init__(self):
+    self.loaded = []
+
+  def load_checkpoint(self, checkpoint):
+    self.loaded.append(checkpoint)
+
+
+def test_apex_state_is_migrated_only_on_resume():
+  amp_state = {'loss_scaler0': {'loss_scale': 1024.0, 'unskipped': 5}}
+
+  # 파인튜닝의 초기 가중치로만 쓰이는 apex 사전학습 체크포인트: loss scale 을 옮기지 않는다.
+  precision = RecordingPrecision()
+  assert resume(build_checkpoint(amp=amp_state), model_name='meena-finetuning', precision=precision,
+                require_model_name=True) is None
+  assert precision.loaded == []
+
+  # 이어서 학습하는 경우에만 옮긴다.
+  precision = RecordingPrecision()
+  checkpoint = build_checkpoint(amp=amp_state, model_name='meena-finetuning')
+  assert resume(checkpoint, model_name='meena-finetuning', precision=precision, require_model_name=True) is not None
+  assert precision.loaded == [checkpoint]
@@ -0,0 +1,275 @@
+import warnings
+
+warnings.filterwarnings("ignore")
+import sys
+
+sys.path.append('../')
+
+import os
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset, Subset
+from tqdm import tqdm
+from transformers import BertTokenizer
+from fairseq.optim.adafactor import Adafactor
+
+from model.meena import Meena, compile_meena, set_activation_checkpointing
+from common.arg import ModelConfig
+from common.resume import ResumableSampler
+from common.dataset import DatasetForSeq2seqConversation
+from train.run_finetuning import MeenaTrainer, meena_dataset
+
+
+class IndexedDataset(Dataset):
+  # 데이터셋 item 앞에 index 를 붙인다. (캐시된 teacher logit 을 찾기 위해 사용)
+  def __init__(self, dataset):
+    self.dataset = dataset
+
+  def __len__(self):
+    return len(self.dataset)
+
+  def __getitem__(self, index):
+    return (index, *self.dataset[index])
+
+
+class TeacherLogitsCache(object):
+  """
+  teacher 의 top-k logit 을 디스크(numpy memmap)에 저장해 두고 학습 중에 읽는다.
+  values: [num_examples, max_len, k] float16, indices: [num_examples, max_len, k] int16 (vocab < 32768)
+  한 번 만들어 두면 epoch 마다 teacher 를 실행하지 않아도 된다.
+  sources: 캐시를 만든 입력 파일(teacher checkpoint, 데이터셋 캐시, vocab)의 경로.
+  파일의 크기/수정 시각을 meta 에 함께 저장해 두고, 달라지면 캐시를 다시 만든다.
+  """
+  def __init__(self, cache_dir, name, num_examples, max_len, k, sources=None):
+    self.values_path = f'{cache_dir}/{name}.teacher_top{k}_values.npy'
+    self.indices_path = f'{cache_dir}/{name}.teacher_top{k}_indices.npy'
+    self.meta_path = f'{cache_dir}/{name}.teacher_top{k}.json'
+    self.shape = (num_examples, max_len, k)
+    self.k = k
+    self.sources = {key: file_fingerprint(path) for key, path in (sources or {}).items()}
+    os.makedirs(cache_dir, exist_ok=True)
+
+    self.values = None
+    self.indices = None
+    if self.is_complete():
+      self.values = np.load(self.values_path, mmap_mode='r')
+      self.indices = np.load(self.indices_path, mmap_mode='r')
+
+  def is_complete(self):
+    if not os.path.exists(self.meta_path):
+      return False
+    with open(self.meta_path) as f:
+      meta = json.load(f)
+    if tuple(meta['shape']) != self.shape:
+      return False
+    if meta.get('sources') != self.sources:
+      logging.warning(f'Teacher logits cache {self.meta_path} was built from different inputs, rebuilding')
+      return False
+    return True
+
+  @torch.no_grad()
+  def build(self, teacher, dataset, batch_size, device):
+    values = np.lib.format.open_memmap(self.values_path, mode='w+', dtype=np.float16, shape=self.shape)
+    indices = np.lib.format.open_memmap(self.indices_path, mode='w+', dtype=np.int16, shape=self.shape)
+
+    dataloader = DataLoader(IndexedDataset(dataset), batch_size=batch_size, shuffle=False)
+    for batch in tqdm(dataloader, desc='Teacher logits', bar_format='{l_bar}{bar:10}{r_bar}'):
+      index, encoder_input_ids, decoder_input_ids, encoder_input_mask, _ = batch
+      logits, _ = teacher(encoder_input_ids.to(device), decoder_input_ids.to(device), encoder_input_mask.to(device))
+      top_values, top_indices = logits.float().topk(self.k, dim=-1)
+      values[index.numpy()] = top_values.cpu().numpy().astype(np.float16)
+      indices[index.numpy()] = top_indices.cpu().numpy().astype(np.int16)
+
+    values.flush()
+    indices.flush()
+    with open(self.meta_path, 'w') as f:
+      json.dump({'shape': list(self.shape), 'sources': self.sources, 'created': str(datetime.now())}, f)
+
+    self.values = np.load(self.values_path, mmap_mode='r')
+    self.indices = np.load(self.indices_path, mmap_mode='r')
+
+  def get(self, index, device):
+    index = index.numpy()
+    values = torch.from_numpy(self.values[index].astype(np.float32)).to(device)
+    indices = torch.from_numpy(self.indices[index].astype(np.int64)).to(device)
+    return values, indices
+
+
+def file_fingerprint(path):
+  # 파일 내용을 모두 해시하지 않고 (경로, 크기, 수정 시각) 으로 바뀌었는지 판단한다.
+  if path is None or not os.path.exists(path):
+    return None
+  stat = os.stat(path)
+  return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature, teacher_indices=None):
+  """
+  temperature 로 나눈 teacher / student 분포 사이의 KL(teacher || student) * temperature^2
+  teacher_indices 가 주어지면 teacher_logits 는 top-k logit 이며, teacher 분포를 top-k 안에서 다시 정규화한다.
+  CrossEntropyLoss(ignore_index=0) 와 같이 다음 토큰 label 이 pad 인 position 은 제외하며,
+  모든 label 이 pad 인 배치는 NaN 대신 0 을 반환한다.
+  """
+  student_logits = student_logits[..., :-1, :].float()
+  teacher_logits = teacher_logits[..., :-1, :].float()
+  mask = labels[..., 1:] != 0
+
+  student_log_probs = F.log_softmax(student_logits / temperature, dim=-1)
+  if teacher_indices is not None:
+    student_log_probs = student_log_probs.gather(-1, teacher_indices[..., :-1, :])
+  teacher_log_probs = F.log_softmax(teacher_logits / temperature, dim=-1)
+
+  kl = (teacher_log_probs.exp() * (teacher_log_probs - student_log_probs)).sum(-1)
+  mask = mask.float()
+  return (kl * mask).sum() / mask.sum().clamp(min=1.0) * temperature ** 2
+
+
+class DistillationTrainer(MeenaTrainer):
+  """
+  고정된 teacher(1.1B Meena)로 student(small config Meena)를 학습한다.
+  loss = alpha * KL(teacher || student) + (1 - alpha) * CrossEntropyLoss(ignore_index=0)
+  teacher_cache 가 있으면 저장된 top-k teacher logit 을 사용하고, 없으면 매 스텝 teacher 를 실행한다.
+  """
+  def __init__(self, dataset, model, tokenizer, teacher, temperature=2.0, alpha=0.5, teacher_cache=None, **kwargs):
+    super(DistillationTrainer, self).__init__(dataset, model, tokenizer, **kwargs)
+    self.teacher = teacher
+    self.temperature = temperature
+    self.alpha = alpha
+    self.teacher_cache = teacher_cache
+
+  def build_dataloaders(self, train_test_split=0.1, train_shuffle=True, eval_shuffle=True):
+    # 학습 데이터에는 teacher logit 캐시를 찾기 위한 원래 데이터셋 index 를 붙인다.
+    dataset_len = len(self.dataset)
+    eval_len = int(dataset_len * train_test_split)
+    permutation = torch.randperm(dataset_len, generator=torch.Generator().manual_seed(self.seed)).tolist()
+    train_dataset = Subset(IndexedDataset(self.dataset), permutation[eval_len:])
+    eval_dataset = Subset(self.dataset, permutation[:eval_len])
+    train_sampler = ResumableSampler(len(train_dataset), shuffle=train_shuffle, seed=self.seed)
+    train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, sampler=train_sampler)
+    eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size, shuffle=eval_shuffle)
+    logging.info(f'''train_dataloader size: {len(train_loader.dataset)} | shuffle: {train_shuffle}
+                         eval_dataloader size: {len(eval_loader.dataset)} | shuffle: {eval_shuffle}''')
+
+    return train_loader, eval_loader
+
+  def compute_loss(self, batch):
+    index, encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch
+    encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
+    student_logits, ce_loss = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels)
+
+    if self.teacher_cache is not None:
+      teacher_logits, teacher_indices = self.teacher_cache.get(index, self.device)
+    else:
+      with torch.no_grad():
+        teacher_logits, _ = self.teacher(encoder_input_ids, decoder_input_ids, encoder_input_mask)
+      teacher_indices = None
+
+    kd_loss = distillation_loss(student_logits, teacher_logits, labels, self.temperature, teacher_indices)
+    return self.alpha * kd_loss + (1 - self.alpha) * ce_loss
+
+
+def load_teacher(config, tokenizer, device):
+  teacher_config = ModelConfig(config_path=config.teacher_config_path).get_config()
+  teacher = Meena.from_config(teacher_config, vocab_size=tokenizer.vocab_size)
+
+  checkpoint = torch.load(config.teacher_checkpoint, map_location='cpu')
+  teacher.load_state_dict(checkpoint['model_state_dict'])
+  del checkpoint
+
+  teacher.requires_grad_(False)
+  teacher.eval()
+  if torch.cuda.is_available():
+    teacher.half()
+  return teacher.to(device)
+
+
+def main():
+  torch.manual_seed(9)
+  torch.cuda.set_device(1)
+  base_path = '..'
+
+  log_dir = f'{base_path}/logs'
+  config_path = f'{base_path}/config/meena-distillation-config.json'
+  device = 'cuda:1' if torch.cuda.is_available() else 'cpu'
+
+  # Config
+  config = ModelConfig(config_path=config_path).get_config()
+
+  # Tokenizer
+  tokenizer = BertTokenizer(vocab_file=config.vocab_path, do_lower_case=False)
+
+  # Dataset
+  dataset = meena_dataset(config, tokenizer, DatasetForSeq2seqConversation)
+
+  # Teacher (frozen)
+  teacher = load_teacher(config, tokenizer, device)
+
+  teacher_cache = None
+  if config.teacher_topk:
+    teacher_cache = TeacherLogitsCache(config.cache_path, config.model_name, len(dataset), config.max_seq_len,
+                                       config.teacher_topk,
+                                       sources={'teacher_checkpoint': config.teacher_checkpoint,
+                                                'dataset': f'{config.cache_path}/{config.model_name}.pickle',
+                                                'vocab': config.vocab_path})
+    if not teacher_cache.is_complete():
+      teacher_cache.build(teacher, dataset, config.batch_size, device)
+    # 캐시를 사용하면 학습 중에는 teacher 가 필요 없다.
+    del teacher
+    teacher = None
+    torch.cuda.empty_cache()
+
+  # Student
+  model = Meena.from_config(config, vocab_size=tokenizer.vocab_size)
+
+  if torch.cuda.is_available():
+    model.cuda(1)
+
+  if config.activation_checkpointing or config.activation_memory_budget:
+    set_activation_checkpointing(model,
+                                 every=config.activation_checkpointing,
+                                 memory_budget=config.activation_memory_budget,
+                                 batch_size=config.batch_size,
+                                 seq_len=config.max_seq_len,
+                                 bytes_per_element=2 if config.fp16 else 4)
+
+  if config.compile:
+    compile_meena(model)
+
+  optimizer = Adafactor(model.parameters(),
+                        scale_parameter=False,
+                        relative_step=False,
+                        warmup_init=False,
+                        lr=config.learning_rate)
+
+  trainer = DistillationTrainer(dataset, model, tokenizer,
+                                teacher=teacher,
+                                temperature=config.distill_temperature,
+                                alpha=config.distill_alpha,
+                                teacher_cache=teacher_cache,
+                                model_name=config.model_name,
+                                max_len=config.max_seq_len,
+                                checkpoint_path=config.checkpoint_path,
+                                train_batch_size=config.batch_size,
+                                eval_batch_size=config.batch_size,
+                                log_dir=log_dir,
+                                fp16=config.fp16,
+                                fp16_opt_level=config.fp16_opt_level)
+
+  train_dataloader, eval_dataloader = trainer.build_dataloaders(train_test_split=0.1)
+
+  trainer.train(epochs=config.epochs,
+                train_dataloader=train_dataloader,
+                eval_dataloader=eval_dataloader,
+                optimizer=optimizer,
+                log_steps=config.log_steps,
+                ckpt_steps=config.ckpt_steps,
+                gradient_accumulation_steps=config.gradient_accumulation_steps)
+
+
+if __name__ == '__main__':
+  main()
@@ -12,14 +12,16 @@ from torch.utils.data import DataLoader, random_split
 from tqdm import tqdm
 from transformers import BertTokenizer
 from fairseq.optim.adafactor import Adafactor
-from apex import amp
 
 import os
+import itertools
 import json
 import logging
 from datetime import datetime
-from model.meena import Meena
+from model.meena import Meena, compile_meena, set_activation_checkpointing
 from common.arg import ModelConfig
+from common.precision import MixedPrecision
+from common.resume import ResumableSampler, PreemptionHandler, get_rng_state, load_resume_state, atomic_save
 from common.dataset import DatasetForSeq2seqV2, DatasetForSeq2seqConversation
 
 class MeenaTrainer(object):
@@ -34,7 +36,9 @@ class MeenaTrainer(object):
                train_batch_size=8,
                eval_batch_size=None,
                log_dir='../logs',
-               fp16=True):
+               fp16=True,
+               fp16_opt_level='O1',
+               seed=9):
 
     self.dataset = dataset
     self.model = model
@@ -48,10 +52,13 @@ class MeenaTrainer(object):
     self.eval_batch_size = eval_batch_size
     self.log_dir = log_dir
     self.fp16 = fp16
+    self.seed = seed
 
     if device is None:
       self.device = 'cuda:1' if torch.cuda.is_available() else 'cpu'
 
+    self.precision = MixedPrecision(fp16, fp16_opt_level, self.device)
+
     if eval_batch_size is None:
       self.eval_batch_size = train_batch_size
 
@@ -61,8 +68,11 @@ class MeenaTrainer(object):
     dataset_len = len(self.dataset)
     eval_len = int(dataset_len * train_test_split)
     train_len = dataset_len - eval_len
-    train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len))
-    train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, shuffle=train_shuffle)
+    # 재시작해도 같은 분할과 순서가 나오도록 seed 를 고정한다.
+    train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len),
+                                               generator=torch.Generator().manual_seed(self.seed))
+    train_sampler = ResumableSampler(len(train_dataset), shuffle=train_shuffle, seed=self.seed)
+    train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, sampler=train_sampler)
     eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size, shuffle=eval_shuffle)
     logging.info(f'''train_dataloader size: {len(train_loader.dataset)} | shuffle: {train_shuffle}
                          eval_dataloader size: {len(eval_loader.dataset)} | shuffle: {eval_shuffle}''')
@@ -85,6 +95,22 @@ class MeenaTrainer(object):
     start_step = 0
     step_perplexity = 0.0
 
+    # Load Checkpoint
+    # main() 이 초기 가중치로 읽는 파일과 같은 경로이므로, 이 trainer 가 저장한 (model_name 이 같은) 체크포인트일 때만
+    # 학습 위치/optimizer 상태를 이어받는다. 사전학습 체크포인트면 epoch 0 부터 새 optimizer 로 학습한다.
+    checkpoint_file = f'{self.checkpoint_path}/{self.model_name}.pth'
+    if os.path.isfile(checkpoint_file):
+      checkpoint = torch.load(checkpoint_file, map_location='cpu')
+      resume_state = load_resume_state(checkpoint, self.model, optimizer, self.seed, len(train_dataloader),
+                                       model_name=self.model_name, precision=self.precision,
+                                       require_model_name=True)
+      if resume_state is not None:
+        start_epoch, start_step, global_steps, losses = resume_state
+        logging.info(f'{datetime.now()} | Resumed from epoch: {start_epoch} | epoch_step: {start_step} | train_step: {global_steps}')
+
+      # remove checkpoint for gpu memory
+      del checkpoint
+
     # Logging
     logging.info(f'{datetime.now()} | Moved model to: {self.device}')
     logging.info(
@@ -94,69 +120,93 @@ class MeenaTrainer(object):
 
     # Train
     self.model.zero_grad()  # Reset gradients tensors
-    for epoch in range(start_epoch, epochs):  # tqdm(range(epochs), desc='Epochs', position=0):
-      logging.info(f'{datetime.now()} | Epoch: {epoch}')
-      pb = tqdm(enumerate(train_dataloader),
-                desc=f'Epoch-{epoch} Iterator',
-                total=len(train_dataloader),
-                bar_format='{l_bar}{bar:10}{r_bar}'
-                )
-      for step, batch in pb:
-        # if step < start_step:
-          # continue
-        encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch  # _ is input_mask
-        encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
-        output = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels) # output: lm_logits, loss, encoder_logit, x
-
-        loss = output[1]
-
-        step_perplexity += torch.exp(loss)
-        origin_loss = loss.item()
-
-        loss = loss / gradient_accumulation_steps  # divide loss into gradient accumulation step
-        if self.fp16:
-          with amp.scale_loss(loss, optimizer) as scaled_loss:
-            scaled_loss.backward()
+    # 학습 데이터 순서는 ResumableSampler 가 정하므로 재시작할 때 앞선 배치를 다시 읽지 않는다.
+    train_sampler = train_dataloader.sampler
+    resumable = isinstance(train_sampler, ResumableSampler)
+    if resumable:
+      train_sampler.set_epoch(start_epoch)
+    steps_per_epoch = len(train_dataloader)
+
+    # SIGTERM/SIGINT 를 받으면 현재 배치를 마친 뒤 체크포인트를 저장하고 종료한다.
+    with PreemptionHandler() as preemption:
+      for epoch in range(start_epoch, epochs):  # tqdm(range(epochs), desc='Epochs', position=0):
+        logging.info(f'{datetime.now()} | Epoch: {epoch}')
+        if resumable:
+          # 이미 학습한 배치는 읽지 않고 start_step 번째 배치부터 시작한다.
+          train_sampler.set_epoch(epoch, start_step * train_dataloader.batch_size)
+          batches = enumerate(train_dataloader, start_step)
         else:
-          loss.backward()
-
-        step_loss += origin_loss
-        losses[global_steps] = origin_loss
-
-        local_steps += 1
-        global_steps += 1
-
-        if global_steps % gradient_accumulation_steps == 0:
-          if self.fp16:
-            torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), max_norm=1.0)
-          else:
+          batches = itertools.islice(enumerate(train_dataloader), start_step, None)
+        pb = tqdm(batches,
+                  desc=f'Epoch-{epoch} Iterator',
+                  initial=start_step,
+                  total=steps_per_epoch,
+                  bar_format='{l_bar}{bar:10}{r_bar}'
+                  )
+        for step, batch in pb:
+          with self.precision.autocast():
+            loss = self.compute_loss(batch)
+
+          step_perplexity += torch.exp(loss)
+          origin_loss = loss.item()
+
+          loss = loss / gradient_accumulation_steps  # divide loss into gradient accumulation step
+          self.precision.backward(loss)
+
+          step_loss += origin_loss
+          losses[global_steps] = origin_loss
+
+          local_steps += 1
+          global_steps += 1
+
+          if global_steps % gradient_accumulation_steps == 0:
+            self.precision.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
 
-          optimizer.step()
-          self.model.zero_grad()
-
-        if global_steps % log_steps == 0:
-          pb.set_postfix_str(
-            f''' Train Loss: {format(step_loss / local_steps, ".4f")} | step_perplexity: {format(step_perplexity/local_steps,".4f")} | Steps: {global_steps}''')
-          step_loss = 0.0
-          local_steps = 0
-          step_perplexity =0.0
+            self.precision.step(optimizer)
+            self.model.zero_grad()
+
+          if global_steps % log_steps == 0:
+            pb.set_postfix_str(
+              f''' Train Loss: {format(step_loss / local_steps, ".4f")} | step_perplexity: {format(step_perplexity/local_steps,".4f")} | Steps: {global_steps}''')
+            step_loss = 0.0
+            local_steps = 0
+            step_perplexity =0.0
+
+          if global_steps % ckpt_steps == 0:
+            self.save(epoch, self.model, optimizer, losses, global_steps, step + 1)
+            logging.info(f'{datetime.now()} | Saved checkpoint to: {self.checkpoint_path}')
+            with open(f'{self.log_dir}/{self.model_name}_train_results.json', 'w') as results_file:
+              json.dump(losses, results_file)
+              results_file.close()
+
+          if preemption.requested:
+            # 누적 중이던 gradient 는 저장하지 않으므로 재시작 후 첫 optimizer step 은 더 적은 배치로 계산된다.
+            self.save(epoch, self.model, optimizer, losses, global_steps, step + 1)
+            logging.info(f'{datetime.now()} | Preempted, saved checkpoint at epoch: {epoch} | epoch_step: {step + 1}')
+            raise SystemExit(preemption.exit_code)
+
+        # Evaluate every epoch
+        self.evaluate(eval_dataloader)
+        self.model.train()
+        start_step = 0
+
+        if preemption.requested:
+          self.save(epoch + 1, self.model, optimizer, losses, global_steps)
+          logging.info(f'{datetime.now()} | Preempted, saved checkpoint at epoch: {epoch + 1}')
+          raise SystemExit(preemption.exit_code)
+
+    self.save(epochs, self.model, optimizer, losses, global_steps)
 
-        if global_steps % ckpt_steps == 0:
-          self.save(epoch, self.model, optimizer, losses, global_steps)
-          logging.info(f'{datetime.now()} | Saved checkpoint to: {self.checkpoint_path}')
-          with open(f'{self.log_dir}/{self.model_name}_train_results.json', 'w') as results_file:
-            json.dump(losses, results_file)
-            results_file.close()
-
-      # Evaluate every epoch
-      self.evaluate(eval_dataloader)
-      self.model.train()
-      start_step = 0
+    return self.model
 
-    self.save(epoch, self.model, optimizer, losses, global_steps)
+  def compute_loss(self, batch):
+    # 학습 스텝의 loss (distillation 등 다른 loss 를 쓰는 trainer 는 이 메서드를 override 한다)
+    encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch  # _ is input_mask
+    encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
+    output = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels) # output: lm_logits, loss, encoder_logit, x
 
-    return self.model
+    return output[1]
 
   def evaluate(self, dataloader):
     self.model.eval()
@@ -175,7 +225,7 @@ class MeenaTrainer(object):
       encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch  # _ is input_mask
       encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
 
-      with torch.no_grad():
+      with torch.no_grad(), self.precision.autocast():
         output = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels) # output: lm_logits, loss, encoder_logit, x
 
       tmp_eval_loss = output[1]
@@ -196,17 +246,21 @@ class MeenaTrainer(object):
         results_file.write(f'{datetime.now()} | Step: {step} | Eval Loss: {total_eval_loss} | Perplexity: {total_perplexity}\n')
         results_file.close()
 
-  def save(self, epoch, model, optimizer, losses, train_step):
+  def save(self, epoch, model, optimizer, losses, train_step, epoch_step=0):
     model.cpu()
-    torch.save({
+    atomic_save({
       'epoch': epoch,  # 현재 학습 epoch
+      'epoch_step': epoch_step,  # 현재 epoch 에서 학습을 마친 배치 수 (재시작 위치)
       'model_state_dict': model.state_dict(),  # 모델 저장
       'optimizer_state_dict': optimizer.state_dict(),  # 옵티마이저 저장
       'losses': losses,  # Loss 저장
       'train_step': train_step,  # 현재 진행한 학습
-      'amp': amp.state_dict()
+      'scaler': self.precision.state_dict(),  # GradScaler loss scale
+      'rng_state': get_rng_state(),  # dropout 등 난수 상태
+      'seed': self.seed,  # 데이터 분할/순서 seed
+      'model_name': self.model_name
     }, f'{self.checkpoint_path}/{self.model_name}.pth')
-    model.cuda()
+    model.to(self.device)
 
 def meena_dataset(config, tokenizer, finetune_dataset):
   cache_data_path = f'{config.cache_path}/{config.model_name}.pickle'
@@ -245,14 +299,7 @@ def main():
   dataset = meena_dataset(config,tokenizer, DatasetForSeq2seqConversation)
 
   # Meena Model
-  model = Meena(
-          vocab_size = tokenizer.vocab_size,
-          dim=config.dim,
-          encoder_depth=config.encoder_depth,
-          decoder_depth=config.decoder_depth,
-          max_seq_len=config.max_seq_len,
-          head_num=config.n_head,
-          dropout=config.dropout_prob)
+  model = Meena.from_config(config, vocab_size=tokenizer.vocab_size)
 
   if torch.cuda.is_available():
     model.cuda(1)
@@ -263,6 +310,17 @@ def main():
 
   del checkpoint
 
+  if config.activation_checkpointing or config.activation_memory_budget:
+    set_activation_checkpointing(model,
+                                 every=config.activation_checkpointing,
+                                 memory_budget=config.activation_memory_budget,
+                                 batch_size=config.batch_size,
+                                 seq_len=config.max_seq_len,
+                                 bytes_per_element=2 if config.fp16 else 4)
+
+  if config.compile:
+    compile_meena(model)
+
   # optimizer = Adafactor(model.parameters())
   optimizer = Adafactor(model.parameters(),
                         scale_parameter=False, # (default: True) if True, learning rate is scaled by root mean square of parameter
@@ -271,9 +329,6 @@ def main():
                         lr=5e-5)
   # optimizer = AdamW(model.parameters(), lr=3e-4)
 
-  if config.fp16:
-    model, optimizer = amp.initialize(model, optimizer, opt_level=config.fp16_opt_level)
-
   # Pretraining Traniner
   trainer = MeenaTrainer(dataset, model, tokenizer,
                            model_name=config.model_name,
@@ -282,7 +337,8 @@ def main():
                            train_batch_size=config.batch_size,
                            eval_batch_size=config.batch_size,
                            log_dir=log_dir,
-                           fp16=config.fp16
+                           fp16=config.fp16,
+                           fp16_opt_level=config.fp16_opt_level
                          )
 
   train_dataloader, eval_dataloader = trainer.build_dataloaders(train_test_split=0.1)
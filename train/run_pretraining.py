@@ -11,14 +11,16 @@ from torch.utils.data import DataLoader, random_split
 from tqdm import tqdm
 from transformers import BertTokenizer
 from fairseq.optim.adafactor import Adafactor
-from apex import amp
 
 import os
+import itertools
 import json
 import logging
 from datetime import datetime
-from model.meena import Meena
+from model.meena import Meena, compile_meena, set_activation_checkpointing
 from common.arg import ModelConfig
+from common.precision import MixedPrecision
+from common.resume import ResumableSampler, PreemptionHandler, get_rng_state, load_resume_state, atomic_save
 from common.dataset import DatasetForSeq2seqV2
 
 class MeenaTrainer(object):
@@ -33,7 +35,9 @@ class MeenaTrainer(object):
                train_batch_size=8,
                eval_batch_size=None,
                log_dir='../logs',
-               fp16=True):
+               fp16=True,
+               fp16_opt_level='O1',
+               seed=9):
 
     self.dataset = dataset
     self.model = model
@@ -47,10 +51,13 @@ class MeenaTrainer(object):
     self.eval_batch_size = eval_batch_size
     self.log_dir = log_dir
     self.fp16 = fp16
+    self.seed = seed
 
     if device is None:
       self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 
+    self.precision = MixedPrecision(fp16, fp16_opt_level, self.device)
+
     if eval_batch_size is None:
       self.eval_batch_size = train_batch_size
 
@@ -60,8 +67,11 @@ class MeenaTrainer(object):
     dataset_len = len(self.dataset)
     eval_len = int(dataset_len * train_test_split)
     train_len = dataset_len - eval_len
-    train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len))
-    train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, shuffle=train_shuffle)
+    # 재시작해도 같은 분할과 순서가 나오도록 seed 를 고정한다.
+    train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len),
+                                               generator=torch.Generator().manual_seed(self.seed))
+    train_sampler = ResumableSampler(len(train_dataset), shuffle=train_shuffle, seed=self.seed)
+    train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, sampler=train_sampler)
     eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size, shuffle=eval_shuffle)
     logging.info(f'''train_dataloader size: {len(train_loader.dataset)} | shuffle: {train_shuffle}
                          eval_dataloader size: {len(eval_loader.dataset)} | shuffle: {eval_shuffle}''')
@@ -88,18 +98,15 @@ class MeenaTrainer(object):
     if os.path.isfile(f'{self.checkpoint_path}/{self.model_name}.pth'):
       self.model.cpu()
       checkpoint = torch.load(f'{self.checkpoint_path}/{self.model_name}.pth', map_location=self.device)
-      start_epoch = checkpoint['epoch']
-      losses = checkpoint['losses']
-      global_steps = checkpoint['train_step']
-      start_step = global_steps if start_epoch == 0 else global_steps % len(train_dataloader)
-
-      self.model.load_state_dict(checkpoint['model_state_dict'])
-      optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-      amp.load_state_dict(checkpoint['amp'])
+      resume_state = load_resume_state(checkpoint, self.model, optimizer, self.seed, len(train_dataloader),
+                                       precision=self.precision)
+      start_epoch, start_step, global_steps, losses = resume_state
 
       # remove checkpoint for gpu memory
       del checkpoint
 
+      logging.info(f'{datetime.now()} | Resumed from epoch: {start_epoch} | epoch_step: {start_step} | train_step: {global_steps}')
+
     # release unopccupied memory
     torch.cuda.empty_cache()
     self.model.train()
@@ -114,67 +121,87 @@ class MeenaTrainer(object):
 
     # Train
     self.model.zero_grad()  # Reset gradients tensors
-    for epoch in range(start_epoch, epochs):  # tqdm(range(epochs), desc='Epochs', position=0):
-      logging.info(f'{datetime.now()} | Epoch: {epoch}')
-      pb = tqdm(enumerate(train_dataloader),
-                desc=f'Epoch-{epoch} Iterator',
-                total=len(train_dataloader),
-                bar_format='{l_bar}{bar:10}{r_bar}'
-                )
-      for step, batch in pb:
-        # if step < start_step:
-          # continue
-        encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch  # _ is input_mask
-        encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
-        output = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels) # output: lm_logits, loss, encoder_logit, x
-
-        loss = output[1]
-
-        step_perplexity += torch.exp(loss)
-        origin_loss = loss.item()
-
-        loss = loss / gradient_accumulation_steps  # divide loss into gradient accumulation step
-        if self.fp16:
-          with amp.scale_loss(loss, optimizer) as scaled_loss:
-            scaled_loss.backward()
+    # 학습 데이터 순서는 ResumableSampler 가 정하므로 재시작할 때 앞선 배치를 다시 읽지 않는다.
+    train_sampler = train_dataloader.sampler
+    resumable = isinstance(train_sampler, ResumableSampler)
+    if resumable:
+      train_sampler.set_epoch(start_epoch)
+    steps_per_epoch = len(train_dataloader)
+
+    # SIGTERM/SIGINT 를 받으면 현재 배치를 마친 뒤 체크포인트를 저장하고 종료한다.
+    with PreemptionHandler() as preemption:
+      for epoch in range(start_epoch, epochs):  # tqdm(range(epochs), desc='Epochs', position=0):
+        logging.info(f'{datetime.now()} | Epoch: {epoch}')
+        if resumable:
+          # 이미 학습한 배치는 읽지 않고 start_step 번째 배치부터 시작한다.
+          train_sampler.set_epoch(epoch, start_step * train_dataloader.batch_size)
+          batches = enumerate(train_dataloader, start_step)
         else:
-          loss.backward()
-
-        step_loss += origin_loss
-        losses[global_steps] = origin_loss
-
-        local_steps += 1
-        global_steps += 1
-
-        if global_steps % gradient_accumulation_steps == 0:
-          if self.fp16:
-            torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), max_norm=1.0)
-          else:
+          batches = itertools.islice(enumerate(train_dataloader), start_step, None)
+        pb = tqdm(batches,
+                  desc=f'Epoch-{epoch} Iterator',
+                  initial=start_step,
+                  total=steps_per_epoch,
+                  bar_format='{l_bar}{bar:10}{r_bar}'
+                  )
+        for step, batch in pb:
+          encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch  # _ is input_mask
+          encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
+          with self.precision.autocast():
+            output = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels) # output: lm_logits, loss, encoder_logit, x
+
+          loss = output[1]
+
+          step_perplexity += torch.exp(loss)
+          origin_loss = loss.item()
+
+          loss = loss / gradient_accumulation_steps  # divide loss into gradient accumulation step
+          self.precision.backward(loss)
+
+          step_loss += origin_loss
+          losses[global_steps] = origin_loss
+
+          local_steps += 1
+          global_steps += 1
+
+          if global_steps % gradient_accumulation_steps == 0:
+            self.precision.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
 
-          optimizer.step()
-          self.model.zero_grad()
-
-        if global_steps % log_steps == 0:
-          pb.set_postfix_str(
-            f''' Train Loss: {format(step_loss / local_steps, ".4f")} | step_perplexity: {format(step_perplexity/local_steps,".4f")} | Steps: {global_steps}''')
-          step_loss = 0.0
-          local_steps = 0
-          step_perplexity =0.0
-
-        if global_steps % ckpt_steps == 0:
-          self.save(epoch, self.model, optimizer, losses, global_steps)
-          logging.info(f'{datetime.now()} | Saved checkpoint to: {self.checkpoint_path}')
-          with open(f'{self.log_dir}/{self.model_name}_train_results.json', 'w') as results_file:
-            json.dump(losses, results_file)
-            results_file.close()
-
-      # Evaluate every epoch
-      self.evaluate(eval_dataloader)
-      self.model.train()
-      start_step = 0
-
-    self.save(epoch, self.model, optimizer, losses, global_steps)
+            self.precision.step(optimizer)
+            self.model.zero_grad()
+
+          if global_steps % log_steps == 0:
+            pb.set_postfix_str(
+              f''' Train Loss: {format(step_loss / local_steps, ".4f")} | step_perplexity: {format(step_perplexity/local_steps,".4f")} | Steps: {global_steps}''')
+            step_loss = 0.0
+            local_steps = 0
+            step_perplexity =0.0
+
+          if global_steps % ckpt_steps == 0:
+            self.save(epoch, self.model, optimizer, losses, global_steps, step + 1)
+            logging.info(f'{datetime.now()} | Saved checkpoint to: {self.checkpoint_path}')
+            with open(f'{self.log_dir}/{self.model_name}_train_results.json', 'w') as results_file:
+              json.dump(losses, results_file)
+              results_file.close()
+
+          if preemption.requested:
+            # 누적 중이던 gradient 는 저장하지 않으므로 재시작 후 첫 optimizer step 은 더 적은 배치로 계산된다.
+            self.save(epoch, self.model, optimizer, losses, global_steps, step + 1)
+            logging.info(f'{datetime.now()} | Preempted, saved checkpoint at epoch: {epoch} | epoch_step: {step + 1}')
+            raise SystemExit(preemption.exit_code)
+
+        # Evaluate every epoch
+        self.evaluate(eval_dataloader)
+        self.model.train()
+        start_step = 0
+
+        if preemption.requested:
+          self.save(epoch + 1, self.model, optimizer, losses, global_steps)
+          logging.info(f'{datetime.now()} | Preempted, saved checkpoint at epoch: {epoch + 1}')
+          raise SystemExit(preemption.exit_code)
+
+    self.save(epochs, self.model, optimizer, losses, global_steps)
 
     return self.model
 
@@ -195,7 +222,7 @@ class MeenaTrainer(object):
       encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = batch  # _ is input_mask
       encoder_input_ids, decoder_input_ids, encoder_input_mask, labels = encoder_input_ids.to(self.device), decoder_input_ids.to(self.device), encoder_input_mask.to(self.device), labels.to(self.device)
 
-      with torch.no_grad():
+      with torch.no_grad(), self.precision.autocast():
         output = self.model(encoder_input_ids, decoder_input_ids, encoder_input_mask, labels) # output: lm_logits, loss, encoder_logit, x
 
       tmp_eval_loss = output[1]
@@ -216,17 +243,21 @@ class MeenaTrainer(object):
         results_file.write(f'{datetime.now()} | Step: {step} | Eval Loss: {total_eval_loss} | Perplexity: {total_perplexity}\n')
         results_file.close()
 
-  def save(self, epoch, model, optimizer, losses, train_step):
+  def save(self, epoch, model, optimizer, losses, train_step, epoch_step=0):
     model.cpu()
-    torch.save({
+    atomic_save({
       'epoch': epoch,  # 현재 학습 epoch
+      'epoch_step': epoch_step,  # 현재 epoch 에서 학습을 마친 배치 수 (재시작 위치)
       'model_state_dict': model.state_dict(),  # 모델 저장
       'optimizer_state_dict': optimizer.state_dict(),  # 옵티마이저 저장
       'losses': losses,  # Loss 저장
       'train_step': train_step,  # 현재 진행한 학습
-      'amp': amp.state_dict()
+      'scaler': self.precision.state_dict(),  # GradScaler loss scale
+      'rng_state': get_rng_state(),  # dropout 등 난수 상태
+      'seed': self.seed,  # 데이터 분할/순서 seed
+      'model_name': self.model_name
     }, f'{self.checkpoint_path}/{self.model_name}.pth')
-    model.cuda()
+    model.to(self.device)
 
 def meena_dataset(config, tokenizer):
   cache_data_path = f'{config.cache_path}/{config.model_name}.pickle'
@@ -262,25 +293,25 @@ def main():
   dataset = meena_dataset(config,tokenizer)
 
   # Meena Model
-  model = Meena(
-          vocab_size = tokenizer.vocab_size,
-          dim=config.dim,
-          encoder_depth=config.encoder_depth,
-          decoder_depth=config.decoder_depth,
-          max_seq_len=config.max_seq_len,
-          head_num=config.n_head,
-          dropout=config.dropout_prob
-          )
+  model = Meena.from_config(config, vocab_size=tokenizer.vocab_size)
   if torch.cuda.is_available():
     model.cuda()
 
+  if config.activation_checkpointing or config.activation_memory_budget:
+    set_activation_checkpointing(model,
+                                 every=config.activation_checkpointing,
+                                 memory_budget=config.activation_memory_budget,
+                                 batch_size=config.batch_size,
+                                 seq_len=config.max_seq_len,
+                                 bytes_per_element=2 if config.fp16 else 4)
+
+  if config.compile:
+    compile_meena(model)
+
   # optimizer = Adafactor(model.parameters())
   optimizer = Adafactor(model.parameters(), scale_parameter=False, relative_step=False, warmup_init=False, lr=3e-4)
   # optimizer = AdamW(model.parameters(), lr=3e-4)
 
-  if config.fp16:
-    model, optimizer = amp.initialize(model, optimizer, opt_level=config.fp16_opt_level)
-
   # Pretraining Traniner
   trainer = MeenaTrainer(dataset, model, tokenizer,
                            model_name=config.model_name,
@@ -289,7 +320,8 @@ def main():
                            train_batch_size=config.batch_size,
                            eval_batch_size=config.batch_size,
                            log_dir=log_dir,
-                           fp16=config.fp16
+                           fp16=config.fp16,
+                           fp16_opt_level=config.fp16_opt_level
                          )
 
   train_dataloader, eval_dataloader = trainer.build_dataloaders(train_test_split=0.1)